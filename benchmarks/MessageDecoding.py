@@ -0,0 +1,111 @@
+#!/usr/bin/python
+#-------------------------------------------------------------------------------
+# Copyright (c) 2011-2013 by European Organization for Nuclear Research (CERN)
+# Author: Lukasz Janyst <ljanyst@cern.ch>
+#-------------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+"""
+Micro-benchmark of the per-message cost of decoding requests and responses:
+compares creating the named tuple class for every message (what the decoders
+used to do) with instantiating the cached class, and times the complete
+decoders for a few message types. Also checks that a request received
+lazily stays undecoded, even with the server logging at the info level.
+"""
+
+import sys
+import socket
+import logging
+import timeit
+
+from collections import namedtuple
+
+from XrdImposter.ImposterClient import ImposterClient
+from XrdImposter.ImposterServer import ImposterServer
+from XrdImposter.MessageHelper import MessageHelper
+from XrdImposter.MessageCodec import getCodec
+from XrdImposter.XProtocol import XOpenRequestOption
+
+#-------------------------------------------------------------------------------
+def perMessage( func, number ):
+  """Return the best time per call in microseconds"""
+  times = timeit.repeat( func, number = number, repeat = 3 )
+  return min( times ) / number * 1e6
+
+#-------------------------------------------------------------------------------
+def main():
+  number  = int( sys.argv[1] ) if len( sys.argv ) > 1 else 20000
+  context = {'socket': None, 'streamid': 1}
+  client  = ImposterClient( context )
+  server  = ImposterServer( context )
+  mh      = MessageHelper( context )
+
+  openRequest = client.kXR_open( path='/data/file.root',
+                                 options=XOpenRequestOption.kXR_retstat )
+  requests = [
+    ('handshake', client.handshake()),
+    ('kXR_open',  openRequest),
+    ('kXR_stat',  client.kXR_stat( path='/data/file.root' )),
+    ('kXR_readv', client.kXR_readv( a=('\0\0\0\1', 4096, 0),
+                                    b=('\0\0\0\1', 4096, 8192) )),
+    ('kXR_write', client.kXR_write( data=65536 * 'x' )) ]
+
+  #-----------------------------------------------------------------------------
+  # Class creation per message vs the cached class
+  #-----------------------------------------------------------------------------
+  codec  = getCodec( ('ClientRequestHdr', 'ClientOpenRequest') )
+  fields = ('type',) + codec.names
+  values = ('kXR_open',) + codec.unpack( openRequest )
+  record = codec.getRecordType( 'request' )
+
+  print "%-30s %10s" % ('operation', 'us/msg')
+  print "%-30s %10.2f" % ('namedtuple per message',
+    perMessage( lambda: namedtuple( 'request', fields )( *values ),
+                number / 10 ))
+  print "%-30s %10.2f" % ('cached record type',
+    perMessage( lambda: record( *values ), number ))
+
+  #-----------------------------------------------------------------------------
+  # Complete decoders
+  #-----------------------------------------------------------------------------
+  for name, request in requests:
+    print "%-30s %10.2f" % ('unpackRequest ' + name,
+      perMessage( lambda: mh.unpackRequest( request ), number ))
+
+  response = server.kXR_open( fhandle='\0\0\0\1', cpsize=0, cptype='\0\0\0\0',
+                              data='1 2 3 4' )
+  print "%-30s %10.2f" % ('unpack_response kXR_open',
+    perMessage( lambda: mh.unpack_response( response, openRequest ), number ))
+
+  #-----------------------------------------------------------------------------
+  # Lazy receive: the body of a big write must not be decoded by the server
+  #-----------------------------------------------------------------------------
+  clientSocket, serverSocket = socket.socketpair()
+  try:
+    receiver = ImposterServer( {'socket': serverSocket, 'streamid': 1} )
+    receiver.logger.setLevel( logging.INFO )
+    clientSocket.sendall( requests[-1][1] )
+    request = next( receiver.receive( zeroCopy = True, lazy = True ) )
+    if request.record is not None or request.values:
+      print "[!] The lazily received %s has been decoded" % request.type
+      return 1
+  finally:
+    clientSocket.close()
+    serverSocket.close()
+  print "%-30s %10s" % ('lazy receive kXR_write', 'undecoded')
+
+#-------------------------------------------------------------------------------
+if __name__ == "__main__":
+  sys.exit( main() )
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+#-------------------------------------------------------------------------------
+# Copyright (c) 2011-2013 by European Organization for Nuclear Research (CERN)
+# Author: Lukasz Janyst <ljanyst@cern.ch>
+#-------------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+"""
+Micro-benchmark comparing the ImposterServer response builders with the
+precompiled response templates.
+"""
+
+import sys
+import timeit
+
+from XrdImposter.ImposterServer import ImposterServer
+from XrdImposter.XProtocol import XErrorCode
+
+#-------------------------------------------------------------------------------
+def perMessage( func, number ):
+  """Return the best time per call in microseconds"""
+  times = timeit.repeat( func, number = number, repeat = 3 )
+  return min( times ) / number * 1e6
+
+#-------------------------------------------------------------------------------
+def main():
+  number = int( sys.argv[1] ) if len( sys.argv ) > 1 else 20000
+  server = ImposterServer( {'socket': None} )
+  data   = 4096 * 'x'
+
+  okTemplate    = server.template( 'kXR_ok' )
+  errorTemplate = server.template( 'kXR_error', errnum=XErrorCode.kXR_NotFound )
+  waitTemplate  = server.template( 'kXR_wait', seconds=5 )
+  protoTemplate = server.template( 'kXR_protocol' )
+
+  cases = [
+    ('kXR_ok 4k',
+     lambda: server.kXR_ok( streamid=1, data=data ),
+     lambda: okTemplate.render( 1, data )),
+    ('kXR_error',
+     lambda: server.kXR_error( streamid=1, errnum=XErrorCode.kXR_NotFound,
+                               errmsg='No such file' ),
+     lambda: errorTemplate.render( 1, 'No such file' )),
+    ('kXR_wait',
+     lambda: server.kXR_wait( streamid=1, seconds=5, infomsg='busy' ),
+     lambda: waitTemplate.render( 1, 'busy' )),
+    ('kXR_protocol',
+     lambda: server.kXR_protocol( streamid=1 ),
+     lambda: protoTemplate.render( 1 )) ]
+
+  print "%-15s %12s %12s %8s" % ('response', 'builder us', 'template us',
+                                 'speedup')
+  for name, builder, template in cases:
+    if str( builder() ) != template().tobytes():
+      print "[!] %s: the template renders a different response" % name
+    b = perMessage( builder, number )
+    t = perMessage( template, number )
+    print "%-15s %12.2f %12.2f %7.1fx" % (name, b, t, b / t)
+
+#-------------------------------------------------------------------------------
+if __name__ == "__main__":
+  sys.exit( main() )
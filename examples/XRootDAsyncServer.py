@@ -0,0 +1,39 @@
+#-------------------------------------------------------------------------------
+# Copyright (c) 2011-2013 by European Organization for Nuclear Research (CERN)
+# Author: Lukasz Janyst <ljanyst@cern.ch>
+#-------------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+from XrdImposter.ImposterServer import ImposterServer
+
+class XRootDAsyncServer:
+  """Coroutine-based server answering the log in sequence and kXR_stat
+  requests, run by the async engine so that a single process can handle
+  many thousands of connections. The log in sequence is handled by the
+  ImposterServer dispatcher defaults, kXR_stat by a registered handler and
+  everything else gets a kXR_error."""
+
+  @classmethod
+  def getDescription( cls ):
+    return { 'type': 'Passive', 'ip': '0.0.0.0', 'port': 1095,
+             'clients': 10000, 'config': '', 'coroutine': True }
+
+  def __call__( self, context ):
+    server = ImposterServer( context )
+    server.register( 'kXR_stat',
+                     lambda request: server.kXR_stat( streamid=request.streamid,
+                                                      data='0 0 0 0\0' ) )
+    yield server.serveAsync()
+    server.close()
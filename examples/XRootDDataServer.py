@@ -0,0 +1,325 @@
+#-------------------------------------------------------------------------------
+# Copyright (c) 2011-2013 by European Organization for Nuclear Research (CERN)
+# Author: Lukasz Janyst <ljanyst@cern.ch>
+#-------------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+import os
+import mmap
+import stat
+import errno
+import struct
+import shutil
+
+from XrdImposter.ImposterServer import ImposterServer
+from XrdImposter.XProtocol import XErrorCode, XOpenRequestOption, \
+                                  XStatRequestOption, XStatRespFlags, \
+                                  XMkdirOptions, XRequestTypes
+
+errorCodes = {
+  errno.ENOENT:    XErrorCode.kXR_NotFound,
+  errno.ENOTDIR:   XErrorCode.kXR_NotFound,
+  errno.EACCES:    XErrorCode.kXR_NotAuthorized,
+  errno.EPERM:     XErrorCode.kXR_NotAuthorized,
+  errno.EROFS:     XErrorCode.kXR_NotAuthorized,
+  errno.EISDIR:    XErrorCode.kXR_isDirectory,
+  errno.ENOSPC:    XErrorCode.kXR_NoSpace,
+  errno.EDQUOT:    XErrorCode.kXR_NoSpace,
+  errno.ENOMEM:    XErrorCode.kXR_NoMemory,
+  errno.EIO:       XErrorCode.kXR_IOError,
+  errno.EBADF:     XErrorCode.kXR_FileNotOpen,
+  errno.EINVAL:    XErrorCode.kXR_ArgInvalid,
+  errno.ENAMETOOLONG: XErrorCode.kXR_ArgTooLong }
+
+class XRootDDataServer:
+  """Coroutine-based server serving a local directory tree, a lightweight
+  stand-in xrootd for client tests: kXR_open hands out file handles,
+  kXR_read and kXR_readv return the file data, kXR_stat, kXR_dirlist and
+  kXR_locate reflect the filesystem and kXR_write, kXR_sync, kXR_truncate,
+  kXR_mkdir, kXR_rm, kXR_rmdir, kXR_mv and kXR_chmod modify it.
+
+  The file data is sent straight from a map of the file, without copying
+  it, in response frames of at most 'framesize' bytes.
+
+  Every request type is handled by the method of the same name, registered
+  with the ImposterServer dispatcher, so a subclass may override or add any
+  of them. The paths are resolved within the 'root' directory,
+  which may be given with --param, ie. --param="root=/data/imposter"
+  """
+
+  @classmethod
+  def getDescription( cls ):
+    return { 'type': 'Passive', 'ip': '0.0.0.0', 'port': 1094,
+             'clients': 10000, 'config': '', 'coroutine': True,
+             'root': '/tmp/imposter-data', 'framesize': 2097152 }
+
+  def __call__( self, context ):
+    desc = self.getDescription()
+    desc.update( self.parseParam( context['param'] ) )
+    self.root      = os.path.abspath( desc['root'] )
+    self.frameSize = int( desc['framesize'] )
+    self.files     = {}
+    self.maps      = {}
+    self.handles   = 0
+    self.context   = context
+    server = ImposterServer( context )
+
+    if self.frameSize < 1:
+      print '[!] Invalid frame size: %d' % self.frameSize
+      server.close()
+      return
+
+    if not os.path.isdir( self.root ):
+      os.makedirs( self.root )
+
+    for type in XRequestTypes.reverseMapping.values():
+      handler = getattr( self, type, None )
+      if handler is not None:
+        server.register( type, self.guard( server, handler ) )
+    yield server.serveAsync()
+
+    for fhandle in self.files.keys():
+      self.release( fhandle )
+    server.close()
+
+  def parseParam( self, param ):
+    """Parse key=value pairs separated by semicolons"""
+    result = {}
+    if not param:
+      return result
+    for item in param.split( ';' ):
+      if item.strip():
+        key, value = item.split( '=', 1 )
+        result[key.strip()] = value.strip()
+    return result
+
+  #-----------------------------------------------------------------------------
+  # Helpers
+  #-----------------------------------------------------------------------------
+  def guard( self, server, handler ):
+    """Wrap the handler into a dispatcher one, the filesystem errors are
+    turned into kXR_error responses"""
+    def guarded( request ):
+      try:
+        return handler( server, request )
+      except (OSError, IOError), e:
+        errnum = errorCodes.get( e.errno, XErrorCode.kXR_FSError )
+        return server.kXR_error( streamid=request.streamid, errnum=errnum,
+                                 errmsg=e.strerror or str( e ) )
+    return guarded
+
+  def resolve( self, path ):
+    """Map a request path, possibly with the opaque info, into the root
+    directory; the path cannot escape it"""
+    path = str( path ).rstrip( '\0' ).split( '?', 1 )[0]
+    return os.path.join( self.root,
+                         os.path.normpath( '/' + path ).lstrip( '/' ) )
+
+  def newHandle( self, fd ):
+    self.handles += 1
+    fhandle = struct.pack( '>I', self.handles )
+    self.files[fhandle] = fd
+    return fhandle
+
+  def lookup( self, fhandle ):
+    try:
+      return self.files[str( fhandle )]
+    except KeyError:
+      raise OSError( errno.EBADF, 'Invalid file handle' )
+
+  def release( self, fhandle ):
+    fd = self.lookup( fhandle )
+    mapped = self.maps.pop( str( fhandle ), None )
+    if mapped is not None:
+      mapped.close()
+    del self.files[str( fhandle )]
+    os.close( fd )
+
+  def mapping( self, fhandle, offset ):
+    """Return a read-only map of the whole file, remapped whenever its size
+    has changed; the frames sent from it are done with before the next
+    request is handled"""
+    if offset < 0:
+      raise OSError( errno.EINVAL, 'Negative offset' )
+    fd     = self.lookup( fhandle )
+    size   = os.fstat( fd ).st_size
+    mapped = self.maps.get( str( fhandle ) )
+    if mapped is not None:
+      if len( mapped ) == size:
+        return mapped
+      mapped.close()
+      del self.maps[str( fhandle )]
+    if not size:
+      return ''
+    mapped = mmap.mmap( fd, size, access = mmap.ACCESS_READ )
+    self.maps[str( fhandle )] = mapped
+    return mapped
+
+  def pwrite( self, fd, data, offset ):
+    os.lseek( fd, offset, os.SEEK_SET )
+    view = memoryview( data )
+    while len( view ):
+      view = view[os.write( fd, view ):]
+
+  def statInfo( self, st, path = None ):
+    """Format the stat information as in the kXR_stat response"""
+    flags = XStatRespFlags.kXR_file
+    if stat.S_ISDIR( st.st_mode ):
+      flags |= XStatRespFlags.kXR_isDir
+    elif not stat.S_ISREG( st.st_mode ):
+      flags |= XStatRespFlags.kXR_other
+    if st.st_mode & 0111:
+      flags |= XStatRespFlags.kXR_xset
+    if path is None or os.access( path, os.R_OK ):
+      flags |= XStatRespFlags.kXR_readable
+    if path is None or os.access( path, os.W_OK ):
+      flags |= XStatRespFlags.kXR_writable
+    ident = (st.st_dev << 32) | (st.st_ino & 0xffffffff)
+    return '%d %d %d %d' % (ident, st.st_size, flags, int( st.st_mtime ))
+
+  #-----------------------------------------------------------------------------
+  # Files
+  #-----------------------------------------------------------------------------
+  def kXR_open( self, server, request ):
+    path    = self.resolve( request.path )
+    options = request.options
+    flags   = os.O_RDONLY
+    if options & (XOpenRequestOption.kXR_open_updt |
+                  XOpenRequestOption.kXR_open_apnd):
+      flags = os.O_RDWR
+    if options & XOpenRequestOption.kXR_open_apnd:
+      flags |= os.O_APPEND
+    if options & XOpenRequestOption.kXR_delete:
+      flags = os.O_RDWR | os.O_CREAT | os.O_TRUNC
+    elif options & XOpenRequestOption.kXR_new:
+      flags = os.O_RDWR | os.O_CREAT | os.O_EXCL
+    if options & XOpenRequestOption.kXR_mkpath and flags & os.O_CREAT:
+      parent = os.path.dirname( path )
+      if not os.path.isdir( parent ):
+        os.makedirs( parent )
+
+    fd = os.open( path, flags, (request.mode & 0777) or 0644 )
+    if stat.S_ISDIR( os.fstat( fd ).st_mode ):
+      os.close( fd )
+      raise OSError( errno.EISDIR, 'Is a directory' )
+    fhandle = self.newHandle( fd )
+
+    if options & XOpenRequestOption.kXR_retstat:
+      return server.kXR_open( streamid=request.streamid, fhandle=fhandle,
+                              cpsize=0, cptype='\0' * 4,
+                              data=self.statInfo( os.fstat( fd ) ) + '\0' )
+    return server.kXR_open( streamid=request.streamid, fhandle=fhandle )
+
+  def kXR_close( self, server, request ):
+    self.release( request.fhandle )
+    return server.kXR_ok( streamid=request.streamid )
+
+  def kXR_read( self, server, request ):
+    source = self.mapping( request.fhandle, request.offset )
+    return server.readFrames( request.streamid, source, request.offset,
+                              request.rlen, self.frameSize )
+
+  def kXR_readv( self, server, request ):
+    chunks = []
+    for chunk in request.chunks:
+      source = self.mapping( chunk.fhandle, chunk.offset )
+      chunks.append( (chunk.fhandle, source, chunk.offset, chunk.length) )
+    return server.readvFrames( request.streamid, chunks, self.frameSize )
+
+  def kXR_write( self, server, request ):
+    fd = self.lookup( request.fhandle )
+    self.pwrite( fd, request.data, request.offset )
+    return server.kXR_ok( streamid=request.streamid )
+
+  def kXR_sync( self, server, request ):
+    os.fsync( self.lookup( request.fhandle ) )
+    return server.kXR_ok( streamid=request.streamid )
+
+  def kXR_truncate( self, server, request ):
+    if request.dlen:
+      f = open( self.resolve( request.path ), 'r+b' )
+      try:
+        f.truncate( request.size )
+      finally:
+        f.close()
+    else:
+      os.ftruncate( self.lookup( request.fhandle ), request.size )
+    return server.kXR_ok( streamid=request.streamid )
+
+  #-----------------------------------------------------------------------------
+  # Namespace
+  #-----------------------------------------------------------------------------
+  def kXR_stat( self, server, request ):
+    if request.options & XStatRequestOption.kXR_vfs:
+      vfs  = os.statvfs( self.resolve( request.path ) )
+      free = vfs.f_bavail * vfs.f_frsize >> 20
+      used = 100 - 100 * vfs.f_bavail / max( vfs.f_blocks, 1 )
+      data = '1 %d %d 0 0 0' % (free, used)
+    elif request.dlen:
+      path = self.resolve( request.path )
+      data = self.statInfo( os.stat( path ), path )
+    else:
+      data = self.statInfo( os.fstat( self.lookup( request.fhandle ) ) )
+    return server.kXR_stat( streamid=request.streamid, data=data + '\0' )
+
+  def kXR_dirlist( self, server, request ):
+    entries = sorted( os.listdir( self.resolve( request.path ) ) )
+    return server.kXR_dirlist( streamid=request.streamid, entries=entries )
+
+  def kXR_locate( self, server, request ):
+    path = self.resolve( request.path )
+    os.stat( path )
+    access = 'w' if os.access( path, os.W_OK ) else 'r'
+    host, port = self.context['socket'].getsockname()[:2]
+    return server.kXR_locate( streamid=request.streamid,
+                              locations=['S%s%s:%d' % (access, host, port)] )
+
+  def kXR_mkdir( self, server, request ):
+    path = self.resolve( request.path )
+    mode = (request.mode & 0777) or 0755
+    if ord( request.options ) & XMkdirOptions.kXR_mkdirpath:
+      if not os.path.isdir( path ):
+        os.makedirs( path, mode )
+    else:
+      os.mkdir( path, mode )
+    return server.kXR_ok( streamid=request.streamid )
+
+  def kXR_rm( self, server, request ):
+    os.remove( self.resolve( request.path ) )
+    return server.kXR_ok( streamid=request.streamid )
+
+  def kXR_rmdir( self, server, request ):
+    os.rmdir( self.resolve( request.path ) )
+    return server.kXR_ok( streamid=request.streamid )
+
+  def kXR_mv( self, server, request ):
+    paths = str( request.path ).rstrip( '\0' ).split( ' ' )
+    if len( paths ) != 2:
+      raise OSError( errno.EINVAL, 'Expected the source and the destination' )
+    shutil.move( self.resolve( paths[0] ), self.resolve( paths[1] ) )
+    return server.kXR_ok( streamid=request.streamid )
+
+  def kXR_chmod( self, server, request ):
+    os.chmod( self.resolve( request.path ), request.mode & 0777 )
+    return server.kXR_ok( streamid=request.streamid )
+
+  #-----------------------------------------------------------------------------
+  # Session, the log in sequence is answered by the ImposterServer defaults
+  #-----------------------------------------------------------------------------
+  def kXR_ping( self, server, request ):
+    return server.kXR_ok( streamid=request.streamid )
+
+  def kXR_endsess( self, server, request ):
+    return server.kXR_ok( streamid=request.streamid )
@@ -0,0 +1,281 @@
+#-------------------------------------------------------------------------------
+# Copyright (c) 2011-2013 by European Organization for Nuclear Research (CERN)
+# Author: Lukasz Janyst <ljanyst@cern.ch>
+#-------------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+import random
+import itertools
+import struct
+import threading
+import time
+
+from XrdImposter import OpenLoop
+from XrdImposter.ImposterClient import ImposterClient
+from XrdImposter.LoadStatistics import LoadStatistics
+from XrdImposter.XProtocol import XResponseType, XOpenRequestOption, \
+                                  XOpenRequestMode
+
+class XRootDLoadClient:
+  """Put a server under sustained load: every connection logs in, creates
+  its own file and then runs a random mix of requests for the given
+  duration or number of operations, keeping up to 'depth' of them in
+  flight. The ops/s, MB/s and latency percentiles per request type are
+  printed every 'interval' seconds and at the end. Run with --pooled the
+  connections come logged in from the session pool and go back to it.
+
+  With 'schedule' set to constant or poisson every connection sends
+  'oprate' requests a second on a timeline independent of the responses
+  instead of waiting for them, and the latencies are measured from the
+  intended send times, so that a stalling server is not let off by the
+  requests it held back; the pipeline needs to be 'depth' enough to keep
+  up with the rate.
+
+  The description values may be overridden with --param, ie.
+  --param="duration=30;mix=read:60,readv:10,write:10,stat:20;depth=4"
+  """
+
+  lock       = threading.Lock()
+  stats      = None
+  service    = None
+  lag        = {'requests': 0, 'late': 0, 'maxlag': 0.0}
+  remaining  = None
+
+  @classmethod
+  def getDescription(cls):
+    return { 'type': 'Active', 'hostname': 'localhost', 'port': 1094,
+             'clients': 10, 'config': '',
+             'duration': 10, 'operations': 0, 'interval': 5, 'depth': 1,
+             'mix': 'open:5,read:40,readv:15,write:20,stat:20',
+             'schedule': 'closed', 'oprate': 100,
+             'blocksize': 65536, 'chunks': 4, 'filesize': 8388608,
+             'path': '/tmp/imposter-load' }
+
+  def __call__(self, context):
+    desc = self.getDescription()
+    desc.update(self.parseParam(context['param']))
+    cls = self.__class__
+
+    cls.lock.acquire()
+    if cls.stats is None:
+      interval = float(desc['interval']) or None
+      if desc['schedule'] == 'closed':
+        cls.stats = LoadStatistics(interval)
+      else:
+        cls.stats   = LoadStatistics(interval,
+                                     'latencies from the intended send time')
+        cls.service = LoadStatistics(None,
+                                     'service times from the actual send time')
+      if int(desc['operations']):
+        cls.remaining = int(desc['operations'])
+    cls.lock.release()
+
+    self.run(context, desc)
+
+  @classmethod
+  def finish(cls):
+    """Print the final report, called by imposter.py once all the clients
+    are done, including the ones that failed or never connected"""
+    if cls.stats is None:
+      return
+    print cls.stats.finalReport()
+    if cls.service is not None:
+      print cls.service.finalReport()
+      print '[i] Open loop: %d requests, %d sent late, max lag %.3fms' % \
+            (cls.lag['requests'], cls.lag['late'], cls.lag['maxlag'] * 1000.0)
+
+  def parseParam(self, param):
+    """Parse key=value pairs separated by semicolons"""
+    result = {}
+    if not param:
+      return result
+    for item in param.split(';'):
+      if item.strip():
+        key, value = item.split('=', 1)
+        result[key.strip()] = value.strip()
+    return result
+
+  def parseMix(self, mix):
+    """Return the cumulative weights of the request types"""
+    cumulative = []
+    total = 0
+    for item in mix.split(','):
+      name, weight = item.split(':')
+      total += int(weight)
+      cumulative.append((total, name.strip()))
+    return cumulative, total
+
+  def claim(self):
+    """Check if there is one more operation to run"""
+    cls = self.__class__
+    if cls.remaining is None:
+      return True
+    cls.lock.acquire()
+    try:
+      if cls.remaining <= 0:
+        return False
+      cls.remaining -= 1
+      return True
+    finally:
+      cls.lock.release()
+
+  def login(self, client):
+    for build in (client.handshake, client.kXR_protocol,
+                  lambda: client.kXR_login(username='imposter')):
+      client.send(build())
+      response = client.receive()
+    status = struct.unpack('>H', response[2:4])[0]
+    if status != XResponseType.kXR_ok:
+      raise Exception('Client %s: login failed with status %d' %
+                      (client.context['streamid'], status))
+
+  def run(self, context, desc):
+    client    = ImposterClient(context)
+    stats     = self.__class__.stats
+    blocksize = int(desc['blocksize'])
+    chunks    = int(desc['chunks'])
+    filesize  = max(int(desc['filesize']), blocksize)
+    blocks    = filesize / blocksize
+    path      = '%s/load-%d' % (desc['path'], context['streamid'])
+    data      = 'x' * blocksize
+    mix, totalWeight = self.parseMix(desc['mix'])
+    deadline  = None
+    if float(desc['duration']) and self.__class__.remaining is None:
+      deadline = time.time() + float(desc['duration'])
+
+    #---------------------------------------------------------------------------
+    # The pooled sessions (imposter.py --pooled) come logged in already
+    #---------------------------------------------------------------------------
+    if 'session' not in context:
+      self.login(client)
+    pipeline = client.pipeline(depth=int(desc['depth']))
+
+    #---------------------------------------------------------------------------
+    # Create the file and fill it so that there is something to read
+    #---------------------------------------------------------------------------
+    future = pipeline.submit('kXR_open', path=path,
+                             mode=XOpenRequestMode.kXR_ur |
+                                  XOpenRequestMode.kXR_uw,
+                             options=XOpenRequestOption.kXR_delete |
+                                     XOpenRequestOption.kXR_mkpath |
+                                     XOpenRequestOption.kXR_open_updt)
+    future.wait()
+    if future.status() != XResponseType.kXR_ok:
+      raise Exception('Client %s: unable to create %s' %
+                      (context['streamid'], path))
+    fhandle = future.raw[8:12]
+    for i in xrange(blocks):
+      pipeline.submit('kXR_write', fhandle=fhandle, offset=i * blocksize,
+                      data=data)
+    pipeline.drain()
+
+    #---------------------------------------------------------------------------
+    # Run the mix, either closed loop, the latency going from the time the
+    # request is written, or open loop on the timeline of the scheduler
+    #---------------------------------------------------------------------------
+    toClose = []
+
+    def transferred(type, future):
+      if type in ('read', 'readv'):
+        return len(future.raw) - 8 + sum([len(p) - 8 for p in future.partials])
+      elif type == 'write':
+        return blocksize
+      return 0
+
+    def done(type, start):
+      def callback(future):
+        failed = future.status() != XResponseType.kXR_ok
+        stats.record(type, time.time() - start, transferred(type, future),
+                     failed)
+      return callback
+
+    def opened(future):
+      if future.status() == XResponseType.kXR_ok:
+        toClose.append(future.raw[8:12])
+
+    def submit(intended, type, name, **kwargs):
+      # Waiting for a free stream id and for the rate limit is not latency
+      future = pipeline.submit(name, **kwargs)
+      pipeline.flush()
+      future.addCallback(done(type, time.time()))
+      return future
+
+    scheduler = None
+    schedule  = itertools.repeat(None)
+    if desc['schedule'] != 'closed':
+      if desc['schedule'] not in OpenLoop.arrivals:
+        raise Exception('Unknown schedule: %s' % desc['schedule'])
+      timeline  = OpenLoop.arrivals[desc['schedule']](float(desc['oprate']))
+      scheduler = OpenLoop.OpenLoopScheduler(pipeline, timeline, stats,
+                                             self.__class__.service,
+                                             transferred)
+      schedule  = iter(scheduler)
+      submit    = scheduler.submit
+
+    while True:
+      while toClose:
+        submit(time.time(), 'close', 'kXR_close', fhandle=toClose.pop())
+
+      if deadline is not None and time.time() >= deadline:
+        break
+      if not self.claim():
+        break
+
+      choice = random.randint(1, totalWeight)
+      for weight, type in mix:
+        if choice <= weight:
+          break
+
+      intended = next(schedule)
+      if type == 'open':
+        future = submit(intended, type, 'kXR_open', path=path,
+                        options=XOpenRequestOption.kXR_open_read)
+        future.addCallback(opened)
+      elif type == 'read':
+        future = submit(intended, type, 'kXR_read', fhandle=fhandle,
+                        rlen=blocksize,
+                        offset=random.randrange(blocks) * blocksize)
+      elif type == 'readv':
+        chunk   = blocksize / chunks
+        offsets = random.sample(xrange(filesize / chunk), chunks)
+        lists   = dict([('chunk%d' % i, (fhandle, chunk, o * chunk))
+                        for i, o in enumerate(offsets)])
+        future  = submit(intended, type, 'kXR_readv', **lists)
+      elif type == 'write':
+        future = submit(intended, type, 'kXR_write', fhandle=fhandle, data=data,
+                        offset=random.randrange(blocks) * blocksize)
+      elif type == 'stat':
+        future = submit(intended, type, 'kXR_stat', path=path)
+      else:
+        raise Exception('Unknown request type in the mix: %s' % type)
+
+      report = stats.intervalReport()
+      if report:
+        print report
+
+    pipeline.drain()
+    if scheduler is not None:
+      cls = self.__class__
+      cls.lock.acquire()
+      cls.lag['requests'] += scheduler.counters['requests']
+      cls.lag['late']     += scheduler.counters['late']
+      cls.lag['maxlag']    = max(cls.lag['maxlag'],
+                                 scheduler.counters['maxlag'])
+      cls.lock.release()
+    for handle in toClose + [fhandle]:
+      pipeline.submit('kXR_close', fhandle=handle)
+    pipeline.drain()
+    if 'session' not in context:
+      context['socket'].close()
@@ -0,0 +1,124 @@
+#-------------------------------------------------------------------------------
+# Copyright (c) 2011-2013 by European Organization for Nuclear Research (CERN)
+# Author: Lukasz Janyst <ljanyst@cern.ch>
+#-------------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+import time
+import struct
+
+from XrdImposter.Capture import CaptureReader, isRequest
+from XrdImposter.ImposterClient import ImposterClient
+from XrdImposter.MessageHelper import MessageException
+
+class XRootDReplayClient:
+  """Replay the requests of a capture recorded with imposter.py --capture,
+  either on the client or on the server side. Client number i replays the
+  i-th connection of the capture, so set 'clients' to the number of
+  connections to replay.
+
+  A request is only sent once the responses the original client had
+  received before sending it have come, the rest of the pacing depends on
+  'speed': 1 keeps the original timing, 2 replays twice as fast and 0 as
+  fast as possible. The file handles and other values handed out by the
+  server are replayed as they were recorded.
+
+  The description values may be overridden with --param, ie.
+  --param="capture=/tmp/session.cap;speed=0"
+  """
+
+  @classmethod
+  def getDescription(cls):
+    return { 'type': 'Active', 'hostname': 'localhost', 'port': 1094,
+             'clients': 1, 'config': '',
+             'capture': 'imposter.cap', 'speed': 1, 'timeout': 10 }
+
+  def __call__(self, context):
+    desc = self.getDescription()
+    desc.update(self.parseParam(context['param']))
+    speed  = float(desc['speed'])
+    number = context['streamid']
+
+    reader = CaptureReader(desc['capture'])
+    try:
+      connections = reader.connections()
+      if number >= len(connections):
+        print '[!] Client %d: the capture has %d connections only' % \
+              (number, len(connections))
+        return
+      context['socket'].settimeout(float(desc['timeout']))
+      self.replay(ImposterClient(context), reader, connections[number], speed)
+    finally:
+      reader.close()
+      context['socket'].close()
+
+  def parseParam(self, param):
+    """Parse key=value pairs separated by semicolons"""
+    result = {}
+    if not param:
+      return result
+    for item in param.split(';'):
+      if item.strip():
+        key, value = item.split('=', 1)
+        result[key.strip()] = value.strip()
+    return result
+
+  def replay(self, client, reader, connection, speed):
+    recorded = {}
+    replayed = {}
+    state    = {'received': 0}
+    expected = 0
+    sent     = 0
+    origin   = None
+    start    = time.time()
+
+    def receive(count):
+      """Receive responses until count of them have come"""
+      while state['received'] < count:
+        try:
+          response = client.receive()
+        except MessageException, e:
+          print '[!] Connection %x: %d responses missing: %s' % \
+                (connection, count - state['received'], e)
+          state['received'] = count
+          return False
+        status = struct.unpack('>H', response[2:4])[0]
+        replayed[status] = replayed.get(status, 0) + 1
+        state['received'] += 1
+      return True
+
+    for record in reader.records(connection):
+      if not isRequest(record.data):
+        status = struct.unpack('>H', record.data[2:4])[0]
+        recorded[status] = recorded.get(status, 0) + 1
+        expected += 1
+        continue
+
+      if not receive(expected):
+        break
+      if origin is None:
+        origin = record.timestamp
+      if speed:
+        delay = start + (record.timestamp - origin) / speed - time.time()
+        if delay > 0:
+          time.sleep(delay)
+      client.send(record.data)
+      sent += 1
+    else:
+      receive(expected)
+
+    print '[i] Connection %x: %d requests in %.3fs, responses by status: ' \
+          'recorded %s, replayed %s' % (connection, sent, time.time() - start,
+                                        recorded, replayed)
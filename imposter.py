@@ -19,9 +19,15 @@
 
 import getopt
 import sys
+import os
+import time
+import errno
 import socket
+import pickle
+import traceback
+import itertools
 
-from threading import Thread
+from threading import Thread, Semaphore
 
 #-------------------------------------------------------------------------------
 def printHelp():
@@ -32,21 +38,254 @@ def printHelp():
   print "    --libpath=path       path containing the interaction definitions"
   print "    --help               print this help message"
   print "    --log=LEVEL          logging level DEBUG|INFO|WARNING|ERROR|CRITICAL"
+  print "    --engine=ENGINE      thread (one thread per connection) or async"
+  print "                         (coroutines in a single event loop), defaults"
+  print "                         to async for coroutine-based scenarios"
+  print "    --workers=N          number of processes sharing the listening socket"
+  print "                         of a passive scenario"
+  print "    --capture=FILE       record all the messages sent and received to"
+  print "                         a binary capture file"
+  print "    --clients=N          number of clients of an active scenario, or of"
+  print "                         connections a passive scenario serves before"
+  print "                         exiting, or unlimited"
+  print "    --backlog=N          listen backlog of a passive scenario, defaults"
+  print "                         to SOMAXCONN"
+  print "    --max-connections=N  number of connections a passive scenario serves"
+  print "                         concurrently in each worker, 0 for no limit"
+  print "    --admission=MODE     what to do with the connections over the limit:"
+  print "                         queue (leave them in the backlog), wait or"
+  print "                         error (answer the log in with kXR_wait or"
+  print "                         kXR_error and close)"
+  print "    --pooled             run an active scenario on logged in sessions"
+  print "                         reused across its clients"
+  print "    --warm=N             number of pooled sessions to log in before the"
+  print "                         clients of an active scenario start"
+  print "    --ramp=N             connections an active scenario opens per second,"
+  print "                         0 for all at once"
+  print "    --rate=N             requests per second all the clients of an active"
+  print "                         scenario send together, 0 for no limit"
+  print "    --burst=N            requests sent at once when the clients have been"
+  print "                         under the rate, defaults to 1"
+  print "    --retries=N          attempts to connect again after a failure"
+  print "    --retry-delay=S      delay before the first retry, doubled for the"
+  print "                         next ones up to --max-retry-delay"
+  print "    --max-retry-delay=S  longest delay between the retries"
+
+#-------------------------------------------------------------------------------
+# Capture writer enabled with --capture
+#-------------------------------------------------------------------------------
+capture = None
+
+#-------------------------------------------------------------------------------
+# Connection settings of the passive scenarios and their defaults
+#-------------------------------------------------------------------------------
+passiveDefaults = {'backlog': socket.SOMAXCONN, 'maxconnections': 0,
+                   'admission': 'queue', 'waittime': 5}
+
+#-------------------------------------------------------------------------------
+# Pacing and connection settings of the active scenarios and their defaults
+#-------------------------------------------------------------------------------
+activeDefaults = {'ramp': 0, 'rate': 0, 'burst': 1, 'retries': 0,
+                  'retrydelay': 0.1, 'maxretrydelay': 5}
 
 #-------------------------------------------------------------------------------
 class SocketHandler( Thread ):
   #-----------------------------------------------------------------------------
-  def __init__( self, scenario, context ):
+  def __init__( self, scenario, context, done = None ):
     Thread.__init__( self )
     self.scenario = scenario
     self.context  = context
+    self.done     = done
+    self.failed   = False
 
   #-----------------------------------------------------------------------------
   def run( self ):
-    self.scenario( self.context )
+    try:
+      self.scenario( self.context )
+    except:
+      self.failed = True
+      raise
+    finally:
+      if self.done:
+        self.done()
+
+#-------------------------------------------------------------------------------
+def getPassiveSettings( desc, overrides ):
+  """Merge the connection settings of a passive scenario description with
+  the ones given on the commandline, the number of clients is None if
+  unlimited"""
+  settings = dict( passiveDefaults )
+  settings['clients'] = desc['clients']
+  for key in passiveDefaults:
+    if key in desc:
+      settings[key] = desc[key]
+  settings.update( overrides )
+
+  if str( settings['clients'] ).lower() == 'unlimited':
+    settings['clients'] = None
+  else:
+    settings['clients'] = int( settings['clients'] )
+  for key in ('backlog', 'maxconnections', 'waittime'):
+    settings[key] = int( settings[key] )
+    if settings[key] < (1 if key == 'backlog' else 0):
+      raise ValueError( '%s: %d' % (key, settings[key]) )
+  if settings['admission'] not in ('queue', 'wait', 'error'):
+    raise ValueError( 'admission: %s' % settings['admission'] )
+  return settings
+
+#-------------------------------------------------------------------------------
+def getActiveSettings( desc, overrides ):
+  """Merge the pacing settings of an active scenario description with the
+  ones given on the commandline"""
+  settings = dict( activeDefaults )
+  for key in activeDefaults:
+    if key in desc:
+      settings[key] = desc[key]
+  settings.update( overrides )
+
+  for key in ('ramp', 'rate', 'retrydelay', 'maxretrydelay'):
+    settings[key] = float( settings[key] )
+    if settings[key] < 0:
+      raise ValueError( '%s: %s' % (key, settings[key]) )
+  for key in ('burst', 'retries'):
+    settings[key] = int( settings[key] )
+    if settings[key] < (1 if key == 'burst' else 0):
+      raise ValueError( '%s: %d' % (key, settings[key]) )
+  return settings
+
+#-------------------------------------------------------------------------------
+def rejectionServer( context, settings ):
+  """Return an ImposterServer answering the handshake of a connection over
+  the limit and rejecting the request following it, and the list the
+  rejected requests are appended to"""
+  from XrdImposter.ImposterServer import ImposterServer
+  from XrdImposter.XProtocol import XErrorCode
+  server   = ImposterServer( context )
+  rejected = []
+
+  def reject( request ):
+    rejected.append( request )
+    if settings['admission'] == 'wait':
+      return server.kXR_wait( streamid = request.streamid,
+                              seconds = settings['waittime'],
+                              infomsg = 'Too many connections' )
+    return server.kXR_error( streamid = request.streamid,
+                             errnum = XErrorCode.kXR_ServerError,
+                             errmsg = 'Too many connections' )
+
+  server.register( 'kXR_login', reject )
+  server.register( 'kXR_auth', reject )
+  server.fallback = reject
+  return server, rejected
+
+#-------------------------------------------------------------------------------
+def rejectConnection( context, settings ):
+  """Reject a connection over the limit and close it"""
+  from XrdImposter.MessageHelper import MessageException
+  server, rejected = rejectionServer( context, settings )
+  try:
+    for request in server.receive():
+      server.respond( server.dispatch( request ) )
+      server.flush()
+      if rejected:
+        break
+  except MessageException:
+    pass
+  server.close()
+
+#-------------------------------------------------------------------------------
+def rejectConnectionAsync( context, settings ):
+  """Coroutine variant of rejectConnection"""
+  from XrdImposter.MessageHelper import MessageException
+  server, rejected = rejectionServer( context, settings )
+  try:
+    while not rejected:
+      request = yield server.receiveAsync()
+      if not request:
+        break
+      yield server.respondAsync( server.dispatch( request ) )
+      yield server.mh.flushAsync()
+  except MessageException:
+    pass
+  server.close()
+
+#-------------------------------------------------------------------------------
+def runWorkers( serve, numClients, numWorkers ):
+  """Fork the workers, each of them serving its share of the clients, and
+  aggregate their exit codes and counters"""
+
+  #-----------------------------------------------------------------------------
+  # Start the workers, they inherit the listening socket and compete for
+  # the connections in accept
+  #-----------------------------------------------------------------------------
+  workers = []
+  first   = 0
+  for i in range( numWorkers ):
+    if numClients is None:
+      share = None
+    else:
+      share = numClients / numWorkers + \
+              (1 if i < numClients % numWorkers else 0)
+    (readFd, writeFd) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+      os.close( readFd )
+      counters = {}
+      status   = 1
+      try:
+        status = serve( first, share, counters ) or 0
+      except:
+        traceback.print_exc()
+      sys.stdout.flush()
+      if capture:
+        capture.flush()
+      os.write( writeFd, pickle.dumps( counters ) )
+      os._exit( status )
+    os.close( writeFd )
+    workers.append( (i, pid, readFd) )
+    first += share or 0
+
+  #-----------------------------------------------------------------------------
+  # Collect the results
+  #-----------------------------------------------------------------------------
+  status = 0
+  totals = {}
+  for (i, pid, readFd) in workers:
+    data = ''
+    while True:
+      chunk = os.read( readFd, 65536 )
+      if not chunk:
+        break
+      data += chunk
+    os.close( readFd )
+    (pid, waitStatus) = os.waitpid( pid, 0 )
+
+    if os.WIFSIGNALED( waitStatus ):
+      code = 128 + os.WTERMSIG( waitStatus )
+    else:
+      code = os.WEXITSTATUS( waitStatus )
+
+    counters = pickle.loads( data ) if data else {}
+    for k, v in counters.items():
+      if k == 'seconds':
+        totals[k] = max( totals.get( k, 0 ), v )
+      else:
+        totals[k] = totals.get( k, 0 ) + v
+
+    print "[i] Worker %d (pid %d): exit code %d, %s" % \
+          (i, pid, code, formatCounters( counters ))
+    if code and not status:
+      status = code
+
+  print "[i] All workers: %s" % formatCounters( totals )
+  return status
+
+#-------------------------------------------------------------------------------
+def formatCounters( counters ):
+  return ', '.join( ['%s: %s' % (k, counters[k]) for k in sorted( counters )] )
 
 #-------------------------------------------------------------------------------
-def runPassive( scenario, param ):
+def runPassive( scenario, param, numWorkers = 1, overrides = {} ):
 
   #-----------------------------------------------------------------------------
   # Get the necessary information from the scenario description
@@ -57,11 +296,15 @@ def runPassive( scenario, param ):
   try:
     listenIP   = desc['ip']
     listenPort = desc['port']
-    numClients = desc['clients']
     config     = desc['config']
+    settings   = getPassiveSettings( desc, overrides )
+    numClients = settings['clients']
   except KeyError, err:
     print "[!] Info missing in scenario description:", err
     return 10
+  except ValueError, err:
+    print "[!] Invalid connection settings:", err
+    return 14
 
   #-----------------------------------------------------------------------------
   # Listen to the incoming connections
@@ -70,22 +313,222 @@ def runPassive( scenario, param ):
     serverSocket = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
     serverSocket.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
     serverSocket.bind( (listenIP, listenPort) )
-    serverSocket.listen( 5 )
+    serverSocket.listen( settings['backlog'] )
   except socket.error, e:
       print "[!] Socket error:", e
       return 11
-      
+
+  #-----------------------------------------------------------------------------
+  # Serve the clients numbered from first to first + numClients - 1, or
+  # forever. Past maxconnections concurrent clients the new connections
+  # either wait in the backlog or get rejected.
+  #-----------------------------------------------------------------------------
+  def serve( first, numClients, counters ):
+    start    = time.time()
+    threads  = []
+    failed   = 0
+    rejected = 0
+    slots    = None
+    release  = None
+    queue    = settings['admission'] == 'queue'
+    if settings['maxconnections']:
+      slots   = Semaphore( settings['maxconnections'] )
+      release = slots.release
+
+    if numClients is None:
+      numbers = itertools.count( first )
+    else:
+      numbers = xrange( first, first + numClients )
+
+    for i in numbers:
+      while True:
+        if slots and queue:
+          slots.acquire()
+        (clientSocket, address) = serverSocket.accept()
+        context = {'socket': clientSocket, 'address': address, 'number': i,
+                   'config': config, 'param': param}
+        if not slots or queue or slots.acquire( False ):
+          break
+
+        clientSocket.settimeout( 10 )
+        ct = SocketHandler( lambda c: rejectConnection( c, settings ), context )
+        ct.daemon = True
+        ct.start()
+        rejected += 1
+
+      scObj = scenario()
+      if not callable( scObj ):
+        print "[!] The scenario is not callable"
+        return 12
+
+      ct = SocketHandler( scObj, context, release )
+      threads.append( ct )
+      ct.start()
+
+      #-------------------------------------------------------------------------
+      # Forget the finished threads when serving forever
+      #-------------------------------------------------------------------------
+      if numClients is None:
+        running = []
+        for ct in threads:
+          if ct.isAlive():
+            running.append( ct )
+          elif ct.failed:
+            failed += 1
+        threads = running
+
+    #---------------------------------------------------------------------------
+    # Join the running threads
+    #---------------------------------------------------------------------------
+    for ct in threads:
+      ct.join()
+
+    counters['accepted'] = numClients
+    counters['failed']   = failed + len( [ct for ct in threads if ct.failed] )
+    counters['rejected'] = rejected
+    counters['seconds']  = round( time.time() - start, 3 )
+
+  if numWorkers > 1:
+    return runWorkers( serve, numClients, numWorkers )
+  return serve( 0, numClients, {} )
+
+#-------------------------------------------------------------------------------
+def finish( scenario ):
+  """Let an active scenario wrap up, ie. print its summary, once all of its
+  clients are done; the scenarios may define a finish classmethod"""
+  if hasattr( scenario, 'finish' ):
+    scenario.finish()
+
+#-------------------------------------------------------------------------------
+def connect( host, port, settings, context ):
+  """Connect to the server, retrying with a backoff on failure, the number
+  of retries is left in the context"""
+  from XrdImposter.RateLimit import backoff
+  delays = backoff( settings['retrydelay'], settings['maxretrydelay'],
+                    settings['retries'] )
+  context['retries'] = 0
+  while True:
+    clientSocket = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+    clientSocket.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+    try:
+      clientSocket.connect( (host, port) )
+      return clientSocket
+    except socket.error:
+      clientSocket.close()
+      delay = next( delays, None )
+      if delay is None:
+        raise
+      context['retries'] += 1
+      time.sleep( delay )
+
+#-------------------------------------------------------------------------------
+def connectedScenario( scObj, host, port, settings ):
+  """Wrap the scenario so that it connects from its own thread, a client
+  unable to connect fails alone instead of aborting the run"""
+  def run( context ):
+    try:
+      context['socket'] = connect( host, port, settings, context )
+    except socket.error, err:
+      print "[!] Client %d: socket error: %s" % (context['streamid'], err)
+      return
+    scObj( context )
+  return run
+
+#-------------------------------------------------------------------------------
+def pooledScenario( scObj, pool, host, port, user ):
+  """Wrap the scenario so that it runs on a logged in session of the pool,
+  the session goes back to the pool unless the scenario fails"""
+  def run( context ):
+    session = pool.acquire( host, port, user, context['config'] )
+    context['socket']  = session.socket
+    context['session'] = session
+    try:
+      scObj( context )
+    except:
+      pool.discard( session )
+      raise
+    pool.release( session )
+  return run
+
+#-------------------------------------------------------------------------------
+def runActive( scenario, param, overrides = {} ):
+
+  #-----------------------------------------------------------------------------
+  # Get the necessary information from the scenario description
+  #-----------------------------------------------------------------------------
+  desc = dict( scenario.getDescription() )
+  desc.update( overrides )
+
+  try:
+    hostName   = desc['hostname']
+    hostPort   = desc['port']
+    numClients = desc['clients']
+    config     = desc['config']
+  except KeyError, err:
+    print "[!] Info missing in scenario description:", err
+    return 10
+
+  try:
+    numClients = int( numClients )
+    settings   = getActiveSettings( desc, overrides )
+  except ValueError, err:
+    print "[!] Invalid connection settings:", err
+    return 14
+
+  #-----------------------------------------------------------------------------
+  # The pooled scenarios run on logged in sessions of the SessionPool instead
+  # of fresh connections, 'warm' of them are logged in before the clients
+  # start so that the run does not measure the logins
+  #-----------------------------------------------------------------------------
+  pool = None
+  if desc.get( 'pooled', False ):
+    from XrdImposter import SessionPool
+    pool = SessionPool.pool
+    user = desc.get( 'user', 'imposter' )
+    try:
+      pool.warm( hostName, hostPort, user, int( desc.get( 'warm', 0 ) ),
+                 config )
+    except ValueError, err:
+      print "[!] Invalid number of sessions to warm up:", desc['warm']
+      return 14
+    except SessionPool.SessionPoolException, err:
+      print "[!] Unable to log in the pooled sessions:", err
+      return 15
+
+  #-----------------------------------------------------------------------------
+  # All the clients share the token bucket limiting the request rate
+  #-----------------------------------------------------------------------------
+  limiter = None
+  if settings['rate']:
+    from XrdImposter.RateLimit import TokenBucket
+    limiter = TokenBucket( settings['rate'], settings['burst'] )
+
+  #-----------------------------------------------------------------------------
+  # Create the clients, 'ramp' of them a second; every client connects from
+  # its own thread so that the retries do not hold the others back
+  #-----------------------------------------------------------------------------
   threads = []
+  start   = time.time()
   for i in range( numClients ):
-    (clientSocket, address) = serverSocket.accept()
-    context = {'socket': clientSocket, 'address': address, 'number': i, 
-               'config': config, 'param': param}
-
     scObj = scenario()
     if not callable( scObj ):
       print "[!] The scenario is not callable"
       return 12
 
+    if settings['ramp']:
+      delay = start + i / settings['ramp'] - time.time()
+      if delay > 0:
+        time.sleep( delay )
+
+    context = {'streamid': i, 'clients': numClients, 'config': config,
+               'param': param}
+    if limiter:
+      context['limiter'] = limiter
+    if pool:
+      scObj = pooledScenario( scObj, pool, hostName, hostPort, user )
+    else:
+      scObj = connectedScenario( scObj, hostName, hostPort, settings )
+
     ct = SocketHandler( scObj, context )
     threads.append( ct )
     ct.start()
@@ -95,9 +538,29 @@ def runPassive( scenario, param ):
   #-----------------------------------------------------------------------------
   for ct in threads:
     ct.join()
+  finish( scenario )
+
+  contexts = [ct.context for ct in threads]
+  counters = {'connected': len( [c for c in contexts if 'socket' in c] ),
+              'retries':   sum( [c.get( 'retries', 0 ) for c in contexts] )}
+  counters['failed'] = numClients - counters['connected']
+
+  if pool:
+    print "[i] Pooled sessions: %s" % formatCounters( pool.counters )
+    pool.close()
+  elif counters['retries'] or counters['failed']:
+    print "[i] Connections: %s" % formatCounters( counters )
+  if limiter:
+    print "[i] Rate limited to %g requests/s, waited %.3fs for tokens" % \
+          (settings['rate'], limiter.waited)
+
+  if counters['failed']:
+    return 11
 
 #-------------------------------------------------------------------------------
-def runActive( scenario, param ):
+def runPassiveAsync( scenario, param, numWorkers = 1, overrides = {} ):
+  """Run a coroutine-based passive scenario in a single event loop"""
+  from XrdImposter.AsyncEngine import Engine, ReadWait, Sleep
 
   #-----------------------------------------------------------------------------
   # Get the necessary information from the scenario description
@@ -105,47 +568,165 @@ def runActive( scenario, param ):
   desc = scenario.getDescription()
 
   try:
-    hostName   = desc['hostname']
-    hostPort   = desc['port']
-    numClients = desc['clients']
+    listenIP   = desc['ip']
+    listenPort = desc['port']
     config     = desc['config']
+    settings   = getPassiveSettings( desc, overrides )
+    numClients = settings['clients']
   except KeyError, err:
     print "[!] Info missing in scenario description:", err
     return 10
+  except ValueError, err:
+    print "[!] Invalid connection settings:", err
+    return 14
 
   #-----------------------------------------------------------------------------
-  # Create the clients
+  # Listen to the incoming connections
   #-----------------------------------------------------------------------------
-  threads = []
-  for i in range( numClients ):
-    try:
-      clientSocket = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
-      clientSocket.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
-      clientSocket.connect( (hostName, hostPort) )
-    except socket.error, err:
-      print "[!] Socket error:", err
+  try:
+    serverSocket = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+    serverSocket.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+    serverSocket.bind( (listenIP, listenPort) )
+    serverSocket.listen( settings['backlog'] )
+    serverSocket.setblocking( 0 )
+  except socket.error, e:
+      print "[!] Socket error:", e
       return 11
 
-    context = {'socket': clientSocket, 'streamid': i, 'config': config,
-               'param': param}
+  #-----------------------------------------------------------------------------
+  # Accept the connections and spawn a coroutine for each of them, past
+  # maxconnections concurrent clients the new connections either wait in the
+  # backlog or get rejected
+  #-----------------------------------------------------------------------------
+  def serve( first, numClients, counters ):
+    start  = time.time()
+    engine = Engine()
+    limit  = settings['maxconnections']
+    queue  = settings['admission'] == 'queue'
+    state  = {'active': 0, 'rejected': 0}
 
-    scObj = scenario()
-    if not callable( scObj ):
-      print "[!] The scenario is not callable"
-      return 12
+    def admitted( coroutine ):
+      try:
+        yield coroutine
+      finally:
+        state['active'] -= 1
 
-    ct = SocketHandler( scObj, context )
-    threads.append( ct )
-    ct.start()
+    def acceptor():
+      i = first
+      while numClients is None or i < first + numClients:
+        if limit and queue and state['active'] >= limit:
+          yield Sleep( 0.01 )
+          continue
+        try:
+          (clientSocket, address) = serverSocket.accept()
+        except socket.error, e:
+          if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+            yield ReadWait( serverSocket )
+            continue
+          raise
+        clientSocket.setblocking( 0 )
+        context = {'socket': clientSocket, 'address': address, 'number': i,
+                   'config': config, 'param': param}
+        if limit and state['active'] >= limit:
+          state['rejected'] += 1
+          engine.spawn( rejectConnectionAsync( context, settings ),
+                        'rejected %d' % state['rejected'] )
+          continue
+        state['active'] += 1
+        engine.spawn( admitted( scenario()( context ) ), 'client %d' % i )
+        i += 1
+
+    engine.spawn( acceptor(), 'acceptor' )
+    engine.run()
+
+    counters['accepted'] = numClients
+    counters['failed']   = engine.failed
+    counters['rejected'] = state['rejected']
+    counters['seconds']  = round( time.time() - start, 3 )
+
+  if numWorkers > 1:
+    status = runWorkers( serve, numClients, numWorkers )
+  else:
+    status = serve( 0, numClients, {} )
+  serverSocket.close()
+  return status
+
+#-------------------------------------------------------------------------------
+def runActiveAsync( scenario, param, overrides = {} ):
+  """Run a coroutine-based active scenario in a single event loop, without
+  the pacing settings of runActive"""
+  from XrdImposter.AsyncEngine import Engine, WriteWait
 
   #-----------------------------------------------------------------------------
-  # Join the running threads
+  # Get the necessary information from the scenario description
   #-----------------------------------------------------------------------------
-  for ct in threads:
-    ct.join()
+  desc = dict( scenario.getDescription() )
+  if 'clients' in overrides:
+    desc['clients'] = overrides['clients']
+
+  try:
+    hostName   = desc['hostname']
+    hostPort   = desc['port']
+    numClients = desc['clients']
+    config     = desc['config']
+  except KeyError, err:
+    print "[!] Info missing in scenario description:", err
+    return 10
+
+  try:
+    numClients = int( numClients )
+    settings   = getActiveSettings( desc, overrides )
+  except ValueError, err:
+    print "[!] Invalid connection settings:", err
+    return 14
+
+  #-----------------------------------------------------------------------------
+  # The pacing of the clients is not implemented by the event loop, refuse
+  # it rather than ignore it, be it in the description or on the commandline
+  #-----------------------------------------------------------------------------
+  defaults    = getActiveSettings( {}, {} )
+  unsupported = [k for k in sorted( activeDefaults )
+                 if settings[k] != defaults[k]]
+  if unsupported:
+    print "[!] The async engine cannot apply the settings:", \
+          ', '.join( unsupported )
+    return 9
+
+  engine = Engine()
+  errors = []
+
+  #-----------------------------------------------------------------------------
+  # Connect in a non-blocking way and hand over to the scenario
+  #-----------------------------------------------------------------------------
+  def client( i ):
+    clientSocket = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+    clientSocket.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+    clientSocket.setblocking( 0 )
+    status = clientSocket.connect_ex( (hostName, hostPort) )
+    if status in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+      yield WriteWait( clientSocket )
+      status = clientSocket.getsockopt( socket.SOL_SOCKET, socket.SO_ERROR )
+    if status:
+      print "[!] Socket error:", errno.errorcode.get( status, status )
+      errors.append( status )
+      clientSocket.close()
+      return
+
+    context = {'socket': clientSocket, 'streamid': i, 'clients': numClients,
+               'config': config, 'param': param}
+    yield scenario()( context )
+
+  for i in range( numClients ):
+    engine.spawn( client( i ), 'client %d' % i )
+  engine.run()
+  finish( scenario )
+
+  if errors:
+    return 11
 
 #-------------------------------------------------------------------------------
 def main():
+  global capture
 
   #-----------------------------------------------------------------------------
   # Parse the commandline
@@ -153,15 +734,24 @@ def main():
   try:
     opts, args = getopt.getopt( sys.argv[1:], "",
                                 ["help", "scenario=", "libpath=", "log=",
-                                 "param="] )
+                                 "param=", "engine=", "workers=",
+                                 "capture=", "clients=", "backlog=",
+                                 "max-connections=", "admission=", "pooled",
+                                 "warm=", "ramp=", "rate=", "burst=",
+                                 "retries=", "retry-delay=",
+                                 "max-retry-delay="] )
   except getopt.GetoptError, err:
     print "[!] Unable to parse commandline:", err
     printHelp()
     return 2
 
-  libPath   = None
-  className = None
-  param     = None
+  libPath     = None
+  className   = None
+  param       = None
+  engine      = None
+  workers     = 1
+  capturePath = None
+  overrides   = {}
   for o, a in opts:
     if o == "--help":
       printHelp()
@@ -174,6 +764,47 @@ def main():
       pass
     elif o == "--param":
       param = a
+    elif o == "--engine":
+      if a not in ('thread', 'async'):
+        print "[!] Unknown engine:", a
+        printHelp()
+        return 2
+      engine = a
+    elif o == "--workers":
+      try:
+        workers = int( a )
+        if workers < 1:
+          raise ValueError( a )
+      except ValueError:
+        print "[!] Invalid number of workers:", a
+        printHelp()
+        return 2
+    elif o == "--capture":
+      capturePath = a
+    elif o == "--clients":
+      overrides['clients'] = a
+    elif o == "--backlog":
+      overrides['backlog'] = a
+    elif o == "--max-connections":
+      overrides['maxconnections'] = a
+    elif o == "--admission":
+      overrides['admission'] = a
+    elif o == "--pooled":
+      overrides['pooled'] = True
+    elif o == "--warm":
+      overrides['warm'] = a
+    elif o == "--ramp":
+      overrides['ramp'] = a
+    elif o == "--rate":
+      overrides['rate'] = a
+    elif o == "--burst":
+      overrides['burst'] = a
+    elif o == "--retries":
+      overrides['retries'] = a
+    elif o == "--retry-delay":
+      overrides['retrydelay'] = a
+    elif o == "--max-retry-delay":
+      overrides['maxretrydelay'] = a
     else:
       assert False, "unhandled option"
 
@@ -181,6 +812,14 @@ def main():
     print "[!] No imposter scenario has been defined"
     return 3
 
+  if capturePath:
+    from XrdImposter import Capture
+    try:
+      capture = Capture.enable( capturePath )
+    except OSError, err:
+      print "[!] Unable to open the capture file:", err
+      return 13
+
   #-----------------------------------------------------------------------------
   # Load the module and see whether we need to act on passive or active
   # scenarios
@@ -212,10 +851,30 @@ def main():
     print "[!] Scenario type is not defined"
     return 7
 
+  #-----------------------------------------------------------------------------
+  # Coroutine-based scenarios declare it in their description and can only
+  # be run by the async engine
+  #-----------------------------------------------------------------------------
+  coroutine = desc.get( 'coroutine', False )
+  if engine is None:
+    engine = 'async' if coroutine else 'thread'
+
+  if coroutine != (engine == 'async'):
+    print "[!] The %s engine cannot run this scenario" % engine
+    return 9
+
   if desc['type'] == 'Active':
-    return runActive( scenario, param )
+    if engine == 'async' and (overrides.get( 'pooled' ) or
+                              desc.get( 'pooled', False )):
+      print "[!] The async engine cannot run pooled sessions"
+      return 9
+    if engine == 'async':
+      return runActiveAsync( scenario, param, overrides )
+    return runActive( scenario, param, overrides )
   elif desc['type'] == 'Passive':
-    return runPassive( scenario, param )
+    if engine == 'async':
+      return runPassiveAsync( scenario, param, workers, overrides )
+    return runPassive( scenario, param, workers, overrides )
   else:
     print "[!] Unknown type of scenario:", desc['type']
     return 8
@@ -0,0 +1,269 @@
+#-------------------------------------------------------------------------------
+# Copyright (c) 2011-2013 by European Organization for Nuclear Research (CERN)
+# Author: Lukasz Janyst <ljanyst@cern.ch>
+#-------------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+"""
+Single-threaded event loop running generator based coroutines.
+
+A coroutine is a generator that yields one of the following:
+
+  - another generator: it is run to completion and its result is sent back
+  - ReadWait(sock)/WriteWait(sock): resumes when the socket is ready
+  - Sleep(seconds): resumes after the given time
+  - None: gives the other coroutines a chance to run
+
+and finishes either normally or by raising Return(value), ie.:
+
+  def scenario( context ):
+    server = ImposterServer( context )
+    request = yield server.receiveAsync()
+    yield server.sendAsync( server.handshake() )
+"""
+
+import sys
+import time
+import heapq
+import select
+import types
+import traceback
+import collections
+
+from Utils import setupLogger
+
+#-------------------------------------------------------------------------------
+class Return( Exception ):
+  """Raised by a coroutine to return a value to its caller"""
+  def __init__( self, value = None ):
+    Exception.__init__( self, value )
+    self.value = value
+
+#-------------------------------------------------------------------------------
+class ReadWait( object ):
+  __slots__ = ['sock']
+  def __init__( self, sock ):
+    self.sock = sock
+
+#-------------------------------------------------------------------------------
+class WriteWait( object ):
+  __slots__ = ['sock']
+  def __init__( self, sock ):
+    self.sock = sock
+
+#-------------------------------------------------------------------------------
+class Sleep( object ):
+  __slots__ = ['seconds']
+  def __init__( self, seconds ):
+    self.seconds = seconds
+
+#-------------------------------------------------------------------------------
+class Task( object ):
+  """A coroutine together with the stack of the coroutines it called"""
+
+  #-----------------------------------------------------------------------------
+  def __init__( self, coroutine, name ):
+    self.stack  = [coroutine]
+    self.name   = name
+    self.done   = False
+    self.result = None
+    self.error  = None
+
+#-------------------------------------------------------------------------------
+class Poller( object ):
+  """Thin wrapper over epoll with a fallback to poll"""
+
+  #-----------------------------------------------------------------------------
+  def __init__( self ):
+    if hasattr( select, 'epoll' ):
+      self.poller  = select.epoll()
+      self.READ    = select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP
+      self.WRITE   = select.EPOLLOUT | select.EPOLLERR | select.EPOLLHUP
+      self.scale   = 1.0
+    else:
+      self.poller  = select.poll()
+      self.READ    = select.POLLIN | select.POLLERR | select.POLLHUP
+      self.WRITE   = select.POLLOUT | select.POLLERR | select.POLLHUP
+      self.scale   = 1000.0
+    self.masks = {}
+
+  #-----------------------------------------------------------------------------
+  def update( self, fd, mask ):
+    current = self.masks.get( fd )
+    if current == mask:
+      return
+    if not mask:
+      del self.masks[fd]
+      try:
+        self.poller.unregister( fd )
+      except (IOError, OSError, KeyError, ValueError):
+        pass
+    elif current is None:
+      self.masks[fd] = mask
+      self.poller.register( fd, mask )
+    else:
+      self.masks[fd] = mask
+      self.poller.modify( fd, mask )
+
+  #-----------------------------------------------------------------------------
+  def poll( self, timeout ):
+    if timeout is None:
+      timeout = -1
+    else:
+      timeout *= self.scale
+      if self.scale != 1.0:
+        timeout = int( timeout )
+    while True:
+      try:
+        return self.poller.poll( timeout )
+      except (IOError, OSError, select.error), e:
+        if e.args[0] != 4: # EINTR
+          raise
+
+#-------------------------------------------------------------------------------
+class Engine( object ):
+  """Run coroutines until all of them have finished"""
+
+  #-----------------------------------------------------------------------------
+  def __init__( self ):
+    self.logger   = setupLogger( __name__ )
+    self.ready    = collections.deque()
+    self.readers  = {}
+    self.writers  = {}
+    self.timers   = []
+    self.sequence = 0
+    self.running  = 0
+    self.failed   = 0
+    self.poller   = Poller()
+
+  #-----------------------------------------------------------------------------
+  def spawn( self, coroutine, name = None ):
+    """Schedule a new coroutine, returns the task handle"""
+    task = Task( coroutine, name )
+    self.running += 1
+    self.ready.append( (task, None, None) )
+    return task
+
+  #-----------------------------------------------------------------------------
+  def run( self ):
+    """Run the loop until there is nothing more to do"""
+    while self.running:
+      while self.ready:
+        task, value, exc = self.ready.popleft()
+        self.step( task, value, exc )
+
+      if not self.running:
+        break
+
+      #-------------------------------------------------------------------------
+      # Wait for the sockets or the nearest timer
+      #-------------------------------------------------------------------------
+      timeout = None
+      if self.timers:
+        timeout = max( 0, self.timers[0][0] - time.time() )
+      elif not self.readers and not self.writers:
+        self.logger.error( '%d coroutines are stuck' % (self.running) )
+        break
+
+      for fd, events in self.poller.poll( timeout ):
+        if events & self.poller.READ and fd in self.readers:
+          self.ready.append( (self.readers.pop( fd ), None, None) )
+        if events & self.poller.WRITE and fd in self.writers:
+          self.ready.append( (self.writers.pop( fd ), None, None) )
+        self.updatePoller( fd )
+
+      now = time.time()
+      while self.timers and self.timers[0][0] <= now:
+        task = heapq.heappop( self.timers )[2]
+        self.ready.append( (task, None, None) )
+
+  #-----------------------------------------------------------------------------
+  def updatePoller( self, fd ):
+    mask = 0
+    if fd in self.readers:
+      mask |= self.poller.READ
+    if fd in self.writers:
+      mask |= self.poller.WRITE
+    self.poller.update( fd, mask )
+
+  #-----------------------------------------------------------------------------
+  def step( self, task, value, exc ):
+    """Advance the task until it blocks or finishes"""
+    while True:
+      gen = task.stack[-1]
+      try:
+        if exc:
+          result = gen.throw( *exc )
+        else:
+          result = gen.send( value )
+      except StopIteration:
+        value, exc = None, None
+      except Return, r:
+        value, exc = r.value, None
+      except:
+        value, exc = None, sys.exc_info()
+      else:
+        value, exc = None, None
+        #-----------------------------------------------------------------------
+        # The coroutine wants to wait for something
+        #-----------------------------------------------------------------------
+        if isinstance( result, types.GeneratorType ):
+          task.stack.append( result )
+          continue
+        elif isinstance( result, ReadWait ):
+          fd = result.sock.fileno()
+          self.readers[fd] = task
+          self.updatePoller( fd )
+          return
+        elif isinstance( result, WriteWait ):
+          fd = result.sock.fileno()
+          self.writers[fd] = task
+          self.updatePoller( fd )
+          return
+        elif isinstance( result, Sleep ):
+          self.sequence += 1
+          heapq.heappush( self.timers, (time.time() + result.seconds,
+                                        self.sequence, task) )
+          return
+        elif result is None:
+          self.ready.append( (task, None, None) )
+          return
+        else:
+          try:
+            raise TypeError( 'Coroutine yielded an unsupported object: %s' %
+                             (repr(result)) )
+          except TypeError:
+            exc = sys.exc_info()
+          continue
+
+      #-------------------------------------------------------------------------
+      # The current coroutine has finished, hand the result to the caller
+      #-------------------------------------------------------------------------
+      task.stack.pop()
+      if not task.stack:
+        self.finish( task, value, exc )
+        return
+
+  #-----------------------------------------------------------------------------
+  def finish( self, task, value, exc ):
+    task.done    = True
+    task.result  = value
+    task.error   = exc
+    self.running -= 1
+    if exc:
+      self.failed += 1
+      self.logger.error( 'Coroutine %s failed:\n%s' %
+                         (str(task.name),
+                          ''.join( traceback.format_exception( *exc ) )) )
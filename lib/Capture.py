@@ -0,0 +1,220 @@
+#-------------------------------------------------------------------------------
+# Copyright (c) 2011-2013 by European Organization for Nuclear Research (CERN)
+# Author: Lukasz Janyst <ljanyst@cern.ch>
+#-------------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+"""
+Binary capture of the messages sent and received by MessageHelper.
+
+The capture file starts with an 8 byte magic followed by the records, each
+of them a fixed size header and the raw message:
+
+  length     4 bytes  length of the message
+  connection 4 bytes  connection id, unique within the capture
+  direction  1 byte   SENT or RECEIVED, from the point of view of the imposter
+  (padding)  3 bytes
+  timestamp  8 bytes  microseconds since the epoch
+  message    length bytes
+
+All the integers are big endian. The records are buffered and appended with
+a single write of whole records, so that the processes and threads sharing
+a capture never interleave partial records. The reader maps the file and
+walks the records without loading it.
+"""
+
+import os
+import mmap
+import time
+import atexit
+import struct
+import threading
+
+from collections import namedtuple
+
+import XProtocol
+
+MAGIC        = 'XRDCAP01'
+recordStruct = struct.Struct( '>IIB3xq' )
+requestId    = struct.Struct( '>H' )
+handShake    = struct.pack( '>iiiii', 0, 0, 0, 4, 2012 )
+
+RECEIVED = 0
+SENT     = 1
+
+Record = namedtuple( 'Record', 'timestamp connection direction data' )
+
+#-------------------------------------------------------------------------------
+# The capture enabled for the whole process, ie. by imposter.py --capture
+#-------------------------------------------------------------------------------
+writer = None
+
+#-------------------------------------------------------------------------------
+class CaptureException( Exception ):
+  def __init__( self, value ):
+    self.value = value
+
+  def __str__( self ):
+    return repr( self.value )
+
+#-------------------------------------------------------------------------------
+def isRequest( message ):
+  """Tell the client requests from the server responses, the request ids
+  do not overlap with the response statuses"""
+  if message == handShake:
+    return True
+  if len( message ) < 24:
+    return False
+  request = requestId.unpack_from( message, 2 )[0]
+  return request != XProtocol.XRequestTypes.handshake and \
+         request in XProtocol.XRequestTypes.reverseMapping
+
+#-------------------------------------------------------------------------------
+class CaptureWriter( object ):
+  """Append the messages to a capture file"""
+
+  #-----------------------------------------------------------------------------
+  def __init__( self, path, bufferSize = 1048576, flushInterval = 1.0 ):
+    self.path          = path
+    self.bufferSize    = bufferSize
+    self.flushInterval = flushInterval
+    self.lock          = threading.Lock()
+    self.buffer        = bytearray()
+    self.lastFlush     = time.time()
+    self.connections   = 0
+    self.fd = os.open( path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644 )
+    if not os.fstat( self.fd ).st_size:
+      os.write( self.fd, MAGIC )
+
+  #-----------------------------------------------------------------------------
+  def newConnection( self ):
+    """Allocate a connection id, the pid makes the ids of the forked workers
+    sharing the capture distinct"""
+    self.lock.acquire()
+    try:
+      self.connections += 1
+      return ((os.getpid() & 0xffff) << 16) | (self.connections & 0xffff)
+    finally:
+      self.lock.release()
+
+  #-----------------------------------------------------------------------------
+  def record( self, connection, direction, message, timestamp = None ):
+    """Record a message, a string, a bytearray or a memoryview, with the
+    current time unless a timestamp is given"""
+    now = time.time()
+    if timestamp is None:
+      timestamp = now
+    self.lock.acquire()
+    try:
+      self.buffer += recordStruct.pack( len( message ), connection,
+                                        direction, int( timestamp * 1e6 ) )
+      self.buffer += message
+      if len( self.buffer ) >= self.bufferSize or \
+         now - self.lastFlush >= self.flushInterval:
+        self.flushLocked()
+    finally:
+      self.lock.release()
+
+  #-----------------------------------------------------------------------------
+  def flushLocked( self ):
+    view = memoryview( self.buffer )
+    while len( view ):
+      view = view[os.write( self.fd, view ):]
+    self.buffer    = bytearray()
+    self.lastFlush = time.time()
+
+  #-----------------------------------------------------------------------------
+  def flush( self ):
+    """Write the buffered records"""
+    self.lock.acquire()
+    try:
+      self.flushLocked()
+    finally:
+      self.lock.release()
+
+  #-----------------------------------------------------------------------------
+  def close( self ):
+    if self.fd is None:
+      return
+    self.flush()
+    os.close( self.fd )
+    self.fd = None
+
+#-------------------------------------------------------------------------------
+class CaptureReader( object ):
+  """Iterate over the records of a capture file"""
+
+  #-----------------------------------------------------------------------------
+  def __init__( self, path ):
+    self.path = path
+    f = open( path, 'rb' )
+    try:
+      if f.read( len( MAGIC ) ) != MAGIC:
+        raise CaptureException( '%s is not a capture file' % path )
+      size = os.fstat( f.fileno() ).st_size
+      self.map = None
+      if size > len( MAGIC ):
+        self.map = mmap.mmap( f.fileno(), size, access = mmap.ACCESS_READ )
+    finally:
+      f.close()
+
+  #-----------------------------------------------------------------------------
+  def __iter__( self ):
+    return self.records()
+
+  #-----------------------------------------------------------------------------
+  def records( self, connection = None ):
+    """Generate the records, of a single connection if given; a truncated
+    last record, ie. of a capture still being written, is ignored"""
+    if self.map is None:
+      return
+    data   = self.map
+    size   = len( data )
+    offset = len( MAGIC )
+    while offset + recordStruct.size <= size:
+      length, conn, direction, timestamp = \
+        recordStruct.unpack_from( data, offset )
+      offset += recordStruct.size
+      if offset + length > size:
+        break
+      if connection is None or conn == connection:
+        yield Record( timestamp / 1e6, conn, direction,
+                      data[offset:offset + length] )
+      offset += length
+
+  #-----------------------------------------------------------------------------
+  def connections( self ):
+    """Return the connection ids in the order of their first record"""
+    seen   = set()
+    result = []
+    for record in self.records():
+      if record.connection not in seen:
+        seen.add( record.connection )
+        result.append( record.connection )
+    return result
+
+  #-----------------------------------------------------------------------------
+  def close( self ):
+    if self.map is not None:
+      self.map.close()
+      self.map = None
+
+#-------------------------------------------------------------------------------
+def enable( path, **kwargs ):
+  """Capture the messages of all the connections of the process"""
+  global writer
+  writer = CaptureWriter( path, **kwargs )
+  atexit.register( writer.close )
+  return writer
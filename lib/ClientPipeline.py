@@ -0,0 +1,245 @@
+#-------------------------------------------------------------------------------
+# Copyright (c) 2011-2013 by European Organization for Nuclear Research (CERN)
+# Author: Lukasz Janyst <ljanyst@cern.ch>
+#-------------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+"""
+Pipelined request submission over a single client connection.
+
+Every request gets its own stream id and a ResponseFuture, up to 'depth'
+requests are kept in flight and the responses are demultiplexed back to the
+futures by their stream id, ie.:
+
+  client   = ImposterClient( context )
+  client.do_full_handshake()
+  pipeline = client.pipeline( depth = 32 )
+  futures  = [pipeline.submit( 'kXR_stat', path='/tmp' ) for i in range(1000)]
+  for future in futures:
+    print future.result()
+
+kXR_oksofar partial responses are accumulated in the future until the final
+response arrives, kXR_waitresp keeps the request in flight until the real
+response comes as kXR_attn/kXR_asynresp. Other kXR_attn messages concern
+the whole connection and are handed to the attention callback.
+"""
+
+import struct
+import collections
+
+import XProtocol
+
+from AsyncEngine import Return
+from MessageHelper import MessageException
+from Utils import setupLogger
+
+headerStruct = struct.Struct( '>HHl' )
+actnumStruct = struct.Struct( '>l' )
+
+#-------------------------------------------------------------------------------
+class PipelineException( Exception ):
+  def __init__( self, value ):
+    self.value = value
+
+  def __str__( self ):
+    return repr( self.value )
+
+#-------------------------------------------------------------------------------
+class ResponseFuture( object ):
+  """Outcome of a single pipelined request"""
+
+  #-----------------------------------------------------------------------------
+  def __init__( self, pipeline, streamid, request ):
+    self.pipeline = pipeline
+    self.streamid = streamid
+    self.request  = request
+    self.partials = []
+    self.raw      = None
+    self.done     = False
+    self.waiting  = False
+    self.callbacks = []
+
+  #-----------------------------------------------------------------------------
+  def addCallback( self, callback ):
+    """Call the callback with the future once it is done"""
+    if self.done:
+      callback( self )
+    else:
+      self.callbacks.append( callback )
+
+  #-----------------------------------------------------------------------------
+  def complete( self, raw ):
+    self.raw  = raw
+    self.done = True
+    for callback in self.callbacks:
+      callback( self )
+    self.callbacks = []
+
+  #-----------------------------------------------------------------------------
+  def status( self ):
+    """Status of the final response"""
+    return headerStruct.unpack_from( self.raw )[1]
+
+  #-----------------------------------------------------------------------------
+  def data( self ):
+    """Payload of the kXR_oksofar partials followed by the one of the final
+    response"""
+    return ''.join( [p[8:] for p in self.partials] ) + self.raw[8:]
+
+  #-----------------------------------------------------------------------------
+  def wait( self ):
+    """Process the incoming responses until this one is done, return the raw
+    final response"""
+    while not self.done:
+      self.pipeline.poll()
+    return self.raw
+
+  #-----------------------------------------------------------------------------
+  def result( self ):
+    """Wait for the final response and return it unpacked"""
+    return self.pipeline.client.unpack( self.wait(), self.request )
+
+  #-----------------------------------------------------------------------------
+  def waitAsync( self ):
+    """Coroutine variant of wait"""
+    while not self.done:
+      yield self.pipeline.pollAsync()
+    raise Return( self.raw )
+
+#-------------------------------------------------------------------------------
+class Pipeline( object ):
+  """Keep up to 'depth' requests in flight on the connection of a client"""
+
+  #-----------------------------------------------------------------------------
+  def __init__( self, client, depth = 16, onAttn = None ):
+    if depth < 1 or depth > 65535:
+      raise PipelineException( 'Invalid pipeline depth: %d' % depth )
+    self.logger      = setupLogger( __name__ )
+    self.client      = client
+    self.depth       = depth
+    self.onAttn      = onAttn
+    self.freeIds     = collections.deque( xrange( 1, depth + 1 ) )
+    self.outstanding = {}
+    self.attn        = []
+    self.counters    = { 'submitted': 0, 'completed': 0, 'partials': 0,
+                         'attn': 0 }
+
+  #-----------------------------------------------------------------------------
+  def __len__( self ):
+    return len( self.outstanding )
+
+  #-----------------------------------------------------------------------------
+  def prepare( self, name, kwargs ):
+    """Allocate a stream id and build the request with it"""
+    if name in ('handshake', 'kXR_auth'):
+      raise PipelineException( 'Cannot pipeline ' + name )
+    streamid = self.freeIds.popleft()
+    request = getattr( self.client, name )( streamid = streamid, **kwargs )
+    future  = ResponseFuture( self, streamid, request )
+    self.outstanding[streamid] = future
+    self.counters['submitted'] += 1
+    return future
+
+  #-----------------------------------------------------------------------------
+  def submit( self, name, **kwargs ):
+    """Build the request using the client builder of the given name and
+    queue it, processing responses first if the pipeline is full. The queued
+    requests are sent together when waiting for responses or by flush."""
+    while not self.freeIds:
+      self.poll()
+    future = self.prepare( name, kwargs )
+    self.client.queue( future.request )
+    return future
+
+  #-----------------------------------------------------------------------------
+  def flush( self ):
+    """Send the queued requests"""
+    self.client.flush()
+
+  #-----------------------------------------------------------------------------
+  def poll( self ):
+    """Send the queued requests, receive a single response and dispatch it"""
+    self.client.flush()
+    if not self.outstanding:
+      raise PipelineException( 'No requests in flight' )
+    self.dispatch( self.client.receive() )
+
+  #-----------------------------------------------------------------------------
+  def drain( self ):
+    """Wait for all the requests in flight"""
+    while self.outstanding:
+      self.poll()
+
+  #-----------------------------------------------------------------------------
+  def submitAsync( self, name, **kwargs ):
+    """Coroutine variant of submit"""
+    while not self.freeIds:
+      yield self.pollAsync()
+    future = self.prepare( name, kwargs )
+    self.client.queue( future.request )
+    raise Return( future )
+
+  #-----------------------------------------------------------------------------
+  def pollAsync( self ):
+    """Coroutine variant of poll"""
+    yield self.client.mh.flushAsync()
+    if not self.outstanding:
+      raise PipelineException( 'No requests in flight' )
+    response = yield self.client.receiveAsync()
+    self.dispatch( response )
+
+  #-----------------------------------------------------------------------------
+  def drainAsync( self ):
+    """Coroutine variant of drain"""
+    while self.outstanding:
+      yield self.pollAsync()
+
+  #-----------------------------------------------------------------------------
+  def dispatch( self, raw ):
+    """Hand a raw response to the future it belongs to"""
+    if len( raw ) < 8:
+      raise MessageException( 'Response too short: %d' % len( raw ) )
+    streamid, status, dlen = headerStruct.unpack_from( raw )
+
+    #---------------------------------------------------------------------------
+    # Attention: either an asynchronous response embedding the real one
+    # after the action code and 4 reserved bytes, or something concerning
+    # the whole connection
+    #---------------------------------------------------------------------------
+    if status == XProtocol.XResponseType.kXR_attn:
+      actnum = actnumStruct.unpack_from( raw, 8 )[0]
+      if actnum == XProtocol.XActionCode.kXR_asynresp and len( raw ) >= 24:
+        return self.dispatch( raw[16:] )
+      self.logger.info( 'Received attention, action code: %d' % actnum )
+      self.counters['attn'] += 1
+      self.attn.append( raw )
+      if self.onAttn:
+        self.onAttn( raw )
+      return
+
+    future = self.outstanding.get( streamid )
+    if future is None:
+      raise MessageException( 'Response for unknown stream id: %d' % streamid )
+
+    if status == XProtocol.XResponseType.kXR_oksofar:
+      self.counters['partials'] += 1
+      future.partials.append( raw )
+    elif status == XProtocol.XResponseType.kXR_waitresp:
+      future.waiting = True
+    else:
+      del self.outstanding[streamid]
+      self.freeIds.append( streamid )
+      self.counters['completed'] += 1
+      future.complete( raw )
@@ -0,0 +1,667 @@
+#-------------------------------------------------------------------------------
+# Copyright (c) 2012-2013 by European Organization for Nuclear Research (CERN)
+# Author: Justin Salmon <jsalmon@cern.ch>
+#-------------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+"""
+Run a fuzz campaign over a pool of worker processes.
+
+Every worker gets a shard of the campaign and its own connections to the
+target, the outcome of each case is one of:
+
+    - ok:     the peer answered
+    - closed: the peer closed the connection but is still accepting new ones
+    - hang:   the peer did not react within the timeout
+    - crash:  the peer closed the connection and refuses new ones
+    - down:   the peer could not be reached before sending the case
+
+The per-worker logs are merged by case index into a single log with one
+tab separated line per case: index, outcome, detail, milliseconds and the
+hex dump of the exact bytes sent.
+
+The cases crashing the target may be minimised: the fields of the mutant
+are reverted to their valid values as long as the crash reproduces, and
+the result is written as a standalone scenario, ie. FuzzCrash1234.py, to
+be run with:
+
+    imposter.py --libpath=<directory> --scenario=FuzzCrash1234
+"""
+
+import os
+import time
+import errno
+import heapq
+import pickle
+import socket
+import struct
+import binascii
+
+from XrdImposter.ImposterClient import ImposterClient
+from XrdImposter.ImposterServer import ImposterServer
+from XrdImposter.MessageHelper import MessageException
+from XrdImposter.Utils import setupLogger
+
+OUTCOMES = ('ok', 'closed', 'hang', 'crash', 'down')
+
+dlen_struct = struct.Struct('>L')
+
+
+class TargetDown(Exception):
+    pass
+
+
+class RequestTarget(object):
+    """Deliver fuzzed requests to a server with an ImposterClient, the
+    optional prepare callable gets the client of every new connection, ie.
+    to log in before the fuzzed requests are sent. A dying server may still
+    accept connections for a moment, so whether it is alive is checked
+    grace seconds after it closed the connection."""
+
+    def __init__(self, hostname, port, prepare=None, timeout=5.0, grace=0.2):
+        self.hostname = hostname
+        self.port = port
+        self.prepare = prepare
+        self.timeout = timeout
+        self.grace = grace
+        self.client = None
+        self.streamid = 1
+        # Messages sent by prepare on the last connection
+        self.preamble = []
+
+    def connect(self):
+        try:
+            sock = socket.create_connection((self.hostname, self.port),
+                                            self.timeout)
+        except socket.error, e:
+            raise TargetDown(str(e))
+        sock.settimeout(self.timeout)
+        self.client = ImposterClient({'socket': sock,
+                                      'streamid': self.streamid,
+                                      'config': '', 'param': None})
+        if self.prepare:
+            try:
+                self.record_preamble()
+            except MessageException, e:
+                self.reset()
+                raise TargetDown('Preparing the connection failed: %s' % e)
+
+    def record_preamble(self):
+        """Run prepare, recording what it sends for the reproducers"""
+        preamble = []
+        send = self.client.send
+
+        def record(message):
+            preamble.append(message)
+            send(message)
+
+        self.client.send = record
+        try:
+            self.prepare(self.client)
+        finally:
+            del self.client.send
+        self.preamble = preamble
+
+    def reset(self):
+        if self.client:
+            self.client.context['socket'].close()
+            self.client = None
+
+    def alive(self):
+        """Check if the server still accepts connections"""
+        try:
+            socket.create_connection((self.hostname, self.port),
+                                     self.timeout).close()
+            return True
+        except socket.error:
+            return False
+
+    def deliver(self, mutant):
+        """Send the mutant, return the outcome and the response status"""
+        if self.client is None:
+            self.connect()
+        try:
+            self.client.send(mutant)
+            response = self.client.receive()
+        except MessageException, e:
+            self.reset()
+            if 'timed out' in str(e):
+                return 'hang', None
+            time.sleep(self.grace)
+            if self.alive():
+                return 'closed', None
+            return 'crash', None
+        return 'ok', self.client.mh.unpack('>H', response[2:4])[0]
+
+    def reproducer(self, name, message, comment):
+        """Return the source of a scenario sending the message"""
+        return REQUEST_REPRODUCER % {
+            'comment': comment, 'name': name, 'hostname': self.hostname,
+            'port': self.port,
+            'preamble': '[%s\n]' % ''.join(['\n    %s,' % hex_literal(m, 4)
+                                          for m in self.preamble]),
+            'message': hex_literal(message, 10)}
+
+
+class ResponseTarget(object):
+    """Deliver fuzzed responses to the clients connecting to the listening
+    socket with an ImposterServer: the requests are answered with defaults
+    until one of the given type comes, which gets the mutant. The reaction
+    is the next request of the client."""
+
+    def __init__(self, listen_socket, request_type, timeout=5.0):
+        self.listen_socket = listen_socket
+        self.request_type = request_type
+        self.timeout = timeout
+        self.server = None
+        self.requests = None
+        self.pending = None
+
+    def connect(self):
+        self.listen_socket.settimeout(self.timeout)
+        try:
+            sock, address = self.listen_socket.accept()
+        except socket.error, e:
+            raise TargetDown(str(e))
+        sock.settimeout(self.timeout)
+        self.server = ImposterServer({'socket': sock, 'streamid': 0,
+                                      'config': '', 'param': None})
+        self.requests = self.server.receive()
+
+    def reset(self):
+        if self.server:
+            self.server.close()
+            self.server = None
+            self.pending = None
+
+    def alive(self):
+        """The peers are the ones connecting, there is no way to tell"""
+        return True
+
+    def answer(self, request):
+        """Answer a request that is not fuzzed"""
+        server = self.server
+        if request.type == 'handshake':
+            server.send(server.handshake())
+        elif request.type == 'kXR_protocol':
+            server.send(server.kXR_protocol(streamid=request.streamid))
+        elif request.type == 'kXR_login':
+            server.send(server.kXR_login(streamid=request.streamid))
+        else:
+            server.send(server.kXR_ok(streamid=request.streamid))
+
+    def deliver(self, mutant):
+        """Send the mutant as the response to the next request of the
+        fuzzed type, return the outcome and the type of the request that
+        followed"""
+        try:
+            while True:
+                if self.server is None:
+                    self.connect()
+                request = self.pending or next(self.requests, None)
+                self.pending = None
+                if request is None:
+                    self.reset()
+                elif request.type == self.request_type:
+                    break
+                else:
+                    self.answer(request)
+        except MessageException:
+            self.reset()
+            raise TargetDown('Connection lost before the fuzzed request')
+
+        try:
+            self.server.send(mutant)
+            self.pending = next(self.requests, None)
+        except MessageException, e:
+            self.reset()
+            if 'timed out' in str(e):
+                return 'hang', None
+            return 'closed', None
+        if self.pending is None:
+            self.reset()
+            return 'closed', None
+        return 'ok', self.pending.type
+
+    def reproducer(self, name, message, comment):
+        """Return the source of a scenario sending the message"""
+        return RESPONSE_REPRODUCER % {
+            'comment': comment, 'name': name,
+            'port': self.listen_socket.getsockname()[1],
+            'request_type': self.request_type,
+            'message': hex_literal(message, 10)}
+
+
+class Minimizer(object):
+    """Shrink a mutant to the fewest fields differing from the valid packet
+    that still make the target react the same way. The fields of the
+    mutation plan, and dlen, are the units of a delta debugging search:
+    reverted fields take their valid value back and dlen follows the length
+    of the variable fields unless it is one of the mutated units.
+
+    The target has to come back after every crash, ie. restarted by its
+    supervisor, each attempt waits for it for up to restart seconds."""
+
+    def __init__(self, target, packet, plan, restart=30.0, poll=0.5):
+        self.target = target
+        self.packet = packet
+        self.plan = plan
+        self.restart = restart
+        self.poll = poll
+        self.tries = 0
+        self.logger = setupLogger(__name__)
+
+        # (name, start, end) of the units in the valid packet
+        self.units = [(name, start, end)
+                      for name, type, start, end in plan.fields]
+        if plan.length:
+            self.units.append(('dlen',) + plan.length)
+        self.units.sort(key=lambda unit: unit[1])
+
+    def spans(self, mutant):
+        """Return the (start, end) of the units in the mutant, None if they
+        cannot be told apart"""
+        delta = len(mutant) - len(self.packet)
+        if not delta:
+            return [(start, end) for name, start, end in self.units]
+        variable = [unit for unit in self.units
+                    if unit[0] in self.plan.variable]
+        if len(variable) != 1:
+            return None
+        shift = 0
+        spans = []
+        for name, start, end in self.units:
+            if name == variable[0][0]:
+                spans.append((start, end + delta))
+                shift = delta
+            else:
+                spans.append((start + shift, end + shift))
+        return spans
+
+    def build(self, mutant, spans, keep):
+        """Return the valid packet with the units in keep taken from the
+        mutant"""
+        parts = []
+        pos = 0
+        for i, (name, start, end) in enumerate(self.units):
+            parts.append(self.packet[pos:start])
+            if i in keep:
+                parts.append(mutant[spans[i][0]:spans[i][1]])
+            else:
+                parts.append(self.packet[start:end])
+            pos = end
+        parts.append(self.packet[pos:])
+        candidate = ''.join(parts)
+        return self.fix_length(candidate, keep)
+
+    def fix_length(self, candidate, keep=()):
+        """Make dlen match the length of the candidate, unless kept"""
+        if not self.plan.length:
+            return candidate
+        start, end = self.plan.length
+        if [i for i in keep if self.units[i][0] == 'dlen']:
+            return candidate
+        dlen = dlen_struct.unpack_from(self.packet, start)[0]
+        dlen += len(candidate) - len(self.packet)
+        return candidate[:start] + dlen_struct.pack(dlen & 0xffffffff) + \
+               candidate[end:]
+
+    def wait_alive(self):
+        deadline = time.time() + self.restart
+        while not self.target.alive():
+            if time.time() >= deadline:
+                raise TargetDown('Target did not come back')
+            time.sleep(self.poll)
+
+    def reproduces(self, candidate, outcome):
+        """Check if the candidate makes the target react with the outcome"""
+        self.tries += 1
+        self.wait_alive()
+        self.target.reset()
+        try:
+            result = self.target.deliver(candidate)[0]
+        except TargetDown:
+            result = 'down'
+        self.target.reset()
+        return result == outcome
+
+    def minimize(self, mutant, outcome='crash'):
+        """Return the minimised mutant, the names of the fields it still
+        has mutated and whether the outcome could be reproduced at all"""
+        spans = self.spans(mutant)
+        if spans is None or not self.reproduces(mutant, outcome):
+            return mutant, None, False
+
+        # dlen counts as mutated only if it does not match the length of
+        # the mutant
+        consistent = self.fix_length(mutant)
+        changed = []
+        for i, (name, start, end) in enumerate(self.units):
+            if name == 'dlen':
+                valid = consistent[start:end]
+            else:
+                valid = self.packet[start:end]
+            if mutant[spans[i][0]:spans[i][1]] != valid:
+                changed.append(i)
+
+        results = {}
+
+        def test(keep):
+            key = tuple(keep)
+            if key not in results:
+                results[key] = self.reproduces(self.build(mutant, spans, keep),
+                                               outcome)
+            return results[key]
+
+        keep = ddmin(changed, test)
+        names = [self.units[i][0] for i in keep]
+        self.logger.info('Minimised to %s in %d tries' % (names, self.tries))
+        return self.build(mutant, spans, keep), names, True
+
+
+def ddmin(items, test):
+    """Delta debugging: return a 1-minimal subset of the items passing the
+    test, the whole list being assumed to pass it"""
+    if not items:
+        return items
+    if test([]):
+        return []
+    granularity = 2
+    while len(items) >= 2:
+        size = len(items) / granularity
+        chunks = [items[i:i + size] for i in range(0, len(items), size)]
+        reduced = False
+        for chunk in chunks:
+            if test(chunk):
+                items, granularity, reduced = chunk, 2, True
+                break
+        if not reduced:
+            for chunk in chunks:
+                complement = [i for i in items if i not in chunk]
+                if test(complement):
+                    items = complement
+                    granularity = max(granularity - 1, 2)
+                    reduced = True
+                    break
+        if not reduced:
+            if granularity >= len(items):
+                break
+            granularity = min(len(items), granularity * 2)
+    return items
+
+
+class Executor(object):
+    """Split a campaign between worker processes, each of them delivering
+    its shard to its own instance of the target. If a reproducers directory
+    is given, the crashing cases are minimised and written there."""
+
+    def __init__(self, campaign, target, workers=2, log='fuzz.log',
+                 max_down=10, retry=1.0, reproducers=None, restart=30.0):
+        self.campaign = campaign
+        self.target = target
+        self.workers = workers
+        self.log = log
+        self.max_down = max_down
+        self.retry = retry
+        self.reproducers = reproducers
+        self.restart = restart
+        self.logger = setupLogger(__name__)
+
+    def work(self, campaign, number):
+        """Run a shard in the current process, return the outcome counts"""
+        counts = dict([(outcome, 0) for outcome in OUTCOMES])
+        target = self.target
+        log = self.open_log(campaign, number)
+        down = 0
+        try:
+            for index, mutant in campaign:
+                start = time.time()
+                try:
+                    outcome, detail = target.deliver(mutant)
+                    down = 0
+                except TargetDown, e:
+                    outcome, detail = 'down', str(e)
+                    down += 1
+                elapsed = (time.time() - start) * 1000
+                counts[outcome] += 1
+
+                log.write('%d\t%s\t%s\t%.3f\t%s\n' %
+                          (index, outcome, detail, elapsed,
+                           binascii.hexlify(mutant)))
+                if outcome != 'ok':
+                    log.flush()
+                if outcome == 'crash' and self.reproducers:
+                    self.reproduce(campaign, index, mutant)
+                if outcome == 'down':
+                    if down >= self.max_down:
+                        self.logger.error('Worker %d: target down, giving up'
+                                          % number)
+                        break
+                    time.sleep(self.retry)
+        finally:
+            log.close()
+            target.reset()
+        return counts
+
+    def reproduce(self, campaign, index, mutant):
+        """Minimise a crashing case and write its reproducer scenario,
+        return the path of the scenario"""
+        minimizer = Minimizer(self.target, campaign.packet, campaign.plan,
+                              self.restart)
+        try:
+            message, fields, reproduced = minimizer.minimize(mutant)
+        except TargetDown, e:
+            self.logger.error('Case %d: %s' % (index, e))
+            message, fields, reproduced = mutant, None, False
+
+        comment = 'Case %d of the fuzz campaign with seed %d' % \
+                  (index, campaign.fuzzer.seed)
+        if not reproduced:
+            comment += ', the crash did not reproduce, sent as is'
+        else:
+            comment += ', minimised in %d tries, mutated fields: %s' % \
+                       (minimizer.tries, ', '.join(fields) or 'none')
+
+        name = 'FuzzCrash%d' % index
+        if not os.path.isdir(self.reproducers):
+            try:
+                os.makedirs(self.reproducers)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        path = os.path.join(self.reproducers, name + '.py')
+        f = open(path, 'w')
+        try:
+            f.write(self.target.reproducer(name, message, comment))
+        finally:
+            f.close()
+        self.logger.info('Case %d: reproducer written to %s' % (index, path))
+        return path
+
+    def open_log(self, campaign, number):
+        """Open the log of a worker, a resumed shard keeps the lines of the
+        cases preceding the resume point only"""
+        name = '%s.%d' % (self.log, number)
+        if not campaign.checkpoint or not os.path.exists(name):
+            return open(name, 'w')
+        f = open(name)
+        try:
+            lines = [line for line in f
+                     if int(line.split('\t', 1)[0]) < campaign.next]
+        finally:
+            f.close()
+        log = open(name, 'w')
+        log.writelines(lines)
+        return log
+
+    def run(self):
+        """Run the campaign, return the outcome counts of all the workers"""
+        start = time.time()
+        workers = []
+        for number in range(self.workers):
+            shard = self.campaign.shard(self.workers, number)
+            (read_fd, write_fd) = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(read_fd)
+                status = 0
+                try:
+                    try:
+                        counts = self.work(shard, number)
+                    except:
+                        self.logger.exception('Worker %d failed' % number)
+                        counts = {}
+                        status = 1
+                    os.write(write_fd, pickle.dumps(counts))
+                finally:
+                    os._exit(status)
+            os.close(write_fd)
+            workers.append((pid, read_fd))
+
+        totals = dict([(outcome, 0) for outcome in OUTCOMES])
+        failed = 0
+        for pid, read_fd in workers:
+            data = ''
+            while True:
+                chunk = os.read(read_fd, 4096)
+                if not chunk:
+                    break
+                data += chunk
+            os.close(read_fd)
+            while True:
+                try:
+                    status = os.waitpid(pid, 0)[1]
+                    break
+                except OSError, e:
+                    if e.errno != errno.EINTR:
+                        raise
+            if status or not data:
+                failed += 1
+                continue
+            for outcome, count in pickle.loads(data).iteritems():
+                totals[outcome] += count
+
+        self.merge()
+        totals['failed_workers'] = failed
+        totals['seconds'] = round(time.time() - start, 3)
+        return totals
+
+    def merge(self):
+        """Merge the worker logs into a single one ordered by case index"""
+        logs = []
+        for number in range(self.workers):
+            name = '%s.%d' % (self.log, number)
+            if os.path.exists(name):
+                logs.append(open(name))
+        try:
+            keyed = [((int(line.split('\t', 1)[0]), line) for line in f)
+                     for f in logs]
+            out = open(self.log + '.tmp', 'w')
+            try:
+                for index, line in heapq.merge(*keyed):
+                    out.write(line)
+            finally:
+                out.close()
+            os.rename(self.log + '.tmp', self.log)
+        finally:
+            for f in logs:
+                f.close()
+
+
+def hex_literal(data, indent):
+    """Format the hex dump of the data as a Python string literal split
+    into lines"""
+    dump = binascii.hexlify(data)
+    lines = ["'%s'" % dump[i:i + 64] for i in range(0, len(dump), 64)]
+    if len(lines) < 2:
+        return lines and lines[0] or "''"
+    return '(' + ('\n' + ' ' * (indent + 1)).join(lines) + ')'
+
+
+REQUEST_REPRODUCER = '''"""
+%(comment)s
+"""
+
+import binascii
+
+from XrdImposter.ImposterClient import ImposterClient
+from XrdImposter.MessageHelper import MessageException
+
+
+class %(name)s:
+    @classmethod
+    def getDescription(cls):
+        return {'type': 'Active', 'hostname': %(hostname)r, 'port': %(port)d,
+                'clients': 1, 'config': ''}
+
+    def __call__(self, context):
+        client = ImposterClient(context)
+        for message in PREAMBLE:
+            client.send(binascii.unhexlify(message))
+            client.receive()
+
+        print '[i] Sending the fuzzed request'
+        client.send(binascii.unhexlify(MESSAGE))
+        try:
+            response = client.receive()
+        except MessageException, e:
+            print '[!] No response:', e
+            return
+        print '[i] Response:', repr(response)
+
+
+PREAMBLE = %(preamble)s
+
+MESSAGE = %(message)s
+'''
+
+RESPONSE_REPRODUCER = '''"""
+%(comment)s
+"""
+
+import binascii
+
+from XrdImposter.ImposterServer import ImposterServer
+from XrdImposter.MessageHelper import MessageException
+
+
+class %(name)s:
+    @classmethod
+    def getDescription(cls):
+        return {'type': 'Passive', 'ip': '0.0.0.0', 'port': %(port)d,
+                'clients': 1, 'config': ''}
+
+    def __call__(self, context):
+        server = ImposterServer(context)
+        try:
+            for request in server.receive():
+                if request.type == 'handshake':
+                    server.send(server.handshake())
+                elif request.type == 'kXR_protocol':
+                    server.send(server.kXR_protocol(streamid=request.streamid))
+                elif request.type == 'kXR_login':
+                    server.send(server.kXR_login(streamid=request.streamid))
+                elif request.type == %(request_type)r:
+                    print '[i] Sending the fuzzed response'
+                    server.send(binascii.unhexlify(MESSAGE))
+                else:
+                    server.send(server.kXR_ok(streamid=request.streamid))
+        except MessageException, e:
+            print '[!] Connection lost:', e
+        server.close()
+
+
+MESSAGE = %(message)s
+'''
@@ -17,11 +17,280 @@
 #-------------------------------------------------------------------------------
 
 import os
+import json
+import math
 import random
-import sys
+import struct
+import hashlib
+import binascii
+import itertools
+import threading
+
+from collections import namedtuple
 
 from XrdImposter.MessageHelper import MessageHelper
-from XrdImposter.Utils import get_struct
+from XrdImposter.MessageCodec import getCodec
+from XrdImposter.Utils import setupLogger
+
+# Number of mutants generated from a single bulk random buffer
+BATCH_SIZE = 256
+
+request_id_struct = struct.Struct('>H')
+dlen_struct = struct.Struct('>L')
+
+
+class FuzzerException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class MutationPlan(object):
+    """Byte ranges of the fuzzable fields of a message layout, computed once
+    from XProtocol so that mutating a message is a matter of overwriting
+    the ranges of a copy of it"""
+
+    def __init__(self, fields, length=None, variable=()):
+        # (name, type, start, end) of the fuzzable fields
+        self.fields = fields
+
+        # (start, end) of the dlen field and names of the fields it covers
+        self.length = length
+        self.variable = variable
+
+        # Adjacent fields are merged into a single span
+        spans = []
+        for name, type, start, end in fields:
+            if spans and spans[-1][1] == start:
+                spans[-1] = (spans[-1][0], end)
+            elif end > start:
+                spans.append((start, end))
+        self.spans = tuple(spans)
+        self.width = sum([end - start for start, end in spans])
+
+
+_plans = {}
+
+def get_plan(codec, lengths=(), payload=0):
+    """Return the mutation plan of a codec for the given variable field
+    lengths, a payload not covered by the codec is appended as a fuzzable
+    string"""
+    key = (codec, lengths, payload)
+    plan = _plans.get(key)
+    if plan is not None:
+        return plan
+
+    fields = []
+    length = None
+    variable = []
+    for field, (start, end) in zip(codec.fields, codec.fieldSpans(lengths)):
+        if field['name'] == 'dlen' and length is None:
+            length = (start, end)
+        if field.get('fuzzable'):
+            fields.append((field['name'], field['type'], start, end))
+            if field.get('size') == 'dlen':
+                variable.append(field['name'])
+    if payload:
+        start = codec.size(lengths)
+        fields.append(('data', 's', start, start + payload))
+        variable.append('data')
+
+    if len(_plans) >= 4096:
+        _plans.clear()
+    plan = MutationPlan(fields, length, tuple(variable))
+    _plans[key] = plan
+    return plan
+
+
+def integer_vectors(size):
+    """Return the boundary values of an integer of the given byte width,
+    packed big endian: 0, 1, the signed maximum and maximum + 1 (the signed
+    minimum), the unsigned maximum (-1) and maximum - 1, and the 16 and 32
+    bit overflow points that fit"""
+    bits = size * 8
+    values = [0, 1, 2 ** (bits - 1) - 1, 2 ** (bits - 1), 2 ** bits - 2,
+              2 ** bits - 1]
+    values += [v for v in (0x10000, 0x100000000) if v < 2 ** (bits - 1)]
+    return unique([binascii.unhexlify('%0*x' % (size * 2, v))
+                   for v in values])
+
+
+def unique(values):
+    """Drop the duplicates, keeping the order"""
+    seen = set()
+    result = []
+    for value in values:
+        if value not in seen:
+            seen.add(value)
+            result.append(value)
+    return tuple(result)
+
+
+# Known dangerous values of the fixed size XProtocol field types
+FUZZ_VECTORS = {
+    'c': integer_vectors(1),
+    'B': integer_vectors(1),
+    'H': integer_vectors(2),
+    'l': integer_vectors(4),
+    'q': integer_vectors(8),
+}
+
+# Known dangerous contents of the variable size strings (paths, tokens,
+# payloads), besides the empty one and the valid one with an embedded NUL
+STRING_VECTORS = (
+    '/' + 'A' * 4095,
+    '/' + 'A' * 65535,
+    '/'.join(['..'] * 2048) + '/etc/passwd',
+    '%s%n' * 256,
+    '\xff' * 1024,
+)
+
+# Values of the dlen field, either relative to the actual length of the
+# fields it covers or absolute; a length pointing past the buffer makes the
+# peer wait for, or read, data that never comes
+LENGTH_VECTORS = (
+    ('relative', 0),
+    ('relative', -1),
+    ('relative', 1),
+    ('relative', 0x10000),
+    ('absolute', 0),
+    ('absolute', 0x7fffffff),
+    ('absolute', -1),
+)
+
+
+def field_vectors(type, value, variable=False):
+    """Return the fuzz vectors of a field holding the given valid value"""
+    size = len(value)
+    middle = size / 2
+    if variable:
+        return unique([value, '', value[:middle] + '\x00' + value[middle:],
+                       value + '\x00' + 'A' * 8] + list(STRING_VECTORS))
+    if type in FUZZ_VECTORS and size == len(FUZZ_VECTORS[type][0]):
+        return FUZZ_VECTORS[type]
+    if type != 's':
+        return integer_vectors(size)
+    if not size:
+        return ('',)
+    return unique([value, '\x00' * size, '\xff' * size, 'A' * size,
+                   ('%n' * size)[:size], ('../' * size)[:size],
+                   value[:middle] + '\x00' + value[middle + 1:]])
+
+
+class VectorSpace(object):
+    """All the combinations of the fuzz vectors of the fuzzable fields of a
+    packet, and of the dlen field if the layout has one. The combinations
+    are enumerated lazily in a fixed order, so that arbitrarily large spaces
+    can be walked with flat memory and any case can be rebuilt from its
+    index.
+
+    Variable size fields may change their length, the dlen field follows
+    unless it is fuzzed itself."""
+
+    def __init__(self, packet, plan, fields=None, lengths=True):
+        self.packet = packet
+        self.plan = plan
+
+        # (start, end, vectors) of every dimension, the dlen one has no span
+        self.dimensions = []
+        for name, type, start, end in plan.fields:
+            if fields is not None and name not in fields:
+                continue
+            vectors = field_vectors(type, packet[start:end],
+                                    name in plan.variable)
+            self.dimensions.append((start, end, vectors))
+        if lengths and plan.length:
+            self.dimensions.append((None, None, LENGTH_VECTORS))
+        self.sizes = [len(vectors) for start, end, vectors in self.dimensions]
+
+    def __len__(self):
+        return reduce(lambda a, b: a * b, self.sizes, 1)
+
+    def __iter__(self):
+        return itertools.imap(self.build, itertools.product(
+            *[vectors for start, end, vectors in self.dimensions]))
+
+    def build(self, choice):
+        """Return the mutant with the given vector in every dimension"""
+        packet = self.packet
+        parts = []
+        pos = 0
+        delta = 0
+        length = ('relative', 0)
+        for (start, end, vectors), value in zip(self.dimensions, choice):
+            if start is None:
+                length = value
+                continue
+            parts.append(packet[pos:start])
+            parts.append(value)
+            pos = end
+            delta += len(value) - (end - start)
+        parts.append(packet[pos:])
+
+        if self.plan.length and (delta or length != ('relative', 0)):
+            start, end = self.plan.length
+            dlen = dlen_struct.unpack_from(packet, start)[0]
+            kind, value = length
+            if kind == 'relative':
+                value += dlen + delta
+            dlen = dlen_struct.pack(value & 0xffffffff)
+            # The dlen field precedes the variable fields, so it has not
+            # moved
+            mutant = ''.join(parts)
+            return mutant[:start] + dlen + mutant[end:]
+        return ''.join(parts)
+
+    def case(self, index):
+        """Rebuild the case of the given index"""
+        return self.build(self.choice(self.digits(index)))
+
+    def digits(self, index):
+        """Return the vector indices of every dimension for a case index,
+        the last dimension varying the fastest like in itertools.product"""
+        if index < 0 or index >= len(self):
+            raise FuzzerException('Case %d out of range' % index)
+        digits = [0] * len(self.sizes)
+        for i in xrange(len(self.sizes) - 1, -1, -1):
+            index, digits[i] = divmod(index, self.sizes[i])
+        return digits
+
+    def choice(self, digits):
+        return [vectors[d] for (start, end, vectors), d
+                in zip(self.dimensions, digits)]
+
+    def cases(self, start=0, stop=None):
+        """Generate the (index, mutant) pairs of the given index range"""
+        if stop is None or stop > len(self):
+            stop = len(self)
+        if start >= stop:
+            return
+        digits = self.digits(start)
+        sizes = self.sizes
+        for index in xrange(start, stop):
+            yield index, self.build(self.choice(digits))
+            i = len(digits) - 1
+            while i >= 0:
+                digits[i] += 1
+                if digits[i] < sizes[i]:
+                    break
+                digits[i] = 0
+                i -= 1
+
+    def singles(self):
+        """Generate the mutants with a single dimension fuzzed at a time,
+        the other ones keeping their valid values"""
+        valid = [self.packet[start:end] if start is not None
+                 else ('relative', 0)
+                 for start, end, vectors in self.dimensions]
+        for i, (start, end, vectors) in enumerate(self.dimensions):
+            for vector in vectors:
+                if vector == valid[i]:
+                    continue
+                choice = list(valid)
+                choice[i] = vector
+                yield self.build(choice)
 
 
 class Fuzzer(object):
@@ -32,49 +301,409 @@ class Fuzzer(object):
         - Random bytes
         - Exhaustive (recursive)
         - Fuzz vectors (known "dangerous" values"
+
+    The fuzzable fields of the packet are overwritten with random bytes
+    according to a precompiled MutationPlan, the randomness for a whole
+    batch of mutants is drawn at once. The batches are derived from the
+    seed and their index only, so that any case can be regenerated from
+    (seed, index) without going through the ones preceding it.
+
+    The fuzz vectors are the boundary values of every field type, see
+    FUZZ_VECTORS, tried one field at a time by fuzz_vectors or in all
+    their combinations by exhaustive.
     """
 
-    def __init__(self, context):
+    def __init__(self, context, iterations=1000, batch_size=BATCH_SIZE,
+                 seed=None):
+        self.context = context
         self.mh = MessageHelper(context)
+        self.logger = setupLogger(__name__)
+        self.iterations = iterations
+        self.batch_size = batch_size
+        if seed is None:
+            seed = struct.unpack('>Q', os.urandom(8))[0]
+        self.seed = seed
+        self.logger.info('Fuzzer seed: %d' % seed)
 
     def fuzz(self, valid_packet):
-        """Generate fuzzed packets"""
-        i = 0
-        self.valid_packet = self.mh.unpack_request(valid_packet)[0]
-
-        # Just do a static number of permutations for now.
-        while i < 1000:
-            print '[i]', i
-            yield self.permute(self.valid_packet)
-            i += 1
-
-    def permute(self, packet):
-        """Return a fuzzed packet"""
-        if packet.type == 'handshake':
-            packet_struct = get_struct('ClientInitHandShake')
+        """Generate fuzzed requests"""
+        return self.mutants(valid_packet, self.request_plan(valid_packet),
+                            0, self.iterations)
+
+    def fuzz_response(self, valid_response, request):
+        """Generate fuzzed responses to the given request, packed or
+        unpacked"""
+        plan = self.response_plan(valid_response, request)
+        return self.mutants(valid_response, plan, 0, self.iterations)
+
+    def vector_space(self, packet, request=None, fields=None, lengths=True):
+        """Return the VectorSpace of a packet, a response if the request it
+        answers is given, restricted to the named fields if any and without
+        the dlen dimension if lengths is False"""
+        if request is None:
+            plan = self.request_plan(packet)
         else:
-            packet_struct = get_struct('ClientRequestHdr')
-            packet_struct += get_struct('Client' + packet.type[4:].title() + 'Request')
-
-        if packet.type == 'kXR_read':
-            packet_struct += get_struct('read_args')
-
-        # Remove 'type' field that we inserted for convenience
-        vars = packet._asdict()
-        del vars['type']
-
-        for field in packet_struct:
-            if field['fuzzable']:
-                vars[field['name']] = self.mutate(vars[field['name']], field['type'])
-
-        return self.mh.build_message(packet_struct, vars)
-
-    def mutate(self, field, type):
-        if type == 'H':
-            return random.randint(0, 65535)
-        elif type == 'l':
-            return random.randint(-2147483648 + 1, 2147483647)
-        elif type == 'q':
-            return random.randint(-sys.maxint + 1, sys.maxint)
-        elif type in ('s', 'c'):
-            return os.urandom(len(field))
\ No newline at end of file
+            plan = self.response_plan(packet, request)
+        return VectorSpace(packet, plan, fields, lengths)
+
+    def fuzz_vectors(self, packet, request=None):
+        """Generate the mutants with the fuzz vectors of a single field at a
+        time"""
+        return self.vector_space(packet, request).singles()
+
+    def exhaustive(self, packet, request=None, fields=None):
+        """Generate the mutants with every combination of the fuzz vectors
+        of the fields"""
+        return iter(self.vector_space(packet, request, fields))
+
+    def campaign(self, packet, start=0, stop=None, checkpoint=None,
+                 request=None):
+        """Return a Campaign fuzzing the packet, a response if the request
+        it answers is given"""
+        if stop is None:
+            stop = start + self.iterations
+        return Campaign(self, packet, start, stop, checkpoint, request)
+
+    def feedback_loop(self, packet, directory, request=None):
+        """Return a FeedbackLoop fuzzing the packet, a response if the
+        request it answers is given, with the corpus kept in a subdirectory
+        of the given one named after the packet"""
+        name = hashlib.sha1(packet).hexdigest()[:16]
+        corpus = Corpus(os.path.join(directory, name))
+        return FeedbackLoop(self, packet, corpus, request)
+
+    def permute(self, packet, index=0):
+        """Return the fuzzed request of the given index"""
+        return self.mutants(packet, self.request_plan(packet),
+                            index, index + 1).next()
+
+    def batch(self, packet, count, plan=None, start=0):
+        """Return a list of count fuzzed requests"""
+        if plan is None:
+            plan = self.request_plan(packet)
+        return list(self.mutants(packet, plan, start, start + count))
+
+    def send(self, message):
+        """Send a fuzzed message to the peer"""
+        self.mh.sendMessage(message)
+
+    def request_plan(self, packet):
+        """Return the mutation plan of a packed request"""
+        request_id = request_id_struct.unpack_from(packet, 2)[0]
+        type, layout = self.mh.getRequestLayout(request_id)
+        codec = getCodec(layout)
+        return get_plan(codec, codec.inferLengths(len(packet)))
+
+    def response_plan(self, packet, request):
+        """Return the mutation plan of a packed response to the given
+        request"""
+        if not hasattr(request, 'type'):
+            request = self.mh.unpackRequest(request)
+        layout, codec, lengths = self.mh.getResponseCodec(packet, request)
+        if len(layout) == 1:
+            return get_plan(codec, (), len(packet) - codec.fixedSize)
+        return get_plan(codec, lengths)
+
+    def random_block(self, block, size):
+        """Return the random bytes of the given batch"""
+        if not size:
+            return ''
+        rng = random.Random((self.seed << 64) | block)
+        return binascii.unhexlify('%0*x' % (size * 2, rng.getrandbits(size * 8)))
+
+    def mutants(self, packet, plan, start, stop):
+        """Generate the mutants of the given index range, each one a copy of
+        the packet with the fuzzable spans of the plan overwritten"""
+        base = bytearray(packet)
+        spans = plan.spans
+        width = plan.width
+        batch_size = self.batch_size
+        index = start
+        while index < stop:
+            block = index / batch_size
+            first = index % batch_size
+            last = min(batch_size, first + stop - index)
+            pool = self.random_block(block, batch_size * width)
+            pos = first * width
+            for i in xrange(first, last):
+                mutant = base[:]
+                for begin, end in spans:
+                    mutant[begin:end] = pool[pos:pos + end - begin]
+                    pos += end - begin
+                yield str(mutant)
+            index += last - first
+            self.logger.debug('Generated mutants up to %d' % index)
+
+
+class Campaign(object):
+    """A reproducible range of fuzz cases: the mutants [start, stop) of a
+    packet for the seed of the fuzzer. Campaigns over disjoint ranges can
+    be run by different processes, the progress is saved in the checkpoint
+    file, if any, so that an interrupted campaign resumes where it was."""
+
+    def __init__(self, fuzzer, packet, start, stop, checkpoint=None,
+                 request=None, interval=1000):
+        self.fuzzer = fuzzer
+        self.packet = packet
+        self.start = start
+        self.stop = stop
+        self.checkpoint = checkpoint
+        self.request = request
+        self.interval = interval
+        self.next = start
+        if request is None:
+            self.plan = fuzzer.request_plan(packet)
+        else:
+            self.plan = fuzzer.response_plan(packet, request)
+
+        if checkpoint and os.path.exists(checkpoint):
+            self.load()
+
+    def state(self):
+        return {'seed': self.fuzzer.seed,
+                'batch_size': self.fuzzer.batch_size,
+                'packet': binascii.hexlify(self.packet),
+                'start': self.start,
+                'stop': self.stop,
+                'next': self.next}
+
+    def load(self):
+        """Resume from the checkpoint file"""
+        f = open(self.checkpoint)
+        try:
+            state = json.load(f)
+        finally:
+            f.close()
+        expected = self.state()
+        for key in ('seed', 'batch_size', 'packet', 'start', 'stop'):
+            if state[key] != expected[key]:
+                raise FuzzerException('Checkpoint %s belongs to a different '
+                                      'campaign: %s mismatch' %
+                                      (self.checkpoint, key))
+        self.next = state['next']
+        self.fuzzer.logger.info('Resuming campaign at case %d' % self.next)
+
+    def save(self):
+        """Write the checkpoint file atomically"""
+        if not self.checkpoint:
+            return
+        tmp = self.checkpoint + '.tmp'
+        f = open(tmp, 'w')
+        try:
+            json.dump(self.state(), f)
+        finally:
+            f.close()
+        os.rename(tmp, self.checkpoint)
+
+    def cases(self):
+        """Generate the (index, mutant) pairs that have not been run yet;
+        a case counts as run when the next one is requested"""
+        index = self.next
+        for mutant in self.fuzzer.mutants(self.packet, self.plan, index,
+                                          self.stop):
+            if (index - self.start) % self.interval == 0:
+                self.next = index
+                self.save()
+            yield index, mutant
+            index += 1
+        self.next = self.stop
+        self.save()
+
+    def __iter__(self):
+        return self.cases()
+
+    def case(self, index):
+        """Regenerate a single case of the campaign"""
+        return self.fuzzer.mutants(self.packet, self.plan, index,
+                                   index + 1).next()
+
+    def shard(self, count, number):
+        """Return the number-th of count campaigns splitting this one"""
+        size = self.stop - self.start
+        start = self.start + size * number / count
+        stop = self.start + size * (number + 1) / count
+        checkpoint = None
+        if self.checkpoint:
+            checkpoint = '%s.%d' % (self.checkpoint, number)
+        return Campaign(self.fuzzer, self.packet, start, stop, checkpoint,
+                        self.request, self.interval)
+
+
+# What the peer did after receiving a mutant: whether it closed the
+# connection, the type of the message it sent next (or 'timeout'), how long
+# it took and how many bytes it sent
+Reaction = namedtuple('Reaction', 'closed type elapsed length')
+
+def signature(reaction):
+    """Reduce a reaction to a coarse behaviour class, timings and lengths
+    are bucketed by their order of magnitude"""
+    return (bool(reaction.closed), str(reaction.type),
+            int(math.log(reaction.elapsed * 1000 + 1, 2)),
+            int(math.log(reaction.length + 1, 2)))
+
+
+class Corpus(object):
+    """Mutants that produced a new peer behaviour, stored on disk. Each
+    entry is a file named after the digest of the mutant, the index file
+    keeps the signatures of the entries and how often each behaviour was
+    seen."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.seen = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        index = os.path.join(directory, 'index.json')
+        if os.path.exists(index):
+            f = open(index)
+            try:
+                state = json.load(f)
+            finally:
+                f.close()
+            self.seen = state['seen']
+            for name, entry in state['entries'].iteritems():
+                f = open(os.path.join(directory, name), 'rb')
+                try:
+                    entry['data'] = f.read()
+                finally:
+                    f.close()
+                self.entries[name] = entry
+
+    def __len__(self):
+        return len(self.entries)
+
+    def key(self, signature):
+        return '|'.join([str(s) for s in signature])
+
+    def observe(self, data, signature):
+        """Account for a reaction, return True if the behaviour is new and
+        the mutant has been added"""
+        key = self.key(signature)
+        self.lock.acquire()
+        try:
+            new = key not in self.seen
+            self.seen[key] = self.seen.get(key, 0) + 1
+            if new:
+                name = hashlib.sha1(data).hexdigest()
+                f = open(os.path.join(self.directory, name), 'wb')
+                try:
+                    f.write(data)
+                finally:
+                    f.close()
+                self.entries[name] = {'data': data, 'signature': key,
+                                      'picked': 0}
+        finally:
+            self.lock.release()
+        return new
+
+    def score(self, entry):
+        """Entries showing rare behaviours and not mutated much yet first"""
+        return 1.0 / self.seen[entry['signature']] / \
+               math.sqrt(1 + entry['picked'])
+
+    def choose(self, rng):
+        """Pick an entry at random weighted by the scores"""
+        self.lock.acquire()
+        try:
+            entries = self.entries.values()
+            if not entries:
+                return None
+            scores = [self.score(e) for e in entries]
+            point = rng.random() * sum(scores)
+            for entry, score in zip(entries, scores):
+                point -= score
+                if point <= 0:
+                    break
+            entry['picked'] += 1
+            return entry['data']
+        finally:
+            self.lock.release()
+
+    def save(self):
+        """Write the index file atomically"""
+        self.lock.acquire()
+        try:
+            entries = dict([(name, {'signature': e['signature'],
+                                    'picked': e['picked']})
+                            for name, e in self.entries.iteritems()])
+            state = {'seen': self.seen, 'entries': entries}
+            index = os.path.join(self.directory, 'index.json')
+            f = open(index + '.tmp', 'w')
+            try:
+                json.dump(state, f)
+            finally:
+                f.close()
+            os.rename(index + '.tmp', index)
+        finally:
+            self.lock.release()
+
+
+class FeedbackLoop(object):
+    """Feedback-guided fuzzing: the mutants that provoke a new behaviour of
+    the peer are kept in the corpus and mutated further, a few fields at a
+    time, in preference to fresh random mutants.
+
+        loop = fuzzer.feedback_loop(response, '/tmp/corpus', request)
+        mutant = loop.next()
+        # send the mutant and watch the peer
+        loop.feedback(mutant, Reaction(closed, type, elapsed, length))
+    """
+
+    def __init__(self, fuzzer, packet, corpus, request=None, explore=0.2,
+                 save_interval=100):
+        self.fuzzer = fuzzer
+        self.packet = packet
+        self.corpus = corpus
+        self.explore = explore
+        self.save_interval = save_interval
+        self.rng = random.Random(fuzzer.seed)
+        self.lock = threading.Lock()
+        self.index = 0
+        self.count = 0
+        if request is None:
+            self.plan = fuzzer.request_plan(packet)
+        else:
+            self.plan = fuzzer.response_plan(packet, request)
+
+    def next(self):
+        """Return the next mutant to try"""
+        self.lock.acquire()
+        try:
+            index = self.index
+            self.index += 1
+            explore = self.rng.random() < self.explore
+        finally:
+            self.lock.release()
+
+        parent = None
+        if not explore:
+            parent = self.corpus.choose(self.rng)
+        if parent is None:
+            return self.fuzzer.mutants(self.packet, self.plan, index,
+                                       index + 1).next()
+
+        # Overwrite a few of the fields of the parent
+        mutant = bytearray(parent)
+        fields = self.plan.fields
+        if not fields:
+            return parent
+        self.lock.acquire()
+        try:
+            count = self.rng.randint(1, min(3, len(fields)))
+            for name, type, start, end in self.rng.sample(fields, count):
+                mutant[start:end] = self.fuzzer.random_block(
+                    self.rng.getrandbits(63), end - start)
+        finally:
+            self.lock.release()
+        return str(mutant)
+
+    def feedback(self, mutant, reaction):
+        """Report the reaction of the peer to a mutant, return True if it
+        was interesting"""
+        new = self.corpus.observe(mutant, signature(reaction))
+        self.count += 1
+        if new or self.count % self.save_interval == 0:
+            self.corpus.save()
+        return new
@@ -23,9 +23,10 @@ import os
 
 import XProtocol
 import MessageHelper
+import ClientPipeline
 #import AuthHelper
 
-from Utils import get_struct, get_requestid, gen_sessid
+from Utils import getMessageStruct, getRequestId, genSessId
 
 class ImposterClient:
   """Class to aid sending/receiving xrootd client messages."""
@@ -33,75 +34,107 @@ class ImposterClient:
   def __init__(self, context):
     self.context = context    
     self.mh = MessageHelper.MessageHelper(context)
+    self.limiter = context.get('limiter')
 
   def send(self, request):
-    """Send a packed xrootd request."""
-    self.mh.send_message(request)
+    """Send a packed xrootd request, together with the queued ones."""
+    if self.limiter is not None:
+      self.limiter.take()
+    self.mh.sendMessage(request)
+
+  def queue(self, request):
+    """Queue a packed xrootd request to be sent by the next send or flush."""
+    if self.limiter is not None:
+      self.limiter.take()
+    self.mh.queueMessage(request)
+
+  def flush(self):
+    """Send the queued requests."""
+    self.mh.flush()
 
   def receive(self):
     """Receive a packed xrootd response."""
-    return self.mh.receive_message()
+    return self.mh.receiveResponse()
+
+  def sendAsync(self, request):
+    """Coroutine sending a packed xrootd request."""
+    return self.mh.sendMessageAsync(request)
+
+  def receiveAsync(self):
+    """Coroutine receiving a packed xrootd response."""
+    return self.mh.receiveResponseAsync()
+
+  def pipeline(self, depth=16, onAttn=None):
+    """Return a Pipeline keeping up to depth requests in flight on this
+    connection, each with its own stream id."""
+    return ClientPipeline.Pipeline(self, depth, onAttn)
 
   def unpack(self, response_raw, request):
     """Return an unpacked named tuple representation of a server response."""
     return self.mh.unpack_response(response_raw, request)
 
-  def do_full_handshake(self):
+  def do_full_handshake(self, username='imposter', verbose=True):
     """Perform handshake/protocol/login/auth/authmore sequence with default 
-    values."""
+    values, return the session id on success. With verbose=False nothing
+    is printed, ie. for the SessionPool logging in in the background."""
+    def report(message):
+      if verbose:
+        print message
+
     handshake_request = self.handshake()
     self.send(handshake_request)
     response_raw = self.receive()
     response = self.unpack(response_raw, handshake_request)
-    print response
+    report(response)
 
     protocol_request = self.kXR_protocol()
     self.send(protocol_request)
     response_raw = self.receive()
     response = self.unpack(response_raw, protocol_request)
-    print response
+    report(response)
 
-    login_request = self.kXR_login(username='imposter')
+    login_request = self.kXR_login(username=username)
     self.send(login_request)
     response_raw = self.receive()
     response = self.unpack(response_raw, login_request)
-    sessid = response.sessid
-    print response
+    sessid = getattr(response, 'sessid', None)
+    report(response)
 
     # Check if we need to auth
-    if len(response.sec):
+    if len(getattr(response, 'sec', '')):
       auth_request = self.kXR_auth(authtoken=response.sec)
       self.send(auth_request)
       response_raw = self.receive()
       response = self.unpack(response_raw, auth_request)
-      print response
+      report(response)
 
       # Check if we need to authmore
       while response.status == XProtocol.XResponseType.kXR_authmore:
-        print 'Client %s: more authentication needed' % self.context['streamid']
+        report('Client %s: more authentication needed' %
+               self.context['streamid'])
         auth_request = self.kXR_auth(contcred=response[-1])
         self.send(auth_request)
         response_raw = self.receive()
         response = self.unpack(response_raw, auth_request)
-        print response
+        report(response)
 
     if response.status == XProtocol.XResponseType.kXR_ok:
-      print "Logged in successfully"
+      report("Logged in successfully")
       return sessid
     else:
-      print "Login failed (%s): %s" % (response.status, 
-                                              response.errmsg)
+      report("Login failed (%s): %s" % (response.status, 
+                                        getattr(response, 'errmsg', '')))
 
   def handshake(self, first=None, second=None, third=None, fourth=None, 
                 fifth=None):
     """Return a packed representation of a client handshake request."""
-    request_struct = get_struct('ClientInitHandShake')
+    request_struct = getMessageStruct('ClientInitHandShake')
     params = {'first'   : first   if first  else 0,
               'second'  : second  if second else 0, 
               'third'   : third   if third  else 0,
               'fourth'  : fourth  if fourth else 4,
               'fifth'   : fifth   if fifth  else 2012}
-    return self.mh.build_message(request_struct, params)
+    return self.mh.buildMessage(request_struct, params)
 
   def kXR_admin(self):
     raise NotImplementedError()
@@ -115,64 +148,64 @@ class ImposterClient:
 
   def kXR_bind(self, streamid=None, requestid=None, sessid=None, dlen=None):
     """Return a packed representation of a kXR_bind request."""
-    request_struct = get_struct('ClientRequestHdr') + get_struct('ClientBindRequest')
+    request_struct = getMessageStruct('ClientRequestHdr') + getMessageStruct('ClientBindRequest')
     params = \
     {'streamid'  : streamid  if streamid   else self.context['streamid'],
-     'requestid' : requestid if requestid  else get_requestid('kXR_bind'),
-     'sessid'    : sessid    if sessid     else gen_sessid(),
+     'requestid' : requestid if requestid  else getRequestId('kXR_bind'),
+     'sessid'    : sessid    if sessid     else genSessId(),
      'dlen'      : dlen      if dlen       else 0}
-    return self.mh.build_message(request_struct, params)
+    return self.mh.buildMessage(request_struct, params)
 
   def kXR_chmod(self, streamid=None, requestid=None, reserved=None, mode=None,
                 dlen=None, path=None):
     """Return a packed representation of a kXR_chmod request."""
-    request_struct = get_struct('ClientRequestHdr') + get_struct('ClientChmodRequest')
+    request_struct = getMessageStruct('ClientRequestHdr') + getMessageStruct('ClientChmodRequest')
     if not path: path = ''
     params = \
     {'streamid'  : streamid  if streamid   else self.context['streamid'],
-     'requestid' : requestid if requestid  else get_requestid('kXR_chmod'),
+     'requestid' : requestid if requestid  else getRequestId('kXR_chmod'),
      'reserved'  : reserved  if reserved   else (14 * '\0'),
      'mode'      : mode      if mode       else 0,
      'dlen'      : dlen      if dlen       else len(path),
      'path'      : path}
-    return self.mh.build_message(request_struct, params)
+    return self.mh.buildMessage(request_struct, params)
 
   def kXR_close(self, streamid=None, requestid=None, fhandle=None, fsize=None,
                 reserved=None, dlen=None):
     """Return a packed representation of a kXR_close request."""
-    request_struct = get_struct('ClientRequestHdr') + get_struct('ClientCloseRequest')
+    request_struct = getMessageStruct('ClientRequestHdr') + getMessageStruct('ClientCloseRequest')
     params = \
     {'streamid'  : streamid  if streamid   else self.context['streamid'],
-     'requestid' : requestid if requestid  else get_requestid('kXR_close'),
+     'requestid' : requestid if requestid  else getRequestId('kXR_close'),
      'fhandle'   : fhandle   if fhandle    else (4 * '\0'),
      'fsize'     : fsize     if fsize      else 0,
      'reserved'  : reserved  if reserved   else (4 * '\0'),
      'dlen'      : dlen      if dlen       else 0}
-    return self.mh.build_message(request_struct, params)
+    return self.mh.buildMessage(request_struct, params)
 
   def kXR_dirlist(self, streamid=None, requestid=None, reserved=None,
                   options=None, dlen=None, path=None):
     """Return a packed representation of a kXR_dirlist request."""
-    request_struct = get_struct('ClientRequestHdr') + get_struct('ClientDirlistRequest')
+    request_struct = getMessageStruct('ClientRequestHdr') + getMessageStruct('ClientDirlistRequest')
     if not path: path = ''
     params = \
     {'streamid'  : streamid  if streamid   else self.context['streamid'],
-     'requestid' : requestid if requestid  else get_requestid('kXR_dirlist'),
+     'requestid' : requestid if requestid  else getRequestId('kXR_dirlist'),
      'reserved'  : reserved  if reserved   else (15 * '\0'),
      'options'   : options   if options    else '\0',
      'dlen'      : dlen      if dlen       else len(path),
      'path'      : path}
-    return self.mh.build_message(request_struct, params)
+    return self.mh.buildMessage(request_struct, params)
 
   def kXR_endsess(self, streamid=None, requestid=None, sessid=None, dlen=None):
     """Return a packed representation of a kXR_endsess request."""
-    request_struct = get_struct('ClientRequestHdr') + get_struct('ClientEndsessRequest')
+    request_struct = getMessageStruct('ClientRequestHdr') + getMessageStruct('ClientEndsessRequest')
     params = \
     {'streamid'  : streamid  if streamid   else self.context['streamid'],
-     'requestid' : requestid if requestid  else get_requestid('kXR_endsess'),
+     'requestid' : requestid if requestid  else getRequestId('kXR_endsess'),
      'sessid'    : sessid    if sessid     else (16 * '\0'),
      'dlen'      : dlen      if dlen       else 0}
-    return self.mh.build_message(request_struct, params)
+    return self.mh.buildMessage(request_struct, params)
 
   def kXR_getfile(self):
     raise NotImplementedError()
@@ -180,25 +213,26 @@ class ImposterClient:
   def kXR_locate(self, streamid=None, requestid=None, options=None,
                  reserved=None, dlen=None, path=None):
     """Return a packed representation of a kXR_locate request."""
-    request_struct = get_struct('ClientRequestHdr') + get_struct('ClientLocateRequest')
+    request_struct = getMessageStruct('ClientRequestHdr') + getMessageStruct('ClientLocateRequest')
     if not path: path = ''
     params = \
     {'streamid'  : streamid  if streamid   else self.context['streamid'],
-     'requestid' : requestid if requestid  else get_requestid('kXR_locate'),
+     'requestid' : requestid if requestid  else getRequestId('kXR_locate'),
      'options'   : options   if options    else 0,
      'reserved'  : reserved  if reserved   else (14 * '\0'),
      'dlen'      : dlen      if dlen       else len(path),
      'path'      : path}
-    return self.mh.build_message(request_struct, params)
+    return self.mh.buildMessage(request_struct, params)
 
   def kXR_login(self, streamid=None, requestid=None, pid=None, username=None,
                     reserved=None, zone=None, capver=None, role=None,
-                    dlen=None):
+                    dlen=None, token=None):
     """Return a packed representation of a kXR_login request."""
-    request_struct = get_struct('ClientRequestHdr') + get_struct('ClientLoginRequest')
+    request_struct = getMessageStruct('ClientRequestHdr') + getMessageStruct('ClientLoginRequest')
+    if not token: token = ''
     params = \
     {'streamid'  : streamid  if streamid   else self.context['streamid'],
-     'requestid' : requestid if requestid  else get_requestid('kXR_login'),
+     'requestid' : requestid if requestid  else getRequestId('kXR_login'),
      'pid'       : pid       if pid        else os.getpid(),
      'username'  : username  if username   else ''.ljust(8, "\0"),
      'reserved'  : reserved  if reserved   else '\0',
@@ -208,90 +242,91 @@ class ImposterClient:
                                                     | XProtocol.XLoginVersion
                                                     .kXR_ver003),
      'role'      : role      if role       else '0',
-     'dlen'      : dlen      if dlen       else 0}
-    return self.mh.build_message(request_struct, params)
+     'dlen'      : dlen      if dlen       else len(token),
+     'token'     : token}
+    return self.mh.buildMessage(request_struct, params)
 
   def kXR_mkdir(self, streamid=None, requestid=None, options=None,
                 reserved=None, mode=None, dlen=None, path=None):
     """Return a packed representation of a kXR_mkdir request."""
-    request_struct = get_struct('ClientRequestHdr') + get_struct('ClientMkdirRequest')
+    request_struct = getMessageStruct('ClientRequestHdr') + getMessageStruct('ClientMkdirRequest')
     if not path: path = ''
     params = \
     {'streamid'  : streamid  if streamid   else self.context['streamid'],
-     'requestid' : requestid if requestid  else get_requestid('kXR_mkdir'),
+     'requestid' : requestid if requestid  else getRequestId('kXR_mkdir'),
      'options'   : options   if options    else '\0',
      'reserved'  : reserved  if reserved   else (13 * '\0'),
      'mode'      : mode      if mode       else 0,
      'dlen'      : dlen      if dlen       else len(path),
      'path'      : path}
-    return self.mh.build_message(request_struct, params)
+    return self.mh.buildMessage(request_struct, params)
 
   def kXR_mv(self, streamid=None, requestid=None, reserved=None, dlen=None,
              path=None):
     """Return a packed representation of a kXR_mv request."""
-    request_struct = get_struct('ClientRequestHdr') + get_struct('ClientMvRequest')
+    request_struct = getMessageStruct('ClientRequestHdr') + getMessageStruct('ClientMvRequest')
     if not path: path = ''
     params = \
     {'streamid'  : streamid  if streamid   else self.context['streamid'],
-     'requestid' : requestid if requestid  else get_requestid('kXR_mv'),
+     'requestid' : requestid if requestid  else getRequestId('kXR_mv'),
      'reserved'  : reserved  if reserved   else (16 * '\0'),
      'dlen'      : dlen      if dlen       else len(path),
      'path'      : path}
-    return self.mh.build_message(request_struct, params)
+    return self.mh.buildMessage(request_struct, params)
 
   def kXR_open(self, streamid=None, requestid=None, mode=None, options=None,
                 reserved=None, dlen=None, path=None):
     """Return a packed representation of a kXR_open request."""
-    request_struct = get_struct('ClientRequestHdr') + get_struct('ClientOpenRequest')
+    request_struct = getMessageStruct('ClientRequestHdr') + getMessageStruct('ClientOpenRequest')
     if not path: path = ''
     params = \
     {'streamid'  : streamid  if streamid   else self.context['streamid'],
-     'requestid' : requestid if requestid  else get_requestid('kXR_open'),
+     'requestid' : requestid if requestid  else getRequestId('kXR_open'),
      'mode'      : mode      if mode       else 0,
      'options'   : options   if options    else 0,
      'reserved'  : reserved  if reserved   else (12 * '\0'),
      'dlen'      : dlen      if dlen       else len(path),
      'path'      : path}
-    return self.mh.build_message(request_struct, params)
+    return self.mh.buildMessage(request_struct, params)
 
   def kXR_ping(self, streamid=None, requestid=None, reserved=None, dlen=None):
     """Return a packed representation of a kXR_ping request."""
-    request_struct = get_struct('ClientRequestHdr') + get_struct('ClientPingRequest')
+    request_struct = getMessageStruct('ClientRequestHdr') + getMessageStruct('ClientPingRequest')
     params = \
     {'streamid'  : streamid  if streamid   else self.context['streamid'],
-     'requestid' : requestid if requestid  else get_requestid('kXR_ping'),
+     'requestid' : requestid if requestid  else getRequestId('kXR_ping'),
      'reserved'  : reserved  if reserved   else (16 * "\0"),
      'dlen'      : dlen      if dlen       else 0}
-    return self.mh.build_message(request_struct, params)
+    return self.mh.buildMessage(request_struct, params)
 
   def kXR_prepare(self, streamid=None, requestid=None, options=None, prty=None,
                   port=None, reserved=None, dlen=None, plist=None):
     """Return a packed representation of a kXR_prepare request."""
-    request_struct = get_struct('ClientRequestHdr') + get_struct('ClientPrepareRequest')
+    request_struct = getMessageStruct('ClientRequestHdr') + getMessageStruct('ClientPrepareRequest')
     if not plist: plist = ''
     params = \
     {'streamid'  : streamid  if streamid   else self.context['streamid'],
-     'requestid' : requestid if requestid  else get_requestid('kXR_prepare'),
+     'requestid' : requestid if requestid  else getRequestId('kXR_prepare'),
      'options'   : options   if options    else '\0',
      'prty'      : prty      if prty       else '\0',
      'port'      : port      if port       else 0,
      'reserved'  : reserved  if reserved   else (12 * "\0"),
      'dlen'      : dlen      if dlen       else len(plist),
      'plist'     : plist}
-    return self.mh.build_message(request_struct, params)
+    return self.mh.buildMessage(request_struct, params)
 
   def kXR_protocol(self, streamid=None, requestid=None, clientpv=None,
                    reserved=None, dlen=None):
     """Return a packed representation of a kXR_protocol request."""
-    request_struct = get_struct('ClientRequestHdr') + get_struct('ClientProtocolRequest')
+    request_struct = getMessageStruct('ClientRequestHdr') + getMessageStruct('ClientProtocolRequest')
     params = \
     {'streamid'  : streamid  if streamid   else self.context['streamid'],
-     'requestid' : requestid if requestid  else get_requestid('kXR_protocol'),
+     'requestid' : requestid if requestid  else getRequestId('kXR_protocol'),
      'clientpv'  : clientpv  if clientpv   else XProtocol.XLoginVersion
                                                  .kXR_ver003,
      'reserved'  : reserved  if reserved   else (12 * "\0"),
      'dlen'      : dlen      if dlen       else 0}   
-    return self.mh.build_message(request_struct, params)
+    return self.mh.buildMessage(request_struct, params)
 
   def kXR_putfile(self):
     raise NotImplementedError()
@@ -300,49 +335,49 @@ class ImposterClient:
                 reserved1=None, fhandle=None, reserved2=None, dlen=None,
                 args=None):
     """Return a packed representation of a kXR_query request."""
-    request_struct = get_struct('ClientRequestHdr') + get_struct('ClientQueryRequest')
+    request_struct = getMessageStruct('ClientRequestHdr') + getMessageStruct('ClientQueryRequest')
     if not args: args = ''
     params = \
     {'streamid'  : streamid   if streamid   else self.context['streamid'],
-     'requestid' : requestid  if requestid  else get_requestid('kXR_query'),
+     'requestid' : requestid  if requestid  else getRequestId('kXR_query'),
      'reqcode'   : reqcode    if reqcode    else 0,
      'reserved1' : reserved1  if reserved1  else (2 * "\0"),
      'fhandle'   : fhandle    if fhandle    else (4 * "\0"),
      'reserved2' : reserved2  if reserved2  else (8 * "\0"),
      'dlen'      : dlen       if dlen       else len(args),
      'args'      : args}    
-    return self.mh.build_message(request_struct, params)
+    return self.mh.buildMessage(request_struct, params)
 
   def kXR_read(self, streamid=None, requestid=None, fhandle=None, offset=None,
                rlen=None, dlen=None, pathid=None, reserved=None, 
                readahead=False, fhandle2=None, rlen2=None, roffset2=None):
     """Return a packed representation of a kXR_read request. Pass 
     readahead=True to enable pre-read."""
-    read_args = get_struct('read_args')
+    read_args = getMessageStruct('read_args')
     params = \
     {'pathid'    : pathid     if pathid     else '',
      'reserved'  : reserved   if reserved   else (7 * '\0')}
-    read_args = self.mh.build_message(read_args, params)
+    read_args = self.mh.buildMessage(read_args, params)
 
     if readahead:
-      readahead_list = get_struct('readahead_list')
+      readahead_list = getMessageStruct('readahead_list')
       params = \
       {'fhandle2': fhandle2   if fhandle2   else (4 * '\0'),
        'rlen2'   : rlen2      if rlen2      else 0,
        'roffset2': roffset2   if roffset2   else 0}
-      readahead_list = self.mh.build_message(readahead_list, params)
+      readahead_list = self.mh.buildMessage(readahead_list, params)
     else: readahead_list = ''
 
-    request_struct = get_struct('ClientRequestHdr') + get_struct('ClientReadRequest')
+    request_struct = getMessageStruct('ClientRequestHdr') + getMessageStruct('ClientReadRequest')
     params = \
     {'streamid'  : streamid   if streamid   else self.context['streamid'],
-     'requestid' : requestid  if requestid  else get_requestid('kXR_read'),
+     'requestid' : requestid  if requestid  else getRequestId('kXR_read'),
      'fhandle'   : fhandle    if fhandle    else (4 * "\0"),
      'offset'    : offset     if offset     else 0,
      'rlen'      : rlen       if rlen       else 0,
      'dlen'      : dlen       if dlen       else len(read_args
                                                      + readahead_list)}
-    return self.mh.build_message(request_struct, params) \
+    return self.mh.buildMessage(request_struct, params) \
            + read_args + readahead_list
 
   def kXR_readv(self, streamid=None, requestid=None, reserved=None, pathid=None,
@@ -352,111 +387,112 @@ class ImposterClient:
     format (fhandle, rlen, offset)."""
     all_read_lists = ''
     for read_list in read_lists.itervalues():
-      read_struct = get_struct('ClientRequestHdr') + get_struct('readahead_list')
+      read_struct = getMessageStruct('read_list')
       params = \
-      {'fhandle2': read_list[0] if read_list[0] else (4 * '\0'),
-       'rlen2'   : read_list[1] if read_list[1] else 0,
-       'roffset2': read_list[2] if read_list[2] else 0}
-      all_read_lists += self.mh.build_message(read_struct, params)
+      {'fhandle' : read_list[0] if read_list[0] else (4 * '\0'),
+       'len'     : read_list[1] if read_list[1] else 0,
+       'offset'  : read_list[2] if read_list[2] else 0}
+      all_read_lists += self.mh.buildMessage(read_struct, params)
 
-    request_struct = get_struct('ClientRequestHdr') + get_struct('ClientReadVRequest')
+    request_struct = getMessageStruct('ClientRequestHdr') + getMessageStruct('ClientReadvRequest')
     params = \
     {'streamid'  : streamid   if streamid   else self.context['streamid'],
-     'requestid' : requestid  if requestid  else get_requestid('kXR_readv'),
+     'requestid' : requestid  if requestid  else getRequestId('kXR_readv'),
      'reserved'  : reserved   if reserved   else (15 * "\0"),
      'pathid'    : pathid     if pathid     else '0',
-     'dlen'      : dlen       if dlen       else len(all_read_lists)}
-    return self.mh.build_message(request_struct, params) + all_read_lists
+     'dlen'      : dlen       if dlen       else len(all_read_lists),
+     'data'      : all_read_lists}
+    return self.mh.buildMessage(request_struct, params)
 
   def kXR_rm(self, streamid=None, requestid=None, reserved=None, dlen=None, 
              path=None):
     """Return a packed representation of a kXR_rm request."""
-    request_struct = get_struct('ClientRequestHdr') + get_struct('ClientRmRequest')
+    request_struct = getMessageStruct('ClientRequestHdr') + getMessageStruct('ClientRmRequest')
     if not path: path = ''
     params = \
     {'streamid'  : streamid  if streamid   else self.context['streamid'],
-     'requestid' : requestid if requestid  else get_requestid('kXR_rm'),
+     'requestid' : requestid if requestid  else getRequestId('kXR_rm'),
      'reserved'  : reserved  if reserved   else (16 * '\0'),
      'dlen'      : dlen      if dlen       else len(path),
      'path'      : path}
-    return self.mh.build_message(request_struct, params)
+    return self.mh.buildMessage(request_struct, params)
 
   def kXR_rmdir(self, streamid=None, requestid=None, reserved=None, dlen=None, 
                path=None):
     """Return a packed representation of a kXR_rmdir request."""
-    if not requestid: requestid = get_requestid('kXR_rmdir')
+    if not requestid: requestid = getRequestId('kXR_rmdir')
     return self.kXR_rm(streamid, requestid, reserved, dlen, path)
 
   def kXR_set(self, streamid=None, requestid=None, reserved=None, dlen=None, 
                data=None):
     """Return a packed representation of a kXR_set request."""
-    request_struct = get_struct('ClientRequestHdr') + get_struct('ClientSetRequest')
+    request_struct = getMessageStruct('ClientRequestHdr') + getMessageStruct('ClientSetRequest')
     if not data: data = ''
     params = \
     {'streamid'  : streamid  if streamid   else self.context['streamid'],
-     'requestid' : requestid if requestid  else get_requestid('kXR_set'),
+     'requestid' : requestid if requestid  else getRequestId('kXR_set'),
      'reserved'  : reserved  if reserved   else (16 * '\0'),
      'dlen'      : dlen      if dlen       else len(data),
      'data'      : data}
-    return self.mh.build_message(request_struct, params)
+    return self.mh.buildMessage(request_struct, params)
 
   def kXR_stat(self, streamid=None, requestid=None, options=None, reserved=None,
                fhandle=None, dlen=None, path=None):
     """Return a packed representation of a kXR_stat request."""
-    request_struct = get_struct('ClientRequestHdr') + get_struct('ClientStatRequest')   
+    request_struct = getMessageStruct('ClientRequestHdr') + getMessageStruct('ClientStatRequest')   
     if not path: path = ''
     params = \
     {'streamid'  : streamid   if streamid   else self.context['streamid'],
-     'requestid' : requestid  if requestid  else get_requestid('kXR_stat'),
-     'options'   : options    if options    else '\0',
+     'requestid' : requestid  if requestid  else getRequestId('kXR_stat'),
+     'options'   : options    if options    else 0,
      'reserved'  : reserved   if reserved   else (11 * "\0"),
      'fhandle'   : fhandle    if fhandle    else (4 * "\0"),
      'dlen'      : dlen       if dlen       else len(path),
      'path'      : path}
-    return self.mh.build_message(request_struct, params)
+    return self.mh.buildMessage(request_struct, params)
 
   def kXR_statx(self, streamid=None, requestid=None, reserved=None, dlen=None, 
                 paths=None):
     """Return a packed representation of a kXR_statx request."""
-    if not requestid: requestid = get_requestid('kXR_statx')
+    if not requestid: requestid = getRequestId('kXR_statx')
     return self.kXR_stat(streamid, requestid, None, reserved, None, dlen, path)
 
   def kXR_sync(self, streamid=None, requestid=None, fhandle=None, reserved=None,
                dlen=None, path=None):
     """Return a packed representation of a kXR_sync request."""
-    request_struct = get_struct('ClientRequestHdr') + get_struct('ClientSyncRequest')
+    request_struct = getMessageStruct('ClientRequestHdr') + getMessageStruct('ClientSyncRequest')
     params = \
     {'streamid'  : streamid   if streamid   else self.context['streamid'],
-     'requestid' : requestid  if requestid  else get_requestid('kXR_sync'),
+     'requestid' : requestid  if requestid  else getRequestId('kXR_sync'),
      'fhandle'   : fhandle    if fhandle    else (4 * "\0"),
      'reserved'  : reserved   if reserved   else (12 * "\0"),
      'dlen'      : dlen       if dlen       else 0}
-    return self.mh.build_message(request_struct, params)
+    return self.mh.buildMessage(request_struct, params)
 
   def kXR_truncate(self, streamid=None, requestid=None, fhandle=None, 
                    size=None, reserved=None, dlen=None, path=None):
     """Return a packed representation of a kXR_truncate request."""
-    request_struct = get_struct('ClientRequestHdr') + get_struct('ClientTruncateRequest')
+    request_struct = getMessageStruct('ClientRequestHdr') + getMessageStruct('ClientTruncateRequest')
     if not path: path = ''
     params = \
     {'streamid'  : streamid   if streamid   else self.context['streamid'],
-     'requestid' : requestid  if requestid  else get_requestid('kXR_truncate'),
+     'requestid' : requestid  if requestid  else getRequestId('kXR_truncate'),
      'fhandle'   : fhandle    if fhandle    else (4 * "\0"),
      'size'      : size       if size       else 0,
      'reserved'  : reserved   if reserved   else (4 * "\0"),
      'dlen'      : dlen       if dlen       else len(path),
      'path'      : path}
-    return self.mh.build_message(request_struct, params)
+    return self.mh.buildMessage(request_struct, params)
 
   def kXR_verifyw(self, streamid=None, requestid=None, fhandle=None, 
                    offset=None, pathid=None, vertype=None, reserved=None,
                    dlen=None, data=None):
     """Return a packed representation of a kXR_verifyw request."""
-    request_struct = get_struct('ClientRequestHdr') + get_struct('ClientVerifywRequest')
+    request_struct = getMessageStruct('ClientRequestHdr') + getMessageStruct('ClientVerifywRequest')
     if not data: data = ''
     params = \
     {'streamid'  : streamid   if streamid   else self.context['streamid'],
-     'requestid' : requestid  if requestid  else get_requestid('kXR_verifyw'),
+     'requestid' : requestid  if requestid  else getRequestId('kXR_verifyw'),
      'fhandle'   : fhandle    if fhandle    else (4 * "\0"),
      'offset'    : offset     if offset     else 0,
      'pathid'    : pathid     if pathid     else '\0',
@@ -464,11 +500,11 @@ class ImposterClient:
      'reserved'  : reserved   if reserved   else (2 * "\0"),
      'dlen'      : dlen       if dlen       else len(data),
      'data'      : data}
-    return self.mh.build_message(request_struct, params)
+    return self.mh.buildMessage(request_struct, params)
 
   def kXR_write(self, streamid=None, requestid=None, fhandle=None, offset=None, 
                 pathid=None, reserved=None, dlen=None, data=None):
     """Return a packed representation of a kXR_write request."""
-    if not requestid: requestid = get_requestid('kXR_write')
+    if not requestid: requestid = getRequestId('kXR_write')
     return self.kXR_verifyw(streamid, requestid, fhandle, offset, pathid, None, 
                             reserved, dlen, data)
@@ -18,15 +18,58 @@
 #-------------------------------------------------------------------------------
 
 import sys
+import select
 import struct
+import logging
 
 import XProtocol
 import MessageHelper
 import AuthHelper
 
+from AsyncEngine import Return
 from Utils import getMessageStruct, genSessId, getResponseId, getAttnCode
+from Utils import getRequestId
 from Utils import setupLogger
 
+headerStruct = struct.Struct( '>HHl' )
+packedTypes  = (str, bytearray, memoryview)
+
+#-------------------------------------------------------------------------------
+# The largest amount of file data sent in a single response frame
+#-------------------------------------------------------------------------------
+defaultFrameSize = 2097152
+
+#-------------------------------------------------------------------------------
+class ResponseTemplate( object ):
+  """Response whose constant part is packed once, only the streamid, status,
+  dlen and the trailing payload are patched into a preallocated buffer when
+  rendering. The prototype is a packed response with an empty payload."""
+
+  #-----------------------------------------------------------------------------
+  def __init__( self, prototype, capacity = 4096 ):
+    self.fixed  = len( prototype )
+    self.status = headerStruct.unpack_from( prototype )[1]
+    self.buffer = bytearray( max( capacity, self.fixed ) )
+    self.buffer[:self.fixed] = prototype
+    self.view   = memoryview( self.buffer )
+
+  #-----------------------------------------------------------------------------
+  def render( self, streamid = 0, payload = '', status = None ):
+    """Return a memoryview of the rendered response, it is only valid until
+    the next call"""
+    size = self.fixed + len( payload )
+    if size > len( self.buffer ):
+      newBuffer = bytearray( max( size, 2 * len( self.buffer ) ) )
+      newBuffer[:self.fixed] = self.buffer[:self.fixed]
+      self.buffer = newBuffer
+      self.view   = memoryview( newBuffer )
+
+    if status is None:
+      status = self.status
+    headerStruct.pack_into( self.buffer, 0, streamid, status, size - 8 )
+    self.buffer[self.fixed:size] = payload
+    return self.view[:size]
+
 #-------------------------------------------------------------------------------
 class ImposterServer:
   """Class to aid sending/receiving xrootd server messages."""
@@ -38,21 +81,95 @@ class ImposterServer:
     self.pending_request = None
     self.logger = setupLogger( __name__ )
 
+    #---------------------------------------------------------------------------
+    # Request handlers of the dispatcher keyed by the request id and the
+    # parameters of the default log in sequence
+    #---------------------------------------------------------------------------
+    self.handlers = {
+      XProtocol.XRequestTypes.handshake:    self.handleHandshake,
+      XProtocol.XRequestTypes.kXR_protocol: self.handleProtocol,
+      XProtocol.XRequestTypes.kXR_login:    self.handleLogin,
+      XProtocol.XRequestTypes.kXR_auth:     self.handleAuth }
+    self.fallback      = self.handleUnsupported
+    self.verifyAuth    = False
+    self.handshakeFlag = None
+    self.protocolFlags = None
+
   #-----------------------------------------------------------------------------
   def send(self, response):
-    """Send a packed xrootd response."""
+    """Send a packed xrootd response, together with the queued ones."""
     self.mh.sendMessage(response)
 
   #-----------------------------------------------------------------------------
-  def receive( self ):
-    """Receive a request"""
+  def queue( self, response ):
+    """Queue a packed xrootd response to be sent by the next send or flush,
+    ie. to send a burst of kXR_oksofar chunks in as few syscalls as
+    possible"""
+    self.mh.queueMessage( response )
+
+  #-----------------------------------------------------------------------------
+  def flush( self ):
+    """Send the queued responses"""
+    self.mh.flush()
+
+  #-----------------------------------------------------------------------------
+  def sendFrames( self, frames ):
+    """Send the responses built by readFrames or readvFrames, together
+    with the queued ones"""
+    self.mh.sendFrames( frames )
+
+  #-----------------------------------------------------------------------------
+  def receive( self, zeroCopy = False, lazy = False ):
+    """Receive a request
+
+    With zeroCopy the payload field (ie. the data of kXR_write) is a
+    memoryview of the receive buffer, valid until the next request is
+    received; good enough for scenarios that only checksum or discard it.
+
+    With lazy only the request header is decoded up front, the rest of the
+    fields on first access; good for scenarios dispatching on the type and
+    streamid only. Combined with zeroCopy, the fields need to be accessed
+    before the next request is received."""
     while True:
-      request = self.mh.unpackRequest( self.mh.receiveMessage() )
-      self.logger.info( 'Received request: %s' % (str(request)) )
-      if request:
-        yield request
+      if zeroCopy:
+        message = self.mh.receiveMessageView()
+      else:
+        message = self.mh.receiveMessage()
+      if lazy:
+        request = self.mh.unpackRequestLazy( message )
       else:
+        request = self.mh.unpackRequest( message )
+      if request is None:
         break
+      if self.logger.isEnabledFor( logging.INFO ):
+        self.logger.info( 'Received request: %s' % (str(request)) )
+      yield request
+
+  #-----------------------------------------------------------------------------
+  def sendAsync( self, response ):
+    """Coroutine sending a packed xrootd response."""
+    return self.mh.sendMessageAsync( response )
+
+  #-----------------------------------------------------------------------------
+  def sendFramesAsync( self, frames ):
+    """Coroutine sending the responses built by readFrames or
+    readvFrames."""
+    return self.mh.sendFramesAsync( frames )
+
+  #-----------------------------------------------------------------------------
+  def receiveAsync( self ):
+    """Coroutine receiving a request, returns None if it cannot be decoded"""
+    request = self.mh.unpackRequest( (yield self.mh.receiveMessageAsync()) )
+    if self.logger.isEnabledFor( logging.INFO ):
+      self.logger.info( 'Received request: %s' % (str(request)) )
+    raise Return( request )
+
+  #-----------------------------------------------------------------------------
+  def template( self, name, capacity = 4096, **kwargs ):
+    """Return a ResponseTemplate built from the response builder of the given
+    name, ie. template('kXR_error', errnum=3011).render(streamid, 'No such
+    file'). The payload argument of the builder must be left out."""
+    return ResponseTemplate( getattr( self, name )( **kwargs ), capacity )
 
   #-----------------------------------------------------------------------------
   def close(self):
@@ -73,8 +190,8 @@ class ImposterServer:
       # Send handshake + protocol at the same time
       #-------------------------------------------------------------------------
       if request.type == 'handshake':
-        self.send( self.handshake(flag = handshakeFlag) +
-                   self.kXR_protocol(flags = protocolFlags))
+        self.queue( self.handshake(flag = handshakeFlag) )
+        self.send( self.kXR_protocol(flags = protocolFlags) )
 
       #-------------------------------------------------------------------------
       # Handle login - if we don't need to handle authentication - that's it
@@ -107,6 +224,127 @@ class ImposterServer:
         #-----------------------------------------------------------------------
         if not contparams: break
 
+  #=============================================================================
+  # Dispatcher
+  #=============================================================================
+  def register( self, type, handler ):
+    """Register the handler of a request type given by its name, ie.
+    'kXR_stat', or its id, replacing the previous one. The handler is called
+    with the request and returns a packed response, the frames returned by
+    readFrames or readvFrames, a list of any of these or None to leave the
+    request unanswered."""
+    if not isinstance( type, (int, long) ):
+      type = getRequestId( type )
+    self.handlers[type] = handler
+
+  #-----------------------------------------------------------------------------
+  def dispatch( self, request ):
+    """Return the response of the handler registered for the request, or
+    of the fallback one if there is none"""
+    requestId = getattr( request, 'requestid',
+                         XProtocol.XRequestTypes.handshake )
+    return self.handlers.get( requestId, self.fallback )( request )
+
+  #-----------------------------------------------------------------------------
+  def responses( self, response ):
+    """Flatten what a handler has returned into a list of packed responses
+    and response frames, the frames being tuples"""
+    if response is None:
+      return []
+    if isinstance( response, packedTypes + (tuple,) ):
+      return [response]
+    items = []
+    for item in response:
+      items.extend( self.responses( item ) )
+    return items
+
+  #-----------------------------------------------------------------------------
+  def respond( self, response ):
+    """Queue the packed responses returned by a handler, the response
+    frames are sent right away as they refer to the file data"""
+    for item in self.responses( response ):
+      if isinstance( item, packedTypes ):
+        self.queue( item )
+      else:
+        self.sendFrames( [item] )
+
+  #-----------------------------------------------------------------------------
+  def respondAsync( self, response ):
+    """Coroutine variant of respond"""
+    for item in self.responses( response ):
+      if isinstance( item, packedTypes ):
+        self.queue( item )
+      else:
+        yield self.sendFramesAsync( [item] )
+
+  #-----------------------------------------------------------------------------
+  def pending( self ):
+    """Check if the client has sent more requests, the responses are
+    batched until it has not"""
+    return bool( select.select( [self.context['socket']], [], [], 0 )[0] )
+
+  #-----------------------------------------------------------------------------
+  def serve( self, zeroCopy = False, lazy = False ):
+    """Dispatch the requests to the registered handlers until the client
+    disconnects. The responses to the requests the client has pipelined are
+    sent together once they have all been handled."""
+    try:
+      for request in self.receive( zeroCopy, lazy ):
+        self.respond( self.dispatch( request ) )
+        if not self.pending():
+          self.flush()
+    except MessageHelper.MessageException, e:
+      self.logger.info( 'Connection done: %s' % (str(e)) )
+
+  #-----------------------------------------------------------------------------
+  def serveAsync( self ):
+    """Coroutine variant of serve"""
+    try:
+      while True:
+        request = yield self.receiveAsync()
+        if not request:
+          break
+        yield self.respondAsync( self.dispatch( request ) )
+        if not self.pending():
+          yield self.mh.flushAsync()
+    except MessageHelper.MessageException, e:
+      self.logger.info( 'Connection done: %s' % (str(e)) )
+
+  #-----------------------------------------------------------------------------
+  def handleHandshake( self, request ):
+    """Answer the handshake together with the kXR_protocol request sent
+    along with it, as doFullHandshake does"""
+    return [self.handshake( flag = self.handshakeFlag ),
+            self.kXR_protocol( flags = self.protocolFlags )]
+
+  #-----------------------------------------------------------------------------
+  def handleProtocol( self, request ):
+    """The kXR_protocol request has been answered with the handshake"""
+    return None
+
+  #-----------------------------------------------------------------------------
+  def handleLogin( self, request ):
+    return self.kXR_login( streamid = request.streamid,
+                           verifyAuth = self.verifyAuth )
+
+  #-----------------------------------------------------------------------------
+  def handleAuth( self, request ):
+    """Authenticate the credentials if verifyAuth is set, answer with
+    kXR_authmore if there is more to it"""
+    contparams = None
+    if self.verifyAuth:
+      contparams = self.authenticate( request.cred )
+    if contparams:
+      return self.kXR_authmore( streamid = request.streamid,
+                                data = contparams )
+    return self.kXR_ok( streamid = request.streamid )
+
+  #-----------------------------------------------------------------------------
+  def handleUnsupported( self, request ):
+    return self.kXR_error( streamid = getattr( request, 'streamid', 0 ),
+                           errnum = XProtocol.XErrorCode.kXR_Unsupported,
+                           errmsg = 'Unsupported request: %s' % request.type )
+
   #-----------------------------------------------------------------------------
   def authenticate(self, cred):
     """Authenticate the given credentials.""" 
@@ -256,14 +494,77 @@ class ImposterServer:
     """
 
     if chunks != None:
-      headerFormat = self.mh.getMessageFormat( getMessageStruct( 'read_list' ) )
-      data = ''
+      parts = []
       for chunk in chunks:
-        data += self.mh.pack( headerFormat, (chunk[0], chunk[1], chunk[2]) )
-        data += chunk[3]
+        parts.append( MessageHelper.readListStruct.pack( *chunk[:3] ) )
+        parts.append( chunk[3] )
+      data = ''.join( parts )
 
     return self.kXR_ok( streamid, status, dlen, data )
 
+  #-----------------------------------------------------------------------------
+  def readFrames( self, streamid, source, offset, length,
+                  frameSize = defaultFrameSize ):
+    """
+    Return the frames of a kXR_read response serving length bytes of the
+    source, ie. an mmap of the file, at the offset; shorter at its end.
+
+    Each frame is a packed header and a buffer of the source, so the data is
+    never copied, and holds at most frameSize bytes of it; all the frames but
+    the last are kXR_oksofar. Send them with sendFrames or sendFramesAsync
+    while the source is still open.
+    """
+    if frameSize < 1:
+      raise ValueError( 'Invalid frame size: %s' % frameSize )
+    offset = max( 0, min( offset, len( source ) ) )
+    length = max( 0, min( length, len( source ) - offset ) )
+    frames = []
+    while True:
+      size    = min( length, frameSize )
+      length -= size
+      status  = XProtocol.XResponseType.kXR_oksofar if length else \
+                XProtocol.XResponseType.kXR_ok
+      frames.append( (headerStruct.pack( streamid, status, size ),
+                      buffer( source, offset, size )) )
+      offset += size
+      if not length:
+        return frames
+
+  #-----------------------------------------------------------------------------
+  def readvFrames( self, streamid, chunks, frameSize = defaultFrameSize ):
+    """
+    Return the frames of a kXR_readv response, see readFrames.
+
+    chunks is a list of 4-tuples of the following format:
+    (fhandle, source, offset, length)
+
+    The response is split into kXR_oksofar frames at the chunk boundaries
+    once it holds more than frameSize bytes.
+    """
+    if frameSize < 1:
+      raise ValueError( 'Invalid frame size: %s' % frameSize )
+    frames = []
+    parts  = []
+    size   = 0
+    for fhandle, source, offset, length in chunks:
+      offset = max( 0, min( offset, len( source ) ) )
+      length = max( 0, min( length, len( source ) - offset ) )
+      chunkSize = MessageHelper.readListStruct.size + length
+      if parts and size + chunkSize > frameSize:
+        frames.append( tuple( [headerStruct.pack(
+                                 streamid, XProtocol.XResponseType.kXR_oksofar,
+                                 size )] + parts ) )
+        parts = []
+        size  = 0
+      parts.append( MessageHelper.readListStruct.pack( fhandle, length,
+                                                       offset ) )
+      parts.append( buffer( source, offset, length ) )
+      size += chunkSize
+    frames.append( tuple( [headerStruct.pack(
+                             streamid, XProtocol.XResponseType.kXR_ok,
+                             size )] + parts ) )
+    return frames
+
   #-----------------------------------------------------------------------------
   def kXR_set(self, streamid=None, status=None, dlen=None, data=None):
     """Return a packed representation of a kXR_set response.""" 
@@ -287,7 +588,7 @@ class ImposterServer:
       'streamid': streamid  if streamid else 0,
       'status'  : status    if status   else getResponseId('kXR_attn'),
       'dlen'    : dlen      if dlen     else len(msg) + 4,
-      'actnum'  : actnum    if actnum   else get_attncode('kXR_asyncab'),
+      'actnum'  : actnum    if actnum   else getAttnCode('kXR_asyncab'),
       'parms'   : msg}
     return self.mh.buildMessage(responseStruct, params)
 
@@ -300,7 +601,7 @@ class ImposterServer:
       'streamid': streamid  if streamid else 0,
       'status'  : status    if status   else getResponseId('kXR_attn'),
       'dlen'    : dlen      if dlen     else 12,
-      'actnum'  : actnum    if actnum   else get_attncode('kXR_asyncdi'),
+      'actnum'  : actnum    if actnum   else getAttnCode('kXR_asyncdi'),
       'wsec'    : wsec      if wsec     else 0,
       'msec'    : msec      if msec     else 0}
     return self.mh.buildMessage(responseStruct, params)
@@ -308,13 +609,13 @@ class ImposterServer:
   def kXR_attn_asyncgo(self, streamid=None, status=None, dlen=None, 
                        actnum=None):
     """Return a packed representation of a kXR_attn_asyncgo response."""
-    if not actnum: actnum = get_attncode('kXR_asyncgo')
+    if not actnum: actnum = getAttnCode('kXR_asyncgo')
     return self.kXR_attn_asyncab(streamid, status, dlen, actnum, None)
 
   def kXR_attn_asyncms(self, streamid=None, status=None, dlen=None, actnum=None,
                        msg=None):
     """Return a packed representation of a kXR_attn_asyncms response."""
-    if not actnum: actnum = get_attncode('kXR_asyncms')
+    if not actnum: actnum = getAttnCode('kXR_asyncms')
     return self.kXR_attn_asyncab(streamid, status, dlen, actnum, msg)
 
   def kXR_attn_asyncrd(self, streamid=None, status=None, dlen=None, actnum=None,
@@ -328,7 +629,7 @@ class ImposterServer:
       'streamid': streamid  if streamid else 0,
       'status'  : status    if status   else getResponseId('kXR_attn'),
       'dlen'    : dlen      if dlen     else len(host),
-      'actnum'  : actnum    if actnum   else get_attncode('kXR_asyncrd'),
+      'actnum'  : actnum    if actnum   else getAttnCode('kXR_asyncrd'),
       'port'    : port      if port     else 0,
       'host'    : host}
     return self.mh.buildMessage(responseStruct, params)
@@ -357,7 +658,7 @@ class ImposterServer:
       'streamid': streamid  if streamid else 0,
       'status'  : status    if status   else getResponseId('kXR_attn'),
       'dlen'    : dlen      if dlen     else 8,
-      'actnum'  : actnum    if actnum   else get_attncode('kXR_asyncwt'),
+      'actnum'  : actnum    if actnum   else getAttnCode('kXR_asyncwt'),
       'wsec'    : wsec      if wsec     else 0}
     return self.mh.buildMessage(responseStruct, params)
 
@@ -0,0 +1,245 @@
+#-------------------------------------------------------------------------------
+# Copyright (c) 2011-2013 by European Organization for Nuclear Research (CERN)
+# Author: Lukasz Janyst <ljanyst@cern.ch>
+#-------------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+"""
+Throughput and latency bookkeeping for load generating scenarios.
+"""
+
+import time
+import threading
+
+#-------------------------------------------------------------------------------
+class LatencyHistogram( object ):
+  """HDR-style log-linear histogram of integer values (ie. microseconds).
+
+  Every power of two range is split into 2**(subBits-1) linear buckets, so
+  the recorded values are kept with a relative error below 2**(1-subBits),
+  under 1% with the default, at a constant cost per record and a memory
+  footprint that only grows with the logarithm of the value range."""
+
+  #-----------------------------------------------------------------------------
+  def __init__( self, subBits = 8 ):
+    self.subBits = subBits
+    self.half    = 1 << (subBits - 1)
+    self.counts  = {}
+    self.reset()
+
+  #-----------------------------------------------------------------------------
+  def reset( self ):
+    self.counts.clear()
+    self.total = 0
+    self.sum   = 0
+    self.min   = None
+    self.max   = None
+
+  #-----------------------------------------------------------------------------
+  def bucket( self, value ):
+    """Return the index of the bucket holding the value"""
+    shift = value.bit_length() - self.subBits
+    if shift <= 0:
+      return value
+    return shift * self.half + (value >> shift)
+
+  #-----------------------------------------------------------------------------
+  def highest( self, index ):
+    """Return the highest value falling into the bucket"""
+    if index < 2 * self.half:
+      return index
+    shift = index / self.half - 1
+    return ((index - shift * self.half + 1) << shift) - 1
+
+  #-----------------------------------------------------------------------------
+  def record( self, value, count = 1 ):
+    value = int( value )
+    if value < 0:
+      value = 0
+    index = self.bucket( value )
+    self.counts[index] = self.counts.get( index, 0 ) + count
+    self.total += count
+    self.sum   += value * count
+    if self.min is None or value < self.min:
+      self.min = value
+    if self.max is None or value > self.max:
+      self.max = value
+
+  #-----------------------------------------------------------------------------
+  def merge( self, other ):
+    """Add the values recorded by another histogram"""
+    for index, count in other.counts.iteritems():
+      self.counts[index] = self.counts.get( index, 0 ) + count
+    self.total += other.total
+    self.sum   += other.sum
+    if other.min is not None and (self.min is None or other.min < self.min):
+      self.min = other.min
+    if other.max is not None and (self.max is None or other.max > self.max):
+      self.max = other.max
+
+  #-----------------------------------------------------------------------------
+  def percentiles( self, percents ):
+    """Return the values at the given ascending percentiles"""
+    result = []
+    if not self.total:
+      return [0] * len( percents )
+    indices = sorted( self.counts.keys() )
+    seen    = 0
+    i       = 0
+    for percent in percents:
+      target = max( 1, int( round( percent / 100.0 * self.total ) ) )
+      while seen + self.counts[indices[i]] < target:
+        seen += self.counts[indices[i]]
+        i    += 1
+      result.append( min( self.highest( indices[i] ), self.max ) )
+    return result
+
+  #-----------------------------------------------------------------------------
+  def percentile( self, percent ):
+    return self.percentiles( [percent] )[0]
+
+  #-----------------------------------------------------------------------------
+  def mean( self ):
+    if not self.total:
+      return 0.0
+    return float( self.sum ) / self.total
+
+#-------------------------------------------------------------------------------
+class OperationStatistics( object ):
+  """Counters of a single request type"""
+
+  #-----------------------------------------------------------------------------
+  def __init__( self ):
+    self.ops       = 0
+    self.errors    = 0
+    self.bytes     = 0
+    self.histogram = LatencyHistogram()
+
+  #-----------------------------------------------------------------------------
+  def merge( self, other ):
+    self.ops    += other.ops
+    self.errors += other.errors
+    self.bytes  += other.bytes
+    self.histogram.merge( other.histogram )
+
+#-------------------------------------------------------------------------------
+class LoadStatistics( object ):
+  """Thread-safe per request type counters and latency histograms, for the
+  whole run and for the current reporting interval; the label tells in the
+  reports what the latencies have been measured from"""
+
+  PERCENTILES = [50.0, 90.0, 99.0, 99.9]
+
+  #-----------------------------------------------------------------------------
+  def __init__( self, interval = None, label = 'latencies' ):
+    self.lock          = threading.Lock()
+    self.interval      = interval
+    self.label         = label
+    self.start         = time.time()
+    self.intervalStart = self.start
+    self.total         = {}
+    self.current       = {}
+
+  #-----------------------------------------------------------------------------
+  def record( self, type, seconds, numBytes = 0, failed = False ):
+    """Record a finished operation of the given type"""
+    self.lock.acquire()
+    try:
+      stats = self.current.get( type )
+      if stats is None:
+        stats = self.current[type] = OperationStatistics()
+      stats.ops   += 1
+      stats.bytes += numBytes
+      if failed:
+        stats.errors += 1
+      stats.histogram.record( seconds * 1e6 )
+    finally:
+      self.lock.release()
+
+  #-----------------------------------------------------------------------------
+  def rollInterval( self ):
+    """Fold the current interval into the totals, return its counters and
+    length; must be called with the lock held"""
+    now      = time.time()
+    current  = self.current
+    duration = now - self.intervalStart
+    for type, stats in current.iteritems():
+      if type not in self.total:
+        self.total[type] = OperationStatistics()
+      self.total[type].merge( stats )
+    self.current       = {}
+    self.intervalStart = now
+    return current, duration
+
+  #-----------------------------------------------------------------------------
+  def intervalReport( self, force = False ):
+    """Return the report of the current interval if it is due, None
+    otherwise"""
+    if not force and (self.interval is None or
+                      time.time() - self.intervalStart < self.interval):
+      return None
+    self.lock.acquire()
+    try:
+      if not force and time.time() - self.intervalStart < self.interval:
+        return None
+      start = self.intervalStart - self.start
+      current, duration = self.rollInterval()
+    finally:
+      self.lock.release()
+    return formatReport( 'Interval %.1f-%.1fs' % (start, start + duration),
+                         current, duration, self.PERCENTILES, self.label )
+
+  #-----------------------------------------------------------------------------
+  def finalReport( self ):
+    """Return the report of the whole run"""
+    self.lock.acquire()
+    try:
+      self.rollInterval()
+      duration = time.time() - self.start
+      total    = dict( self.total )
+    finally:
+      self.lock.release()
+    return formatReport( 'Total %.1fs' % duration, total, duration,
+                         self.PERCENTILES, self.label )
+
+#-------------------------------------------------------------------------------
+def formatReport( title, statistics, duration, percents,
+                  label = 'latencies' ):
+  """Format a table of the operation statistics, latencies in milliseconds"""
+  duration = max( duration, 1e-9 )
+  header   = '%-10s %9s %10s %9s %7s %9s' % ('type', 'ops', 'ops/s', 'MB/s',
+                                             'errors', 'mean') + \
+             ''.join( [' %9s' % ('p%g' % p) for p in percents] ) + \
+             ' %9s' % ('max')
+  lines = ['[i] %s, %s in ms' % (title, label), header]
+  total = OperationStatistics()
+  for type in sorted( statistics.keys() ) + ['all']:
+    if type == 'all':
+      if len( statistics ) < 2:
+        break
+      stats = total
+    else:
+      stats = statistics[type]
+      total.merge( stats )
+    hist = stats.histogram
+    line = '%-10s %9d %10.1f %9.2f %7d %9.3f' % \
+           (type, stats.ops, stats.ops / duration,
+            stats.bytes / duration / 1024.0 / 1024.0, stats.errors,
+            hist.mean() / 1000.0)
+    line += ''.join( [' %9.3f' % (v / 1000.0)
+                      for v in hist.percentiles( percents )] )
+    line += ' %9.3f' % ((hist.max or 0) / 1000.0)
+    lines.append( line )
+  return '\n'.join( lines )
@@ -0,0 +1,311 @@
+#-------------------------------------------------------------------------------
+# Copyright (c) 2011-2013 by European Organization for Nuclear Research (CERN)
+# Author: Lukasz Janyst <ljanyst@cern.ch>
+#-------------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+"""
+Registry of precompiled struct.Struct codecs for the XProtocol message
+layouts.
+
+A layout is a tuple of XProtocol struct names, ie.
+('ClientRequestHdr', 'ClientOpenRequest'), optionally with some of the fields
+excluded. The part of the layout preceding the first variable-size ('dlen')
+field is compiled once, the tail is compiled on demand for every distinct
+combination of variable field lengths and cached.
+"""
+
+import struct
+import copy
+
+from collections import namedtuple
+
+import XProtocol
+
+#-------------------------------------------------------------------------------
+# Maximum number of compiled tails kept per codec
+#-------------------------------------------------------------------------------
+MAX_TAILS = 512
+
+#-------------------------------------------------------------------------------
+# Hit/miss counters: 'layout' counts codec lookups, 'tail' counts lookups
+# of the compiled variable parts
+#-------------------------------------------------------------------------------
+stats = { 'layoutHits': 0, 'layoutMisses': 0, 'tailHits': 0, 'tailMisses': 0 }
+
+#-------------------------------------------------------------------------------
+class CodecException( Exception ):
+  def __init__( self, value ):
+    self.value = value
+
+  def __str__( self ):
+    return repr( self.value )
+
+#-------------------------------------------------------------------------------
+def fieldFormat( field, length = None ):
+  """Return the struct format of a single field, variable-size fields take
+  the given length"""
+  size = field.get( 'size' )
+  if size == 'dlen':
+    size = length
+  if size is None:
+    return field['type']
+  return str( size ) + field['type']
+
+#-------------------------------------------------------------------------------
+class MessageCodec( object ):
+  """Precompiled packer/unpacker for a single message layout"""
+
+  #-----------------------------------------------------------------------------
+  def __init__( self, layout, fields ):
+    self.layout   = layout
+    self.fields   = fields
+    self.names    = tuple( [f['name'] for f in fields] )
+    self.variable = tuple( [i for i, f in enumerate( fields )
+                            if f.get( 'size' ) == 'dlen'] )
+
+    if self.variable:
+      first = self.variable[0]
+    else:
+      first = len( fields )
+
+    self.prefix     = struct.Struct( '>' + ''.join( [fieldFormat( f )
+                                                     for f in fields[:first]] ) )
+    self.prefixLen  = first
+    self.tailFields = fields[first:]
+    self.fixedSize  = self.prefix.size + \
+                      struct.calcsize( '>' + ''.join( [fieldFormat( f, 0 )
+                                                       for f in self.tailFields] ) )
+
+    #---------------------------------------------------------------------------
+    # A single trailing string does not need packing at all, we just append
+    # the bytes to the prefix
+    #---------------------------------------------------------------------------
+    self.rawTail = len( self.tailFields ) == 1 and \
+                   self.tailFields[0]['type'] == 's'
+    self.tails   = {}
+    self.records = {}
+    self.spans   = {}
+
+    #---------------------------------------------------------------------------
+    # Structs and offsets of the individual prefix fields, for decoding
+    # single fields
+    #---------------------------------------------------------------------------
+    self.index        = dict( [(f['name'], i) for i, f in enumerate( fields )] )
+    self.fieldStructs = []
+    offset = 0
+    for f in fields[:first]:
+      fieldStruct = struct.Struct( '>' + fieldFormat( f ) )
+      self.fieldStructs.append( (fieldStruct, offset) )
+      offset += fieldStruct.size
+
+  #-----------------------------------------------------------------------------
+  def getRecordType( self, typeName, extra = () ):
+    """Get the named tuple class holding the decoded messages of this layout,
+    preceded by the type field and followed by the extra fields"""
+    key    = (typeName, extra)
+    record = self.records.get( key )
+    if record is None:
+      record = namedtuple( typeName, ('type',) + self.names + extra )
+      self.records[key] = record
+    return record
+
+  #-----------------------------------------------------------------------------
+  def getTail( self, lengths ):
+    """Get the compiled struct of the variable part for the given lengths"""
+    tail = self.tails.get( lengths )
+    if tail is not None:
+      stats['tailHits'] += 1
+      return tail
+
+    stats['tailMisses'] += 1
+    if len( lengths ) != len( self.variable ):
+      raise CodecException( 'Layout %s has %d variable fields, got %d lengths' %
+                            (str(self.layout), len(self.variable), len(lengths)) )
+
+    format = '>'
+    lengthIter = iter( lengths )
+    for f in self.tailFields:
+      if f.get( 'size' ) == 'dlen':
+        format += fieldFormat( f, lengthIter.next() )
+      else:
+        format += fieldFormat( f )
+
+    if len( self.tails ) >= MAX_TAILS:
+      self.tails.clear()
+    tail = struct.Struct( format )
+    self.tails[lengths] = tail
+    return tail
+
+  #-----------------------------------------------------------------------------
+  def format( self, lengths = () ):
+    """Return the full struct format string for the given lengths"""
+    if not self.variable:
+      return self.prefix.format
+    return self.prefix.format + self.getTail( lengths ).format[1:]
+
+  #-----------------------------------------------------------------------------
+  def size( self, lengths = () ):
+    """Return the size of the packed message for the given lengths"""
+    return self.fixedSize + sum( lengths )
+
+  #-----------------------------------------------------------------------------
+  def inferLengths( self, blobLength ):
+    """Compute the variable field lengths from the size of the blob, only
+    possible if there is at most one variable field"""
+    if not self.variable:
+      return ()
+    if len( self.variable ) > 1:
+      raise CodecException( 'Cannot infer lengths of %d variable fields' %
+                            (len(self.variable)) )
+    return (blobLength - self.fixedSize,)
+
+  #-----------------------------------------------------------------------------
+  def fieldSpans( self, lengths = () ):
+    """Return the (start, end) byte offsets of every field in the packed
+    message for the given lengths"""
+    spans = self.spans.get( lengths )
+    if spans is not None:
+      return spans
+
+    spans      = []
+    offset     = 0
+    lengthIter = iter( lengths )
+    for f in self.fields:
+      if f.get( 'size' ) == 'dlen':
+        size = struct.calcsize( '>' + fieldFormat( f, lengthIter.next() ) )
+      else:
+        size = struct.calcsize( '>' + fieldFormat( f ) )
+      spans.append( (offset, offset + size) )
+      offset += size
+
+    if len( self.spans ) >= MAX_TAILS:
+      self.spans.clear()
+    spans = tuple( spans )
+    self.spans[lengths] = spans
+    return spans
+
+  #-----------------------------------------------------------------------------
+  def pack( self, values, lengths = () ):
+    """Pack the values given in the field order"""
+    prefix = self.prefix.pack( *values[:self.prefixLen] )
+    if not self.tailFields:
+      return prefix
+
+    tailValues = values[self.prefixLen:]
+    if self.rawTail and len( tailValues[0] ) == lengths[0]:
+      stats['tailHits'] += 1
+      return prefix + tailValues[0]
+    return prefix + self.getTail( lengths ).pack( *tailValues )
+
+  #-----------------------------------------------------------------------------
+  def unpack( self, blob, lengths = None ):
+    """Unpack the blob to a tuple of values in the field order"""
+    if lengths is None:
+      lengths = self.inferLengths( len( blob ) )
+
+    if not self.tailFields:
+      return self.prefix.unpack( blob )
+
+    if len( blob ) != self.size( lengths ) or min( lengths ) < 0:
+      raise struct.error( 'unpack requires a string argument of length %d' %
+                          (self.size( lengths )) )
+
+    prefix = self.prefix.unpack_from( blob )
+    if self.rawTail:
+      stats['tailHits'] += 1
+      return prefix + (blob[self.prefix.size:],)
+    return prefix + self.getTail( lengths ).unpack_from( blob,
+                                                          self.prefix.size )
+
+  #-----------------------------------------------------------------------------
+  def unpackField( self, blob, name ):
+    """Unpack a single field of the blob, raises KeyError if there is no such
+    field"""
+    i = self.index[name]
+    if i < self.prefixLen:
+      fieldStruct, offset = self.fieldStructs[i]
+      return fieldStruct.unpack_from( blob, offset )[0]
+    if self.rawTail:
+      return blob[self.prefix.size:]
+    return self.unpack( blob )[i]
+
+#-------------------------------------------------------------------------------
+# Pristine copies of the XProtocol structs taken at import, before anyone
+# had the chance to patch field attributes
+#-------------------------------------------------------------------------------
+_structs = {}
+for _name in dir( XProtocol ):
+  _obj = getattr( XProtocol, _name )
+  if isinstance( _obj, list ) and _obj and isinstance( _obj[0], dict ):
+    _structs[_name] = copy.deepcopy( _obj )
+
+_codecs = {}
+
+#-------------------------------------------------------------------------------
+def hasStruct( name ):
+  """Check if XProtocol defines a struct of the given name"""
+  return _structs.has_key( name )
+
+#-------------------------------------------------------------------------------
+def buildCodec( layout, exclude = () ):
+  """Compile a codec for the given layout skipping the excluded fields"""
+  fields = []
+  for name in layout:
+    if not _structs.has_key( name ):
+      raise CodecException( 'Struct ' + name + ' not found' )
+    fields += [f for f in _structs[name] if f['name'] not in exclude]
+  return MessageCodec( layout, fields )
+
+#-------------------------------------------------------------------------------
+def getCodec( layout, exclude = () ):
+  """Get the codec for the given layout, compiling it if necessary"""
+  key   = (layout, exclude)
+  codec = _codecs.get( key )
+  if codec is not None:
+    stats['layoutHits'] += 1
+    return codec
+
+  stats['layoutMisses'] += 1
+  codec = buildCodec( layout, exclude )
+  _codecs[key] = codec
+  return codec
+
+#-------------------------------------------------------------------------------
+def getStatistics():
+  """Return a copy of the hit/miss counters together with the number of
+  compiled layouts"""
+  result = dict( stats )
+  result['layouts'] = len( _codecs )
+  return result
+
+#-------------------------------------------------------------------------------
+def _precompile():
+  """Compile the codecs for all the known message layouts"""
+  for name in _structs.keys():
+    _codecs[((name,), ())] = buildCodec( (name,) )
+    if name.startswith( 'Client' ) and name.endswith( 'Request' ) and \
+       name != 'ClientRequestHdr':
+      layout = ('ClientRequestHdr', name)
+      _codecs[(layout, ())] = buildCodec( layout )
+    elif name.startswith( 'ServerResponseBody_' ) or \
+         name == 'ServerInitHandShake':
+      layout = ('ServerResponseHeader', name)
+      _codecs[(layout, ())] = buildCodec( layout )
+
+  layout = ('ClientRequestHdr', 'ClientReadRequest', 'read_args')
+  _codecs[(layout, ())] = buildCodec( layout )
+
+_precompile()
@@ -18,6 +18,7 @@
 #-------------------------------------------------------------------------------
 
 import sys
+import errno
 import struct
 import socket
 import logging
@@ -25,10 +26,32 @@ import logging
 from struct import error
 from collections import namedtuple
 from Utils import flatten, struct_format, formatLength, getRequestId, \
-                  getResponseId, getMessageStruct, get_attncode
+                  getResponseId, getMessageStruct, getAttnCode
+from MessageCodec import getCodec, CodecException
 import Utils
 
+from AsyncEngine import Return, ReadWait, WriteWait
 import XProtocol
+import MessageCodec
+import Capture
+
+handShakeStruct = struct.Struct( '>iiiii' )
+lengthStruct    = struct.Struct( '>l' )
+requestIdStruct = struct.Struct( '>H' )
+
+headerStruct    = struct.Struct( '>HH' )
+
+ChunkRequest    = namedtuple( 'chunk_request', 'fhandle length offset' )
+readListStruct  = getCodec( ('read_list',) ).prefix
+
+#-------------------------------------------------------------------------------
+def unpackReadVChunks( data ):
+  """Unpack the list of chunks of a readv request"""
+  if len( data ) % readListStruct.size:
+    raise MessageException( 'Malformed readv request: %d bytes of chunks' %
+                            (len(data)) )
+  return [ChunkRequest( *readListStruct.unpack_from( data, x ) )
+          for x in range( 0, len( data ), readListStruct.size )]
 
 #-------------------------------------------------------------------------------
 class MessageException( Exception ):
@@ -38,6 +61,90 @@ class MessageException( Exception ):
   def __str__( self ):
     return repr( self.value )
 
+#-------------------------------------------------------------------------------
+class LazyRequest( object ):
+  """Client request with only the header decoded, the body fields are
+  unpacked from the raw message on first access. Exposes the same fields as
+  the named tuples returned by MessageHelper.unpackRequest and turns into one
+  when iterated, indexed or repr'ed; str only shows what has been decoded
+  so far."""
+
+  __slots__ = ['type', 'streamid', 'requestid', 'raw', 'codec', 'values',
+               'record']
+
+  #-----------------------------------------------------------------------------
+  def __init__( self, type, streamid, requestid, raw, codec ):
+    self.type      = type
+    self.streamid  = streamid
+    self.requestid = requestid
+    self.raw       = raw
+    self.codec     = codec
+    self.values    = {}
+    self.record    = None
+
+  #-----------------------------------------------------------------------------
+  def __getattr__( self, name ):
+    values = self.values
+    if name in values:
+      return values[name]
+
+    try:
+      if name == 'chunks' and \
+         self.requestid == XProtocol.XRequestTypes.kXR_readv:
+        value = unpackReadVChunks( self.codec.unpackField( self.raw, 'data' ) )
+      else:
+        value = self.codec.unpackField( self.raw, name )
+    except KeyError:
+      raise AttributeError( name )
+    except (error, TypeError, CodecException), e:
+      raise MessageException( str( e ) )
+
+    values[name] = value
+    return value
+
+  #-----------------------------------------------------------------------------
+  def materialize( self ):
+    """Decode everything and return the named tuple"""
+    if self.record is None:
+      try:
+        values = self.codec.unpack( self.raw )
+      except (error, TypeError, CodecException), e:
+        raise MessageException( str( e ) )
+      extra = ()
+      if self.requestid == XProtocol.XRequestTypes.kXR_readv:
+        extra   = ('chunks',)
+        values += (unpackReadVChunks( values[-1] ),)
+      record = self.codec.getRecordType( 'request', extra )
+      self.record = record( self.type, *values )
+    return self.record
+
+  #-----------------------------------------------------------------------------
+  def _asdict( self ):
+    return self.materialize()._asdict()
+
+  def __iter__( self ):
+    return iter( self.materialize() )
+
+  def __getitem__( self, key ):
+    return self.materialize()[key]
+
+  def __len__( self ):
+    return len( self.materialize() )
+
+  def __repr__( self ):
+    return repr( self.materialize() )
+
+  def __nonzero__( self ):
+    return True
+
+  def __str__( self ):
+    if self.record is not None:
+      return str( self.record )
+    values = ''.join( [', %s=%r' % item
+                       for item in sorted( self.values.items() )] )
+    return 'request(type=%r, streamid=%r%s, ...)' % (self.type, self.streamid,
+                                                     values)
+
 #-------------------------------------------------------------------------------
 class MessageHelper:
 
@@ -45,9 +152,61 @@ class MessageHelper:
   def __init__(self, context):
     self.sock   = context['socket']
     self.logger = Utils.setupLogger( __name__ )
+    self.buffer = bytearray()
+    self.view   = memoryview( self.buffer )
+
+    #---------------------------------------------------------------------------
+    # Output queue and its counters
+    #---------------------------------------------------------------------------
+    self.outBuffer     = bytearray()
+    self.outMessages   = 0
+    self.flushBytes    = None
+    self.flushMessages = None
+    self.counters      = {'bytes': 0, 'syscalls': 0, 'messages': 0,
+                          'flushes': 0}
+
+    #---------------------------------------------------------------------------
+    # Capture of the messages, shared by all the helpers of the connection
+    #---------------------------------------------------------------------------
+    self.capture   = context.get( 'capture' ) or Capture.writer
+    self.captureId = None
+    if self.capture is not None:
+      if 'captureId' not in context:
+        context['captureId'] = self.capture.newConnection()
+      self.captureId = context['captureId']
+
+  #-----------------------------------------------------------------------------
+  def getStructCodec( self, messageStruct ):
+    """Return the precompiled codec matching the message struct or None
+    if the struct cannot be mapped onto one"""
+    layout = getattr( messageStruct, 'layout', None )
+    if layout is None:
+      return None
+    return getCodec( layout, messageStruct.exclude )
+
+  #-----------------------------------------------------------------------------
+  def getStructLengths( self, codec, messageStruct, params = None ):
+    """Return the lengths of the variable-size fields, either as set with
+    setFieldAttribute or taken from the parameters. Returns None if the
+    lengths cannot be established."""
+    lengths = []
+    for i in codec.variable:
+      size = messageStruct[i].get( 'size' )
+      if size == 'dlen':
+        if params is None:
+          return None
+        size = len( params[messageStruct[i]['name']] )
+      lengths.append( size )
+    return tuple( lengths )
 
   #-----------------------------------------------------------------------------
   def getMessageFormat( self, messageStruct ):
+    codec = self.getStructCodec( messageStruct )
+    if codec:
+      lengths = self.getStructLengths( codec, messageStruct )
+      if lengths is not None:
+        return codec.format( lengths )
+
     format = '>'
 
     for member in messageStruct:
@@ -73,6 +232,15 @@ class MessageHelper:
       self.logger.error( "params (%d):        %s" % (len(params), params) )
       raise MessageException( "Wrong number of parameters" )
 
+    codec = self.getStructCodec( messageStruct )
+    if codec:
+      try:
+        messageData = [params[name] for name in codec.names]
+        lengths     = self.getStructLengths( codec, messageStruct, params )
+        return (codec.format( lengths ), messageData, codec.size( lengths ))
+      except (error, TypeError, CodecException), e:
+        raise MessageException( str( e ) )
+
     messageData = []
     format = '>'
 
@@ -100,6 +268,15 @@ class MessageHelper:
       self.logger.error( "params (%d):        %s" % (len(params), params) )
       raise MessageException( "Wrong number of parameters" )
 
+    codec = self.getStructCodec( messageStruct )
+    if codec:
+      try:
+        return codec.pack( [params[name] for name in codec.names],
+                           self.getStructLengths( codec, messageStruct,
+                                                  params ) )
+      except (error, TypeError, CodecException), e:
+        raise MessageException( str( e ) )
+
     messageData = []
     format = '>'
 
@@ -115,10 +292,17 @@ class MessageHelper:
 
   #-----------------------------------------------------------------------------
   def setFieldAttribute( self, messageStruct, fieldName, attrName, attrVal ):
+    #---------------------------------------------------------------------------
+    # The codecs understand sizing of the variable fields, anything else
+    # alters the layout
+    #---------------------------------------------------------------------------
+    codec   = self.getStructCodec( messageStruct )
     attrSet = False
-    for f in messageStruct:
+    for i, f in enumerate( messageStruct ):
       if f['name'] != fieldName:
         continue
+      if codec and not (attrName == 'size' and i in codec.variable):
+        messageStruct.layout = None
       f[attrName] = attrVal
       attrSet = True
     if not attrSet:
@@ -127,14 +311,106 @@ class MessageHelper:
 
   #-----------------------------------------------------------------------------
   def removeFields( self, messageStruct, toBeRemoved ):
-    return [f for f in messageStruct if f['name'] not in toBeRemoved]
+    fields = [f for f in messageStruct if f['name'] not in toBeRemoved]
+    layout = getattr( messageStruct, 'layout', None )
+    if layout is None:
+      return fields
+    exclude = set( messageStruct.exclude )
+    exclude.update( [f['name'] for f in messageStruct
+                     if f['name'] in toBeRemoved] )
+    return Utils.MessageStruct( fields, layout, tuple( sorted( exclude ) ) )
 
   #-----------------------------------------------------------------------------
   def sendMessage(self, message):
-    """Send a packed binary message."""
+    """Send a packed binary message together with everything queued before
+    it, making sure all of it is delivered."""
+    self.logger.debug( "Message size: %s" % (len(message)) )
+    if self.capture is not None:
+      self.capture.record( self.captureId, Capture.SENT, message )
+    if self.outBuffer:
+      self.outBuffer.extend( message )
+      self.outMessages += 1
+      self.flush()
+    else:
+      self.counters['messages'] += 1
+      self.sendAll( message )
+
+  #-----------------------------------------------------------------------------
+  def queueMessage( self, message ):
+    """Queue a packed binary message to be sent with the next flush,
+    flushes automatically if one of the auto-flush thresholds is reached."""
+    if self.capture is not None:
+      self.capture.record( self.captureId, Capture.SENT, message )
+    self.outBuffer.extend( message )
+    self.outMessages += 1
+    if (self.flushBytes is not None and
+        len( self.outBuffer ) >= self.flushBytes) or \
+       (self.flushMessages is not None and
+        self.outMessages >= self.flushMessages):
+      self.flush()
+
+  #-----------------------------------------------------------------------------
+  def setAutoFlush( self, numBytes = None, numMessages = None ):
+    """Set the thresholds of queued bytes or messages triggering a flush,
+    None disables the threshold"""
+    self.flushBytes    = numBytes
+    self.flushMessages = numMessages
+
+  #-----------------------------------------------------------------------------
+  def flush( self ):
+    """Send all the queued messages at once"""
+    if not self.outBuffer:
+      return
+    self.counters['messages'] += self.outMessages
+    self.counters['flushes']  += 1
+    try:
+      self.sendAll( self.outBuffer )
+    finally:
+      self.outBuffer   = bytearray()
+      self.outMessages = 0
+
+  #-----------------------------------------------------------------------------
+  def sendFrames( self, frames ):
+    """Send the messages given as sequences of buffers, ie. a response
+    header followed by a buffer of a mapped file, without joining them"""
+    for part in self.frameParts( frames ):
+      self.flush()
+      self.sendAll( part )
+    self.flush()
+
+  #-----------------------------------------------------------------------------
+  def frameParts( self, frames, copyLimit = 16384 ):
+    """Queue the parts of the frames smaller than copyLimit, ie. the
+    headers, and yield the larger ones to be sent as they are once the queue
+    has been flushed"""
+    for frame in frames:
+      if self.capture is not None:
+        message = bytearray()
+        for part in frame:
+          message += part
+        self.capture.record( self.captureId, Capture.SENT, message )
+      self.outMessages += 1
+      for part in frame:
+        if len( part ) < copyLimit:
+          self.outBuffer += part
+        else:
+          yield part
+
+  #-----------------------------------------------------------------------------
+  def sendAll( self, data ):
+    """Send the data handling short writes"""
+    view = memoryview( data )
     try:
-      self.logger.debug( "Message size: %s" % (len(message)) )
-      self.sock.send(message)
+      while len( view ):
+        try:
+          sent = self.sock.send( view )
+        except socket.error, e:
+          if e.args[0] == errno.EINTR:
+            continue
+          raise
+        self.counters['syscalls'] += 1
+        self.counters['bytes']    += sent
+        view = view[sent:]
     except socket.error, e:
       raise MessageException( str(e) )
 
@@ -142,178 +418,313 @@ class MessageHelper:
   def isHandShake( self, message ):
     """Check if the message is a handshake"""
     if len( message ) != 20:
-      return false
-    decodedMsg = struct.unpack( ">iiiii", message )
-    return decodedMsg == ( 0, 0, 0, 4, 2012 )
+      return False
+    return handShakeStruct.unpack_from( message ) == ( 0, 0, 0, 4, 2012 )
 
   #-----------------------------------------------------------------------------
-  def readBytes( self, numBytes ):
-    """Get bytes from the socket"""
-    message   = str()
-    bytesLeft = numBytes
-    while bytesLeft:
-      msg       = self.sock.recv( bytesLeft )
+  def reserveBuffer( self, size, keep = 0 ):
+    """Make sure the receive buffer can hold size bytes, preserving the
+    first keep bytes"""
+    if len( self.buffer ) >= size:
+      return
+    newBuffer = bytearray( max( size, 2 * len( self.buffer ), 4096 ) )
+    newBuffer[:keep] = self.buffer[:keep]
+    self.buffer = newBuffer
+    self.view   = memoryview( newBuffer )
+
+  #-----------------------------------------------------------------------------
+  def readInto( self, view ):
+    """Fill the memoryview with bytes from the socket"""
+    while len( view ):
+      received = self.sock.recv_into( view )
       # python's way of saying a connection is broken
-      if msg == '':
+      if not received:
         raise MessageException( 'Connection closed by peer' )
-      message   += msg
-      bytesLeft -= len( msg )
-    return message
+      view = view[received:]
 
   #-----------------------------------------------------------------------------
-  def receiveMessage( self ):
-    """Receive a client message from the connection socket"""
+  def readBytes( self, numBytes ):
+    """Get bytes from the socket"""
+    message = bytearray( numBytes )
+    self.readInto( memoryview( message ) )
+    return str( message )
+
+  #-----------------------------------------------------------------------------
+  def readFrame( self, headerLen ):
+    """Read the rest of a message whose header (ending with the payload
+    length) has been read to the receive buffer up to headerLen"""
+    payloadLen = lengthStruct.unpack_from( self.buffer, headerLen - 4 )[0]
+    self.logger.debug( 'Received message header, payload size: %d' %
+                       (payloadLen) )
+    if payloadLen < 0:
+      raise MessageException( 'Invalid payload size: %d' % payloadLen )
+    self.reserveBuffer( headerLen + payloadLen, headerLen )
+    self.readInto( self.view[headerLen:headerLen + payloadLen] )
+    return self.view[:headerLen + payloadLen]
+
+  #-----------------------------------------------------------------------------
+  def receiveMessageView( self ):
+    """Receive a client message to the receive buffer and return a
+    memoryview of it. The view is only valid until the next receive."""
     try:
-      message = self.readBytes( 20 )
-      if self.isHandShake( message ):
+      self.reserveBuffer( 24 )
+      self.readInto( self.view[:20] )
+      if self.isHandShake( self.view[:20] ):
         self.logger.debug( 'Received XRootD client handshake' )
-        return message
-      payloadLenMsg = self.readBytes( 4 )
-      message += payloadLenMsg
-      payloadLen = struct.unpack( ">i", payloadLenMsg )
+        message = self.view[:20]
+      else:
+        self.readInto( self.view[20:24] )
+        message = self.readFrame( 24 )
+      if self.capture is not None:
+        self.capture.record( self.captureId, Capture.RECEIVED, message )
+      return message
 
-      self.logger.debug( 'Received message header, payload size: %d' %
-                         (payloadLen) )
+    except socket.error, e:
+      self.logger.error( 'Error receiving message: %s' % e )
+      raise MessageException( str(e) )
 
-      message += self.readBytes( payloadLen[0] )
-      self.logger.debug( 'Received message message of size: %d' %
-                         (len(message)) )
+  #-----------------------------------------------------------------------------
+  def receiveMessage( self ):
+    """Receive a client message from the connection socket"""
+    return self.receiveMessageView().tobytes()
 
+  #-----------------------------------------------------------------------------
+  def receiveResponseView( self ):
+    """Receive a server response to the receive buffer and return a
+    memoryview of it. The view is only valid until the next receive."""
+    try:
+      self.reserveBuffer( 8 )
+      self.readInto( self.view[:8] )
+      message = self.readFrame( 8 )
+      if self.capture is not None:
+        self.capture.record( self.captureId, Capture.RECEIVED, message )
+      return message
     except socket.error, e:
-      self.logger.error( 'Error receiving message: %s' % e )
+      self.logger.error( 'Error receiving response: %s' % e )
       raise MessageException( str(e) )
 
-    return message
+  #-----------------------------------------------------------------------------
+  def receiveResponse( self ):
+    """Receive a server response from the connection socket"""
+    return self.receiveResponseView().tobytes()
+
+  #=============================================================================
+  # Coroutine variants of the transport for non-blocking sockets, to be run
+  # by the AsyncEngine
+  #=============================================================================
+  def sendMessageAsync( self, message ):
+    """Send a packed binary message together with everything queued before
+    it, wait for the socket if it is full"""
+    self.logger.debug( "Message size: %s" % (len(message)) )
+    if self.capture is not None:
+      self.capture.record( self.captureId, Capture.SENT, message )
+    if self.outBuffer:
+      self.outBuffer.extend( message )
+      self.outMessages += 1
+      return self.flushAsync()
+    self.counters['messages'] += 1
+    return self.sendAllAsync( message )
+
+  #-----------------------------------------------------------------------------
+  def flushAsync( self ):
+    """Send all the queued messages at once, wait for the socket if it is
+    full"""
+    data = self.outBuffer
+    if data:
+      self.counters['messages'] += self.outMessages
+      self.counters['flushes']  += 1
+      self.outBuffer   = bytearray()
+      self.outMessages = 0
+    return self.sendAllAsync( data )
+
+  #-----------------------------------------------------------------------------
+  def sendFramesAsync( self, frames ):
+    """Send the messages given as sequences of buffers without joining
+    them, wait for the socket if it is full"""
+    for part in self.frameParts( frames ):
+      yield self.flushAsync()
+      yield self.sendAllAsync( part )
+    yield self.flushAsync()
+
+  #-----------------------------------------------------------------------------
+  def sendAllAsync( self, data ):
+    """Send the data handling short writes, wait for the socket if it is
+    full"""
+    view = memoryview( data )
+    while len( view ):
+      try:
+        sent = self.sock.send( view )
+      except socket.error, e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+          yield WriteWait( self.sock )
+        elif e.args[0] != errno.EINTR:
+          raise MessageException( str(e) )
+        continue
+      self.counters['syscalls'] += 1
+      self.counters['bytes']    += sent
+      view = view[sent:]
+
+  #-----------------------------------------------------------------------------
+  def readBytesAsync( self, numBytes ):
+    """Get bytes from the socket, wait for the socket if there is not enough"""
+    message = bytearray( numBytes )
+    view    = memoryview( message )
+    while len( view ):
+      try:
+        received = self.sock.recv_into( view )
+      except socket.error, e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+          yield ReadWait( self.sock )
+          continue
+        elif e.args[0] == errno.EINTR:
+          continue
+        self.logger.error( 'Error receiving message: %s' % e )
+        raise MessageException( str(e) )
+      if not received:
+        raise MessageException( 'Connection closed by peer' )
+      view = view[received:]
+    raise Return( str( message ) )
+
+  #-----------------------------------------------------------------------------
+  def receiveMessageAsync( self ):
+    """Receive a client message from the connection socket"""
+    message = yield self.readBytesAsync( 20 )
+    if self.isHandShake( message ):
+      self.logger.debug( 'Received XRootD client handshake' )
+    else:
+      payloadLenMsg = yield self.readBytesAsync( 4 )
+      message += payloadLenMsg
+      payloadLen = struct.unpack( ">i", payloadLenMsg )[0]
+      if payloadLen < 0:
+        raise MessageException( 'Invalid payload size: %d' % payloadLen )
+      message += yield self.readBytesAsync( payloadLen )
+    if self.capture is not None:
+      self.capture.record( self.captureId, Capture.RECEIVED, message )
+    raise Return( message )
+
+  #-----------------------------------------------------------------------------
+  def receiveResponseAsync( self ):
+    """Receive a server response from the connection socket"""
+    message = yield self.readBytesAsync( 8 )
+    payloadLen = struct.unpack( ">l", message[4:8] )[0]
+    if payloadLen < 0:
+      raise MessageException( 'Invalid payload size: %d' % payloadLen )
+    message += yield self.readBytesAsync( payloadLen )
+    if self.capture is not None:
+      self.capture.record( self.captureId, Capture.RECEIVED, message )
+    raise Return( message )
 
   #-----------------------------------------------------------------------------
   def unpack_response(self, response_raw, request_raw):
-    """Return an unpacked named tuple representation of a server response."""
+    """Return an unpacked named tuple representation of a server response.
+    The request that generated it may be given packed or unpacked."""
     if not len(response_raw):
       return ''
 
     # Unpack the request that generated this response for reference
-    request = self.unpack_request(request_raw)[0]
-    requestid = get_requestid(request.type)
+    if hasattr(request_raw, 'type'):
+      request = request_raw
+    else:
+      request = self.unpackRequest(request_raw)
+
+    layout, codec, lengths = self.getResponseCodec(response_raw, request)
+    status = headerStruct.unpack_from(response_raw)[1]
+    dlen = lengthStruct.unpack_from(response_raw, 4)[0]
+
+    # Unpack to regular tuple, the payload of the responses with no body
+    # struct goes to the data field
+    names = codec.names
+    try:
+      if len(layout) == 1 and dlen > 0:
+        response_tuple = codec.unpack(response_raw[:codec.fixedSize]) \
+                         + (response_raw[codec.fixedSize:],)
+        names = names + ('data',)
+      else:
+        response_tuple = codec.unpack(response_raw, lengths)
+    except (error, TypeError, CodecException), e:
+      raise MessageException(str(e))
+
+    # Convert to named tuple
+    type = getResponseId(status)
+    response = codec.getRecordType('response', names[len(codec.names):])
+    return response(type, *response_tuple)
+
+  #-----------------------------------------------------------------------------
+  def getResponseCodec(self, response_raw, request):
+    """Return the layout, the codec and the variable field lengths of a
+    packed response to the given unpacked request. A layout consisting of
+    the header only means that the payload, if any, has no body struct."""
+    requestid = getRequestId(request.type)
 
     # Unpack the response header to find the status and data length
-    header_struct = getMessageStruct('ServerResponseHeader')
-    format = '>'
-    for member in header_struct:
-      format += member['type']
-    header = self.unpack(format + (str(len(response_raw) - 8) + 's'),
-                         response_raw)
-    streamid = header[0]
-    status = header[1]
-    dlen = header[2]
-    body = header[-1]
+    header_codec = getCodec(('ServerResponseHeader',))
+    if len(response_raw) < header_codec.prefix.size:
+      raise MessageException('Response too short: %d' % len(response_raw))
+    streamid, status, dlen = header_codec.prefix.unpack_from(response_raw)
 
     # Check if this is a handshake response
     if requestid == XProtocol.XRequestTypes.handshake:
-      body_struct = getMessageStruct('ServerInitHandShake')
+      body_name = 'ServerInitHandShake'
     # Check if this is an asynchronous response
     elif status == XProtocol.XResponseType.kXR_attn:
       # Extract the attn code
-      attncode = self.unpack('>H', body[:2])[0]
-      body_struct = getMessageStruct('ServerResponseBody_Attn_' \
-                               + get_attncode(attncode)[4:])
-      if not body_struct:
-        body_struct = body_struct = getMessageStruct('ServerResponseBody_Attn')
+      attncode = self.unpack('>l', response_raw[8:12])[0]
+      body_name = 'ServerResponseBody_Attn_' + getAttnCode(attncode)[4:]
+      if not MessageCodec.hasStruct(body_name):
+        body_name = 'ServerResponseBody_Attn'
     # Check if this is more than a simple kXR_ok response
     elif status != XProtocol.XResponseType.kXR_ok:
-      body_struct = getMessageStruct('ServerResponseBody_' \
-                               + get_responseid(status)[4:].title())
+      body_name = 'ServerResponseBody_' + getResponseId(status)[4:].title()
     else:
-      body_struct = getMessageStruct('ServerResponseBody_' \
-                               + request.type[4:].title())
+      body_name = 'ServerResponseBody_' + request.type[4:].title()
 
-    if not body_struct: body_struct = list()
-    response_struct = header_struct + body_struct
+    if MessageCodec.hasStruct(body_name):
+      layout = ('ServerResponseHeader', body_name)
+    else:
+      layout = ('ServerResponseHeader',)
 
     # The number of params in a kXR_open response depends on the options that
     # were passed in the request.
+    exclude = ()
     if requestid == XProtocol.XRequestTypes.kXR_open:
       # Remove members from the response struct if the option was not given in
       # the request.
-      response_struct[:] = [m for m in response_struct
-                            if self.option_included(m, request, response_raw)]
-
-    # Build complete format string
-    format = '>'
-    for member in response_struct:
-      if member.has_key('size'):
-        if member['size'] == 'dlen':
-          if member.has_key('offset'):
-            format += str(dlen - member['offset']) + member['type']
-          else:
-            format += str(dlen) + member['type']
-        else:
-          format += str(member['size']) + member['type']
-      else:
-        format += member['type']
-
-    if len(body_struct) == 0 and dlen > 0:
-      format += (str(dlen) + 's')
+      exclude = tuple(sorted([m['name'] for m in getCodec(layout).fields
+                              if not self.option_included(m, request,
+                                                          response_raw)]))
+    codec = getCodec(layout, exclude)
 
-    # Unpack to regular tuple
-    response_tuple = self.unpack(format, response_raw)
-    # Convert to named tuple
-    response_struct.insert(0, {'name': 'type'})
-    type = get_responseid(status)
-    response = namedtuple('response',
-                          ' '.join([m['name'] for m in response_struct]))
-    return response(type, *response_tuple)
+    # Compute the sizes of the variable fields from the header
+    lengths = tuple([dlen - codec.fields[i].get('offset', 0)
+                     for i in codec.variable])
+    return layout, codec, lengths
 
   #-----------------------------------------------------------------------------
   def unpackRequest( self, requestRaw ):
-    """Return an unpacked named tuple representation of a client request."""
+    """Return an unpacked named tuple representation of a client request.
+
+    The request may be given as a memoryview, ie. as returned by
+    receiveMessageView, in which case the variable-size payload field is
+    not copied and is returned as a memoryview as well."""
     if len( requestRaw ) < 20:
       return None
 
     #---------------------------------------------------------------------------
-    # Figure out the request type and build the map of fields
+    # Figure out the request type and pick the codec
     #---------------------------------------------------------------------------
-    requestId = self.unpack('>H', requestRaw[2:4])[0]
+    requestId = requestIdStruct.unpack_from( requestRaw, 2 )[0]
     self.logger.debug( 'Received request with id %d' % (requestId) )
-
-    if requestId == XProtocol.XRequestTypes.handshake:
-      requestStruct = getMessageStruct('ClientInitHandShake')
-      self.logger.debug( 'Mapped request type: handshake' )
-    else:
-      requestType = XProtocol.XRequestTypes.reverseMapping[requestId]
-      requestTypeName = requestType[4:].title()
-      self.logger.debug( 'Mapped request type: %s %s' % (requestType, requestTypeName) )
-      requestStruct  = getMessageStruct( 'ClientRequestHdr' )
-      requestStruct += getMessageStruct( 'Client' + requestTypeName + 'Request' )
-
-    if requestId == XProtocol.XRequestTypes.kXR_read:
-        requestStruct += getMessageStruct( 'read_args' )
-
-    #---------------------------------------------------------------------------
-    # Build unpacking format string for this message
-    #---------------------------------------------------------------------------
-    format = '>'
-    for member in requestStruct:
-      if member.has_key('size'):
-        if member['size'] == 'dlen':
-          format += str(len(requestRaw) - formatLength(format)) \
-                    + member['type']
-        else:
-          format += str(member['size']) + member['type']
-      else:
-        format += member['type']
-    self.logger.debug( 'Unpack format is: %s' % (format) )
+    type, layout = self.getRequestLayout( requestId )
+    self.logger.debug( 'Mapped request type: %s' % (type) )
 
     #---------------------------------------------------------------------------
     # Convert the binary message to a named tupple
     #---------------------------------------------------------------------------
-    requestTuple = self.unpack(format, requestRaw)
-
-    # Convert to named tuple
-    requestStruct.insert( 0, {'name': 'type'} )
-    if requestId == XProtocol.XRequestTypes.handshake:
-      type = 'handshake'
-    else:
-      type = getRequestId( requestId )
+    codec = getCodec( layout )
+    try:
+      requestTuple = codec.unpack( requestRaw )
+    except (error, TypeError, CodecException), e:
+      raise MessageException( str( e ) )
 
     #---------------------------------------------------------------------------
     extra = []
@@ -326,13 +737,44 @@ class MessageHelper:
       extraData.append( e[1] )
       extraFields.append( e[0] )
     requestTuple += tuple( extraData )
-    extraFields  = ' ' + ' '.join( extraFields )
 
-    request = namedtuple('request',
-                         ' '.join([m['name'] for m in requestStruct]) +
-                         extraFields)
+    request = codec.getRecordType( 'request', tuple( extraFields ) )
     return request(type, *requestTuple)
 
+  #-----------------------------------------------------------------------------
+  def getRequestLayout( self, requestId ):
+    """Return the request type and the codec layout of the given request
+    id"""
+    if requestId == XProtocol.XRequestTypes.handshake:
+      return 'handshake', ('ClientInitHandShake',)
+
+    try:
+      type = XProtocol.XRequestTypes.reverseMapping[requestId]
+    except KeyError:
+      raise MessageException( 'Unknown request id: %d' % requestId )
+    layout = ('ClientRequestHdr', 'Client' + type[4:].title() + 'Request')
+    if requestId == XProtocol.XRequestTypes.kXR_read:
+      layout += ('read_args',)
+    return type, layout
+
+  #-----------------------------------------------------------------------------
+  def unpackRequestLazy( self, requestRaw ):
+    """Return a LazyRequest decoding only the request header up front,
+    handshakes are decoded completely. The raw message must stay untouched
+    until the request has been dealt with."""
+    if len( requestRaw ) < 20:
+      return None
+
+    streamId, requestId = headerStruct.unpack_from( requestRaw )
+    if requestId == XProtocol.XRequestTypes.handshake:
+      return self.unpackRequest( requestRaw )
+
+    type, layout = self.getRequestLayout( requestId )
+    codec = getCodec( layout )
+    if len( requestRaw ) < codec.fixedSize:
+      raise MessageException( 'Request too short: %d bytes' % len(requestRaw) )
+    return LazyRequest( type, streamId, requestId, requestRaw, codec )
+
   #-----------------------------------------------------------------------------
   def pack(self, format, values):
     """Try to pack the given values into a binary blob according to the given format string"""
@@ -356,17 +798,8 @@ class MessageHelper:
     self.logger.debug( 'Unpacking %s worth of readv chunks' % (len(data)) )
     if not len(data):
       return []
-    readFormat = self.getMessageFormat( getMessageStruct( 'read_list' ) )
-    readLength = struct.calcsize( readFormat )
-    chunksRaw  = [data[x:x+readLength] for x in range(0, len(data), readLength)]
-    chunkType  = namedtuple( 'chunk_request', 'fhandle length offset' )
-    chunks     = []
-
-    for chunk in chunksRaw:
-      c = chunkType( *self.unpack( readFormat, chunk ) )
-      chunks.append( c )
-
-    self.logger.debug( 'Unpacked %d chunks: %s' % (len(chunksRaw), str(chunks)) )
+    chunks = unpackReadVChunks( data )
+    self.logger.debug( 'Unpacked %d chunks: %s' % (len(chunks), str(chunks)) )
 
     return [('chunks', chunks)]
 
@@ -0,0 +1,151 @@
+#-------------------------------------------------------------------------------
+# Copyright (c) 2011-2013 by European Organization for Nuclear Research (CERN)
+# Author: Lukasz Janyst <ljanyst@cern.ch>
+#-------------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+"""
+Open loop request scheduling over a client pipeline.
+
+A closed loop client sends its next request only once the previous one has
+been answered, so when the server stalls for a second the requests that
+would have been sent during that second are not sent at all and only the one
+that stalled sees the long latency: the measurement coordinates with the
+server and leaves the stall out. The OpenLoopScheduler sends on a timeline
+fixed in advance instead, independent of the responses, and measures every
+latency from the time the request was meant to be sent, so the time the
+requests spend queued behind a stall, in the pipeline or in the client, is
+accounted for, ie.:
+
+  stats     = LoadStatistics()
+  scheduler = OpenLoopScheduler( client.pipeline( depth = 256 ),
+                                 poissonArrivals( 100 ), stats )
+  for intended in scheduler:
+    if intended > deadline:
+      break
+    scheduler.submit( intended, 'stat', 'kXR_stat', path = '/tmp' )
+  scheduler.drain()
+  print stats.finalReport()
+
+The pipeline must be deep enough to hold the requests in flight at the
+target rate, a full pipeline holds the sending back like a closed loop
+would; the scheduler then falls behind its timeline and the latencies show
+it.
+"""
+
+import time
+import random
+import select
+import itertools
+
+import XProtocol
+
+#-------------------------------------------------------------------------------
+def constantArrivals( rate, start = None ):
+  """Generate the intended send times of requests evenly spaced at the given
+  rate a second"""
+  if start is None:
+    start = time.time()
+  interval = 1.0 / rate
+  for i in itertools.count():
+    yield start + i * interval
+
+#-------------------------------------------------------------------------------
+def poissonArrivals( rate, start = None ):
+  """Generate the intended send times of requests arriving as a Poisson
+  process of the given rate a second, ie. with exponential gaps"""
+  intended = time.time() if start is None else start
+  while True:
+    yield intended
+    intended += random.expovariate( rate )
+
+#-------------------------------------------------------------------------------
+# The timelines by name, as given in the scenario descriptions
+#-------------------------------------------------------------------------------
+arrivals = {'constant': constantArrivals, 'poisson': poissonArrivals}
+
+#-------------------------------------------------------------------------------
+class OpenLoopScheduler( object ):
+  """Send the requests of a pipeline on a timeline and record their latency
+  from the intended send time to the final response in stats, and the
+  service time from the actual send time in service if given. size( type,
+  future ) returns the number of bytes to record for a finished request."""
+
+  #-----------------------------------------------------------------------------
+  def __init__( self, pipeline, timeline, stats, service = None, size = None,
+                tolerance = 0.001 ):
+    self.pipeline  = pipeline
+    self.socket    = pipeline.client.context['socket']
+    self.timeline  = timeline
+    self.stats     = stats
+    self.service   = service
+    self.size      = size
+    self.tolerance = tolerance
+    self.counters  = {'requests': 0, 'late': 0, 'maxlag': 0.0}
+
+  #-----------------------------------------------------------------------------
+  def __iter__( self ):
+    """Generate the intended send times, each once it has come"""
+    for intended in self.timeline:
+      self.waitUntil( intended )
+      yield intended
+
+  #-----------------------------------------------------------------------------
+  def waitUntil( self, when ):
+    """Process the responses as they come until the given time"""
+    pipeline = self.pipeline
+    pipeline.flush()
+    while True:
+      timeout = when - time.time()
+      if timeout <= 0:
+        return
+      if not len( pipeline ):
+        time.sleep( timeout )
+        return
+      if select.select( [self.socket], [], [], timeout )[0]:
+        pipeline.dispatch( pipeline.client.receive() )
+
+  #-----------------------------------------------------------------------------
+  def submit( self, intended, type, name, **kwargs ):
+    """Send the request meant to be sent at the intended time right away,
+    the type is the one its latency is recorded for"""
+    future = self.pipeline.submit( name, **kwargs )
+    self.pipeline.flush()
+    sent = time.time()
+
+    lag = sent - intended
+    self.counters['requests'] += 1
+    if lag > self.tolerance:
+      self.counters['late'] += 1
+    self.counters['maxlag'] = max( self.counters['maxlag'], lag )
+
+    future.addCallback( self.completed( type, intended, sent ) )
+    return future
+
+  #-----------------------------------------------------------------------------
+  def completed( self, type, intended, sent ):
+    def callback( future ):
+      now      = time.time()
+      failed   = future.status() != XProtocol.XResponseType.kXR_ok
+      numBytes = self.size( type, future ) if self.size else 0
+      self.stats.record( type, now - intended, numBytes, failed )
+      if self.service is not None:
+        self.service.record( type, now - sent, numBytes, failed )
+    return callback
+
+  #-----------------------------------------------------------------------------
+  def drain( self ):
+    """Wait for all the requests in flight"""
+    self.pipeline.drain()
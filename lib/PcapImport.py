@@ -0,0 +1,450 @@
+#-------------------------------------------------------------------------------
+# Copyright (c) 2011-2013 by European Organization for Nuclear Research (CERN)
+# Author: Lukasz Janyst <ljanyst@cern.ch>
+#-------------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+"""
+Import the XRootD sessions of a libpcap file into a capture file that can be
+replayed with the XRootDReplayClient example, ie.:
+
+  python -m XrdImposter.PcapImport --ports=1094,1095 dump.pcap dump.cap
+
+The pcap records are read one at a time and the TCP streams are reassembled
+on the fly, so the memory footprint depends on the number of open sessions
+and on the size of the largest message only. A session is picked up at its
+SYN or at a segment starting with the client handshake; the client messages
+are recorded as RECEIVED and the server ones as SENT, as if the capture had
+been taken by the server.
+"""
+
+import sys
+import struct
+import getopt
+import socket
+
+import Capture
+import XProtocol
+
+from MessageHelper import MessageHelper, MessageException
+from Utils import setupLogger
+
+#-------------------------------------------------------------------------------
+# Link layer types
+#-------------------------------------------------------------------------------
+LINKTYPE_NULL       = 0
+LINKTYPE_ETHERNET   = 1
+LINKTYPE_RAW        = 101
+LINKTYPE_LOOP       = 108
+LINKTYPE_LINUX_SLL  = 113
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = (0x8100, 0x88a8)
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+
+shortStruct  = struct.Struct( '>H' )
+lengthStruct = struct.Struct( '>l' )
+ipv4Struct   = struct.Struct( '>BxHxxHxBxx4s4s' )
+ipv6Struct   = struct.Struct( '>4xHBx16s16s' )
+tcpStruct    = struct.Struct( '>HHLLBB' )
+handShake    = struct.pack( '>iiiii', 0, 0, 0, 4, 2012 )
+
+#-------------------------------------------------------------------------------
+# Messages larger than this mean that the stream is not XRootD or has been
+# misparsed
+#-------------------------------------------------------------------------------
+MAX_MESSAGE = 256 * 1024 * 1024
+
+#-------------------------------------------------------------------------------
+class PcapException( Exception ):
+  def __init__( self, value ):
+    self.value = value
+
+  def __str__( self ):
+    return repr( self.value )
+
+#-------------------------------------------------------------------------------
+class PcapReader( object ):
+  """Iterate over the (timestamp, frame) records of a pcap file"""
+
+  #-----------------------------------------------------------------------------
+  def __init__( self, f ):
+    self.file = f
+    header    = f.read( 24 )
+    if len( header ) < 24:
+      raise PcapException( 'Truncated pcap header' )
+    for order in ('<', '>'):
+      magic = struct.unpack( order + 'L', header[:4] )[0]
+      if magic in (0xa1b2c3d4, 0xa1b23c4d):
+        break
+    else:
+      raise PcapException( 'Not a pcap file, pcapng is not supported' )
+    self.divisor  = 1e9 if magic == 0xa1b23c4d else 1e6
+    self.linkType = struct.unpack( order + 'L', header[20:24] )[0] & 0xffff
+    self.record   = struct.Struct( order + 'LLLL' )
+
+  #-----------------------------------------------------------------------------
+  def __iter__( self ):
+    read   = self.file.read
+    record = self.record
+    while True:
+      header = read( record.size )
+      if len( header ) < record.size:
+        return
+      seconds, fraction, length, origLength = record.unpack( header )
+      frame = read( length )
+      if len( frame ) < length:
+        return
+      yield seconds + fraction / self.divisor, frame
+
+#-------------------------------------------------------------------------------
+def decodeFrame( linkType, frame ):
+  """Return the source, destination and TCP segment of a frame, None if it
+  does not carry TCP over IP"""
+  #-----------------------------------------------------------------------------
+  # Strip the link layer
+  #-----------------------------------------------------------------------------
+  if linkType == LINKTYPE_ETHERNET:
+    offset    = 14
+    etherType = shortStruct.unpack_from( frame, 12 )[0]
+    while etherType in ETHERTYPE_VLAN:
+      etherType = shortStruct.unpack_from( frame, offset + 2 )[0]
+      offset   += 4
+  elif linkType == LINKTYPE_LINUX_SLL:
+    offset    = 16
+    etherType = shortStruct.unpack_from( frame, 14 )[0]
+  elif linkType == LINKTYPE_LINUX_SLL2:
+    offset    = 20
+    etherType = shortStruct.unpack_from( frame, 0 )[0]
+  elif linkType in (LINKTYPE_NULL, LINKTYPE_LOOP, LINKTYPE_RAW):
+    offset    = 0 if linkType == LINKTYPE_RAW else 4
+    version   = ord( frame[offset] ) >> 4 if len( frame ) > offset else 0
+    etherType = {4: ETHERTYPE_IPV4, 6: ETHERTYPE_IPV6}.get( version )
+  else:
+    raise PcapException( 'Unsupported link type: %d' % linkType )
+
+  #-----------------------------------------------------------------------------
+  # Strip the network layer, fragments and IPv6 extension headers are not
+  # supported
+  #-----------------------------------------------------------------------------
+  if etherType == ETHERTYPE_IPV4:
+    if len( frame ) < offset + ipv4Struct.size:
+      return None
+    versionIhl, totalLength, fragment, protocol, src, dst = \
+      ipv4Struct.unpack_from( frame, offset )
+    if protocol != socket.IPPROTO_TCP or fragment & 0x3fff:
+      return None
+    end     = offset + totalLength
+    offset += (versionIhl & 0x0f) * 4
+    src     = socket.inet_ntop( socket.AF_INET, src )
+    dst     = socket.inet_ntop( socket.AF_INET, dst )
+  elif etherType == ETHERTYPE_IPV6:
+    if len( frame ) < offset + ipv6Struct.size:
+      return None
+    payloadLength, nextHeader, src, dst = \
+      ipv6Struct.unpack_from( frame, offset )
+    if nextHeader != socket.IPPROTO_TCP:
+      return None
+    offset += ipv6Struct.size
+    end     = offset + payloadLength
+    src     = socket.inet_ntop( socket.AF_INET6, src )
+    dst     = socket.inet_ntop( socket.AF_INET6, dst )
+  else:
+    return None
+
+  if len( frame ) < offset + tcpStruct.size + 2:
+    return None
+  return src, dst, frame[offset:end]
+
+#-------------------------------------------------------------------------------
+class TcpStream( object ):
+  """Reassemble one direction of a TCP connection"""
+
+  #-----------------------------------------------------------------------------
+  def __init__( self, seq = None ):
+    self.next    = seq
+    self.pending = {}
+
+  #-----------------------------------------------------------------------------
+  def add( self, seq, data ):
+    """Add a segment, return the data that became contiguous"""
+    if self.next is None:
+      self.next = seq
+    if len( data ) > len( self.pending.get( seq, '' ) ):
+      self.pending[seq] = data
+
+    #---------------------------------------------------------------------------
+    # Consume the segments starting at or before the end of the contiguous
+    # data, the retransmitted parts are trimmed
+    #---------------------------------------------------------------------------
+    result   = []
+    progress = True
+    while progress:
+      progress = False
+      for s in self.pending.keys():
+        behind = (self.next - s) & 0xffffffff
+        if behind < 0x80000000:
+          data = self.pending.pop( s )
+          if behind < len( data ):
+            result.append( data[behind:] )
+            self.next = (self.next + len( data ) - behind) & 0xffffffff
+          progress = True
+          break
+    return ''.join( result )
+
+#-------------------------------------------------------------------------------
+class MessageSplitter( object ):
+  """Split a reassembled stream into XRootD messages"""
+
+  #-----------------------------------------------------------------------------
+  def __init__( self, requests ):
+    self.buffer    = bytearray()
+    self.header    = 24 if requests else 8
+    self.handshake = requests
+
+  #-----------------------------------------------------------------------------
+  def feed( self, data ):
+    """Add data, return the list of complete messages"""
+    self.buffer.extend( data )
+    messages = []
+    offset   = 0
+    buffer   = self.buffer
+    while True:
+      if self.handshake:
+        if len( buffer ) - offset < 20:
+          break
+        self.handshake = False
+        if buffer[offset:offset + 20] == handShake:
+          messages.append( str( buffer[offset:offset + 20] ) )
+          offset += 20
+          continue
+      if len( buffer ) - offset < self.header:
+        break
+      dlen = lengthStruct.unpack_from( buffer, offset + self.header - 4 )[0]
+      if dlen < 0 or dlen > MAX_MESSAGE:
+        raise PcapException( 'Invalid message length: %d' % dlen )
+      end = offset + self.header + dlen
+      if end > len( buffer ):
+        break
+      messages.append( str( buffer[offset:end] ) )
+      offset = end
+    if offset:
+      del buffer[:offset]
+    return messages
+
+#-------------------------------------------------------------------------------
+class Session( object ):
+  """Both directions of an XRootD connection"""
+
+  #-----------------------------------------------------------------------------
+  def __init__( self, connection, clientSeq = None ):
+    self.connection = connection
+    self.client     = TcpStream( clientSeq )
+    self.server     = TcpStream()
+    self.requests   = MessageSplitter( True )
+    self.responses  = MessageSplitter( False )
+    self.closed     = set()
+
+#-------------------------------------------------------------------------------
+class PcapImporter( object ):
+  """Turn the XRootD traffic of pcap records into capture records"""
+
+  #-----------------------------------------------------------------------------
+  def __init__( self, writer, ports = (1094, 1095), maxPending = 4096,
+                decode = False ):
+    self.writer     = writer
+    self.ports      = set( ports )
+    self.maxPending = maxPending
+    self.decode     = decode
+    self.sessions   = {}
+    self.logger     = setupLogger( __name__ )
+    self.mh         = MessageHelper( {'socket': None} )
+    self.counters   = { 'packets': 0, 'segments': 0, 'sessions': 0,
+                        'requests': 0, 'responses': 0, 'unsynced': 0,
+                        'dropped': 0 }
+    self.requestTypes = {}
+
+  #-----------------------------------------------------------------------------
+  def run( self, reader ):
+    """Import all the records of a PcapReader"""
+    for timestamp, frame in reader:
+      self.feed( timestamp, reader.linkType, frame )
+    self.writer.flush()
+    return self.counters
+
+  #-----------------------------------------------------------------------------
+  def feed( self, timestamp, linkType, frame ):
+    """Process a single pcap record"""
+    self.counters['packets'] += 1
+    try:
+      decoded = decodeFrame( linkType, frame )
+    except struct.error:
+      return
+    if decoded is None:
+      return
+    src, dst, segment = decoded
+    sport, dport, seq, ack, dataOffset, flags = \
+      tcpStruct.unpack_from( segment )
+    if dport in self.ports:
+      key, toServer = (src, sport, dst, dport), True
+    elif sport in self.ports:
+      key, toServer = (dst, dport, src, sport), False
+    else:
+      return
+    self.counters['segments'] += 1
+    payload = segment[(dataOffset >> 4) * 4:]
+
+    #---------------------------------------------------------------------------
+    # Find or start the session
+    #---------------------------------------------------------------------------
+    session = self.sessions.get( key )
+    if flags & TCP_SYN:
+      if toServer and not flags & TCP_ACK:
+        self.sessions[key] = Session( self.writer.newConnection(),
+                                      (seq + 1) & 0xffffffff )
+        self.counters['sessions'] += 1
+      elif session is not None and not toServer:
+        session.server.next = (seq + 1) & 0xffffffff
+      return
+    if session is None:
+      if not (toServer and payload.startswith( handShake )):
+        if payload:
+          self.counters['unsynced'] += 1
+        return
+      session = self.sessions[key] = Session( self.writer.newConnection() )
+      self.counters['sessions'] += 1
+
+    #---------------------------------------------------------------------------
+    # Reassemble and split
+    #---------------------------------------------------------------------------
+    try:
+      if payload:
+        if toServer:
+          self.onData( session, session.client, session.requests,
+                       Capture.RECEIVED, seq, payload, timestamp )
+        else:
+          self.onData( session, session.server, session.responses,
+                       Capture.SENT, seq, payload, timestamp )
+    except PcapException, e:
+      self.logger.warning( 'Dropping session %s:%d -> %s:%d: %s' %
+                           (key + (e,)) )
+      self.counters['dropped'] += 1
+      del self.sessions[key]
+      return
+
+    if flags & TCP_RST:
+      del self.sessions[key]
+    elif flags & TCP_FIN:
+      session.closed.add( toServer )
+      if len( session.closed ) == 2:
+        del self.sessions[key]
+
+  #-----------------------------------------------------------------------------
+  def onData( self, session, stream, splitter, direction, seq, payload,
+              timestamp ):
+    data = stream.add( seq, payload )
+    if len( stream.pending ) > self.maxPending:
+      raise PcapException( 'Too many segments missing' )
+    if not data:
+      return
+    for message in splitter.feed( data ):
+      self.writer.record( session.connection, direction, message, timestamp )
+      if direction == Capture.SENT:
+        self.counters['responses'] += 1
+        continue
+      self.counters['requests'] += 1
+      requestId = shortStruct.unpack_from( message, 2 )[0]
+      type = XProtocol.XRequestTypes.reverseMapping.get( requestId, 'unknown' )
+      self.requestTypes[type] = self.requestTypes.get( type, 0 ) + 1
+      if self.decode:
+        try:
+          request = self.mh.unpackRequest( message )
+        except MessageException, e:
+          request = 'undecodable %s request, id %d, header %s: %s' % \
+                    (type, requestId, message[:24].encode( 'hex' ), e)
+        print '[i] %x: %s' % (session.connection, request)
+
+#-------------------------------------------------------------------------------
+def printHelp():
+  print "Usage:"
+  print "  python -m XrdImposter.PcapImport [options] input.pcap output.cap"
+  print "    --ports=PORTS        comma separated server ports, 1094,1095"
+  print "                         by default"
+  print "    --decode             print the unpacked requests"
+  print "    --help               print this help message"
+
+#-------------------------------------------------------------------------------
+def main( argv ):
+  try:
+    opts, args = getopt.getopt( argv, "", ["help", "ports=", "decode"] )
+  except getopt.GetoptError, err:
+    print "[!] Unable to parse commandline:", err
+    printHelp()
+    return 2
+
+  ports  = (1094, 1095)
+  decode = False
+  for o, a in opts:
+    if o == "--help":
+      printHelp()
+      return 0
+    elif o == "--ports":
+      try:
+        ports = [int( p ) for p in a.split( ',' )]
+      except ValueError:
+        print "[!] Invalid ports:", a
+        return 2
+    elif o == "--decode":
+      decode = True
+
+  if len( args ) != 2:
+    printHelp()
+    return 2
+
+  try:
+    f = open( args[0], 'rb' )
+  except IOError, err:
+    print "[!] Unable to open the pcap file:", err
+    return 3
+  try:
+    try:
+      reader = PcapReader( f )
+    except PcapException, err:
+      print "[!] %s: %s" % (args[0], err)
+      return 4
+    writer   = Capture.CaptureWriter( args[1] )
+    importer = PcapImporter( writer, ports, decode = decode )
+    try:
+      counters = importer.run( reader )
+    finally:
+      writer.close()
+  finally:
+    f.close()
+
+  print "[i] %s" % ', '.join( ['%s: %d' % (k, counters[k])
+                               for k in sorted( counters )] )
+  print "[i] Requests: %s" % ', '.join( ['%s: %d' % (k, v) for k, v in
+                                         sorted( importer.requestTypes.items() )] )
+  return 0
+
+#-------------------------------------------------------------------------------
+if __name__ == "__main__":
+  sys.exit( main( sys.argv[1:] ) )
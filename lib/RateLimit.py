@@ -0,0 +1,98 @@
+#-------------------------------------------------------------------------------
+# Copyright (c) 2011-2013 by European Organization for Nuclear Research (CERN)
+# Author: Lukasz Janyst <ljanyst@cern.ch>
+#-------------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+"""
+Pacing of the requests and connections of the active scenarios.
+
+A TokenBucket shared by the clients of a run caps their combined request
+rate: the bucket refills with 'rate' tokens a second up to 'burst' and every
+request takes one. The tokens are reserved under the lock and waited for
+outside of it, so that the clients are served in the order they asked and
+the requests leave on a steady timeline however many clients share it, ie.:
+
+  bucket = TokenBucket( 500, burst = 10 )
+  context['limiter'] = bucket
+  client = ImposterClient( context )   # every send now takes a token
+
+Backoff generates the delays between the attempts to connect.
+"""
+
+import time
+import random
+import threading
+
+#-------------------------------------------------------------------------------
+class RateLimitException( Exception ):
+  def __init__( self, value ):
+    self.value = value
+
+  def __str__( self ):
+    return repr( self.value )
+
+#-------------------------------------------------------------------------------
+class TokenBucket( object ):
+  """Limit the rate of the requests of all the clients sharing the bucket"""
+
+  #-----------------------------------------------------------------------------
+  def __init__( self, rate, burst = 1 ):
+    if rate <= 0:
+      raise RateLimitException( 'Invalid rate: %s' % rate )
+    if burst < 1:
+      raise RateLimitException( 'Invalid burst: %s' % burst )
+    self.rate   = float( rate )
+    self.burst  = float( burst )
+    self.tokens = self.burst
+    self.last   = time.time()
+    self.lock   = threading.Lock()
+    self.waited = 0.0
+
+  #-----------------------------------------------------------------------------
+  def reserve( self, count = 1 ):
+    """Take count tokens, possibly ahead of time, and return the number of
+    seconds to wait before using them"""
+    self.lock.acquire()
+    try:
+      now         = time.time()
+      self.tokens = min( self.burst,
+                         self.tokens + (now - self.last) * self.rate )
+      self.last   = now
+      self.tokens -= count
+      if self.tokens >= 0:
+        return 0.0
+      delay = -self.tokens / self.rate
+      self.waited += delay
+      return delay
+    finally:
+      self.lock.release()
+
+  #-----------------------------------------------------------------------------
+  def take( self, count = 1 ):
+    """Block until count tokens are available"""
+    delay = self.reserve( count )
+    if delay > 0:
+      time.sleep( delay )
+
+#-------------------------------------------------------------------------------
+def backoff( initial, maximum, retries ):
+  """Generate the delays before each of the retries: exponential, capped at
+  maximum and jittered so that the clients refused together do not come
+  back together"""
+  delay = initial
+  for i in xrange( retries ):
+    yield random.uniform( 0.5, 1.0 ) * delay
+    delay = min( delay * 2, maximum )
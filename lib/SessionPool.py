@@ -0,0 +1,251 @@
+#-------------------------------------------------------------------------------
+# Copyright (c) 2011-2013 by European Organization for Nuclear Research (CERN)
+# Author: Lukasz Janyst <ljanyst@cern.ch>
+#-------------------------------------------------------------------------------
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+"""
+Pool of logged in client connections reused across the scenario instances.
+
+The sessions are kept per (host, port, user), a session is handed out by
+acquire, logging in a new connection if there is no idle one, and handed
+back with release once the scenario is done with it, ie.:
+
+  session = SessionPool.pool.acquire( 'localhost', 1094, 'imposter' )
+  try:
+    client = session.client
+    client.send( client.kXR_stat( path='/tmp' ) )
+    client.receive()
+  finally:
+    SessionPool.pool.release( session )
+
+A session the scenario has left in an unknown state, ie. after an error or
+with responses still in flight, has to be discarded instead. The idle
+sessions are checked before being handed out again: the ones the server has
+closed or sent something to in the meantime are dropped, the ones idle for
+longer than pingAfter are pinged first.
+"""
+
+import time
+import socket
+import select
+import struct
+import threading
+
+import XProtocol
+
+from ImposterClient import ImposterClient
+from MessageHelper import MessageException
+from Utils import setupLogger
+
+#-------------------------------------------------------------------------------
+class SessionPoolException( Exception ):
+  def __init__( self, value ):
+    self.value = value
+
+  def __str__( self ):
+    return repr( self.value )
+
+#-------------------------------------------------------------------------------
+class Session( object ):
+  """A logged in connection, the context is the one the scenarios get"""
+
+  #-----------------------------------------------------------------------------
+  def __init__( self, key, sock, streamid, config = '' ):
+    self.key      = key
+    self.socket   = sock
+    self.context  = {'socket': sock, 'streamid': streamid, 'config': config}
+    self.client   = ImposterClient( self.context )
+    self.sessid   = None
+    self.uses     = 0
+    self.lastUsed = time.time()
+
+  #-----------------------------------------------------------------------------
+  def closed( self ):
+    """Check if the socket has been closed, ie. by the scenario"""
+    try:
+      self.socket.fileno()
+      return False
+    except socket.error:
+      return True
+
+  #-----------------------------------------------------------------------------
+  def stale( self ):
+    """Check if the server has closed the connection or sent something
+    unsolicited while the session was idle"""
+    if self.closed():
+      return True
+    return bool( select.select( [self.socket], [], [], 0 )[0] )
+
+  #-----------------------------------------------------------------------------
+  def ping( self, timeout ):
+    """Check if the server still answers on this connection"""
+    self.socket.settimeout( timeout )
+    try:
+      self.client.send( self.client.kXR_ping() )
+      response = self.client.receive()
+    except MessageException:
+      return False
+    finally:
+      self.socket.settimeout( None )
+    return struct.unpack( '>H', response[2:4] )[0] == \
+           XProtocol.XResponseType.kXR_ok
+
+  #-----------------------------------------------------------------------------
+  def close( self ):
+    try:
+      self.socket.close()
+    except socket.error:
+      pass
+
+#-------------------------------------------------------------------------------
+class SessionPool( object ):
+  """Idle logged in sessions keyed by (host, port, user)"""
+
+  #-----------------------------------------------------------------------------
+  def __init__( self, maxIdle = 60.0, pingAfter = 5.0, maxIdleSessions = None,
+                timeout = 30.0 ):
+    self.maxIdle         = maxIdle
+    self.pingAfter       = pingAfter
+    self.maxIdleSessions = maxIdleSessions
+    self.timeout         = timeout
+    self.lock            = threading.Lock()
+    self.idle            = {}
+    self.streamids       = 0
+    self.counters        = {'logins': 0, 'reused': 0, 'dropped': 0}
+    self.logger          = setupLogger( __name__ )
+
+  #-----------------------------------------------------------------------------
+  def connect( self, host, port, user, config = '' ):
+    """Open and log in a new session"""
+    self.lock.acquire()
+    try:
+      self.streamids = (self.streamids + 1) & 0xffff
+      streamid = self.streamids
+      self.counters['logins'] += 1
+    finally:
+      self.lock.release()
+
+    try:
+      sock = socket.create_connection( (host, port), self.timeout )
+    except socket.error, e:
+      raise SessionPoolException( 'Unable to connect to %s:%d: %s' %
+                                  (host, port, e) )
+
+    session = Session( (host, port, user), sock, streamid, config )
+    try:
+      session.sessid = session.client.do_full_handshake( username = user,
+                                                         verbose = False )
+    except MessageException, e:
+      session.close()
+      raise SessionPoolException( 'Unable to log in to %s:%d as %s: %s' %
+                                  (host, port, user, e) )
+    if session.sessid is None:
+      session.close()
+      raise SessionPoolException( 'Login to %s:%d as %s failed' %
+                                  (host, port, user) )
+    sock.settimeout( None )
+    return session
+
+  #-----------------------------------------------------------------------------
+  def acquire( self, host, port, user = 'imposter', config = '' ):
+    """Hand out an idle session or log in a new one"""
+    key = (host, port, user)
+    while True:
+      self.lock.acquire()
+      try:
+        sessions = self.idle.get( key )
+        session  = sessions.pop() if sessions else None
+      finally:
+        self.lock.release()
+
+      if session is None:
+        session = self.connect( host, port, user, config )
+        break
+
+      idle = time.time() - session.lastUsed
+      if idle > self.maxIdle or session.stale() or \
+         (idle > self.pingAfter and not session.ping( self.timeout )):
+        self.drop( session )
+        continue
+
+      self.lock.acquire()
+      self.counters['reused'] += 1
+      self.lock.release()
+      break
+
+    session.uses += 1
+    return session
+
+  #-----------------------------------------------------------------------------
+  def release( self, session ):
+    """Take a session back, the scenario must have received all the responses
+    to its requests"""
+    if session.closed():
+      self.drop( session )
+      return
+    session.lastUsed = time.time()
+
+    self.lock.acquire()
+    try:
+      sessions = self.idle.setdefault( session.key, [] )
+      if self.maxIdleSessions is None or \
+         len( sessions ) < self.maxIdleSessions:
+        sessions.append( session )
+        return
+    finally:
+      self.lock.release()
+    self.drop( session )
+
+  #-----------------------------------------------------------------------------
+  def discard( self, session ):
+    """Close a session the scenario has left in an unknown state"""
+    self.drop( session )
+
+  #-----------------------------------------------------------------------------
+  def drop( self, session ):
+    self.logger.debug( 'Dropping session %s after %d uses' %
+                       (str(session.key), session.uses) )
+    session.close()
+    self.lock.acquire()
+    self.counters['dropped'] += 1
+    self.lock.release()
+
+  #-----------------------------------------------------------------------------
+  def warm( self, host, port, user = 'imposter', count = 1, config = '' ):
+    """Log in count sessions up front and leave them idle"""
+    sessions = [self.connect( host, port, user, config )
+                for i in range( count )]
+    for session in sessions:
+      self.release( session )
+
+  #-----------------------------------------------------------------------------
+  def close( self ):
+    """Close all the idle sessions"""
+    self.lock.acquire()
+    try:
+      idle      = self.idle
+      self.idle = {}
+    finally:
+      self.lock.release()
+    for sessions in idle.values():
+      for session in sessions:
+        session.close()
+
+#-------------------------------------------------------------------------------
+# The pool shared by the scenarios of the process, ie. by runActive for the
+# scenarios with 'pooled' sessions
+#-------------------------------------------------------------------------------
+pool = SessionPool()
@@ -19,7 +19,6 @@
 import sys
 import re
 import random
-import copy
 import logging
 
 import XProtocol
@@ -105,12 +104,43 @@ def genSessId():
   """Return a random session ID of length 16"""
   return str(random.randrange(9999999999999999)).zfill(16)
 
+#-------------------------------------------------------------------------------
+class MessageStruct( list ):
+  """List of field dicts remembering the layout (the names of the XProtocol
+  structs it was assembled from) and the removed fields, so that it can be
+  mapped onto a precompiled codec. The layout is None if the fields have been
+  altered in a way the codec cannot follow."""
+
+  #-----------------------------------------------------------------------------
+  def __init__( self, fields, layout = None, exclude = () ):
+    list.__init__( self, fields )
+    self.layout  = layout
+    self.exclude = exclude
+
+  #-----------------------------------------------------------------------------
+  def _joinLayout( self, other ):
+    if not isinstance( other, MessageStruct ) or self.layout is None or \
+       other.layout is None or self.exclude or other.exclude:
+      return None, ()
+    return self.layout + other.layout, ()
+
+  #-----------------------------------------------------------------------------
+  def __add__( self, other ):
+    layout, exclude = self._joinLayout( other )
+    return MessageStruct( list.__add__( self, other ), layout, exclude )
+
+  #-----------------------------------------------------------------------------
+  def __iadd__( self, other ):
+    self.layout, self.exclude = self._joinLayout( other )
+    self.extend( other )
+    return self
+
 #-------------------------------------------------------------------------------
 def getMessageStruct( name ):
   """Return a representation of a struct as a list of dicts."""
   if hasattr( XProtocol, name ):
     struct = getattr( XProtocol, name )
-    return copy.copy( struct )
+    return MessageStruct( [dict( f ) for f in struct], (name,) )
   raise UtilsException( "Struct " + name + " not found" );
 
 #-------------------------------------------------------------------------------
@@ -138,12 +168,13 @@ def getResponseId( responseid ):
   except: pass
 
   try:
-    return XProtocol.XResponseType.reverse_mapping[responseid]
+    return XProtocol.XResponseType.reverseMapping[responseid]
   except: pass
 
-  raise UtilsException( "Invalid response id: " + str(requestid) );
+  raise UtilsException( "Invalid response id: " + str(responseid) );
 
-def get_attncode(attncode):
+#-------------------------------------------------------------------------------
+def getAttnCode( attncode ):
   """Return the string attn code associated with the given integer attn code, 
   or the other way around."""
   try:
@@ -152,8 +183,7 @@ def get_attncode(attncode):
   except: pass
 
   try:
-    return XProtocol.XActionCode.reverse_mapping[attncode]
+    return XProtocol.XActionCode.reverseMapping[attncode]
   except: pass
 
-  print "[!] Unknown attn code:", attncode
-  sys.exit(1)
+  raise UtilsException( "Invalid attn code: " + str(attncode) );
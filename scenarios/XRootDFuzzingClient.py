@@ -16,14 +16,25 @@ class XRootDFuzzingClient:
     def __call__(self, context):
         client = ImposterClient(context)
         mh = MessageHelper(context)
-        fuzzer = Fuzzer(context)
+
+        # The campaign may be given as --param=seed:start:stop[:checkpoint]
+        # to reproduce, split or resume it
+        seed, start, stop, checkpoint = None, 0, 1000, None
+        if context['param']:
+            args = context['param'].split(':')
+            seed, start, stop = int(args[0]), int(args[1]), int(args[2])
+            if len(args) > 3:
+                checkpoint = args[3]
+        fuzzer = Fuzzer(context, seed=seed)
+        print '[i] Fuzzer seed:', fuzzer.seed
 
         handshake_request = client.handshake()
-        print mh.unpack_request(handshake_request)
+        print mh.unpackRequest(handshake_request)
 
         # Fuzz a read request
-        for m in fuzzer.fuzz(handshake_request):
-            print mh.unpack_request(m)[0]
+        campaign = fuzzer.campaign(handshake_request, start, stop, checkpoint)
+        for i, m in campaign:
+            print '[i]', i, mh.unpackRequest(m)
             client.send(m)
             response_raw = client.receive()
             response = client.unpack(response_raw, m)
@@ -34,18 +45,18 @@ class XRootDFuzzingClient:
         #
         # # Open a file
         # open_request = client.kXR_open(path='/tmp/spam')
-        # print mh.unpack_request(open_request)[0]
+        # print mh.unpackRequest(open_request)
         # client.send(open_request)
         # response_raw = client.receive()
         # response = client.unpack(response_raw, open_request)
         # print response
         #
         # read_request = client.kXR_read(rlen=1024)
-        # print mh.unpack_request(read_request)
+        # print mh.unpackRequest(read_request)
         #
         # # Fuzz a read request
         # for m in fuzzer.fuzz(read_request):
-        #     print mh.unpack_request(m)[0]
+        #     print mh.unpackRequest(m)
         #     client.send(m)
         #     response_raw = client.receive()
         #     response = client.unpack(response_raw, m)
@@ -0,0 +1,58 @@
+from XrdImposter.ImposterClient import ImposterClient
+from XrdImposter.Fuzzer import Fuzzer, FuzzerException
+from XrdImposter.FuzzExecutor import Executor, RequestTarget
+
+
+class XRootDParallelFuzzingClient:
+    """Fuzz kXR_stat requests of a logged in client over a pool of worker
+    processes, each with its own connections to the server; the outcome of
+    every case goes to the merged log and the crashing cases are minimised
+    into reproducer scenarios. The campaign may be given as
+    --param=seed[:start[:stop[:workers]]], the checkpoint and the log are
+    named after the seed, the range and the number of workers so that a
+    campaign given again resumes and a new one starts afresh"""
+
+    @classmethod
+    def getDescription(cls):
+        return {'type': 'Active', 'hostname': 'localhost', 'port': 1094,
+                'clients': 1, 'config': ''}
+
+    def __call__(self, context):
+        # The workers open their own connections
+        context['socket'].close()
+        desc = self.getDescription()
+
+        args = [None, 0, 100000, 4]
+        if context['param']:
+            fields = context['param'].split(':')
+            try:
+                if len(fields) > len(args):
+                    raise ValueError('too many fields')
+                args[:len(fields)] = [int(f) for f in fields]
+            except ValueError, e:
+                print '[!] Invalid campaign %s: %s' % (context['param'], e)
+                return
+        seed, start, stop, workers = args
+
+        client = ImposterClient(context)
+        fuzzer = Fuzzer(context, seed=seed)
+        print '[i] Fuzzer seed:', fuzzer.seed
+
+        def login(client):
+            for request in (client.handshake(), client.kXR_protocol(),
+                            client.kXR_login(username='imposter')):
+                client.send(request)
+                client.receive()
+
+        name = 'stat-fuzz-%d-%d-%d-%d' % (fuzzer.seed, start, stop, workers)
+        campaign = fuzzer.campaign(client.kXR_stat(path='/tmp'), start, stop,
+                                   name + '.checkpoint')
+        target = RequestTarget(desc['hostname'], desc['port'], login)
+        executor = Executor(campaign, target, workers, name + '.log',
+                            reproducers='stat-fuzz-crashes')
+        try:
+            outcomes = executor.run()
+        except FuzzerException, e:
+            print '[!] Unable to run the campaign:', e
+            return
+        print '[i] Outcomes:', outcomes
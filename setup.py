@@ -18,7 +18,11 @@ setup( name             = 'XrdImposter',
        package_dir      = {'XrdImposter': 'lib'},
        data_files       = [('share/XrdImposter/examples',
                             ['examples/XRootDLogInClient.py',
-                             'examples/XRootDLogInServer.py'])],
+                             'examples/XRootDLogInServer.py',
+                             'examples/XRootDAsyncServer.py',
+                             'examples/XRootDLoadClient.py',
+                             'examples/XRootDReplayClient.py',
+                             'examples/XRootDDataServer.py'])],
        description      = "Implementation of the XRootD protocol",
        long_description = "Implementation of the XRootD protocol",
 #       ext_modules      = [